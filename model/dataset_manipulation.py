@@ -1,16 +1,23 @@
 import os
 import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from PIL import Image
 
 from utils.fileio import files_of_type, verify_dir, is_dir_empty, clear_dir
+from utils.dataset_pairing import pair_datasets
+from model.tile_cache import load_tile, open_tile_cache
 
 
 def reshape_inputs(img_list, mask_list, size=(576, 576)):
     """
     Read images, and resize, normalize and reshape for input to model.
 
+    Loads the whole dataset into memory. For large datasets, use
+    batch_generator() instead.
+
     Parameters
     ----------
     img_list: list
@@ -28,13 +35,9 @@ def reshape_inputs(img_list, mask_list, size=(576, 576)):
     X_list = []
     Y_list = []
     for image, mask in zip(img_list, mask_list):
-        im_X = Image.open(image)
-        im_X = im_X.convert('RGB')
-        im_X = im_X.resize(size)
-        X_list.append(np.array(im_X))
-
-        im_Y = Image.open(mask).resize(size)
-        Y_list.append(np.array(im_Y))
+        im_X, im_Y = load_tile(image, mask, size)
+        X_list.append(im_X)
+        Y_list.append(im_Y)
 
     x = np.asarray(X_list, dtype=np.float32)
     y = np.asarray(Y_list, dtype=np.float32)
@@ -52,6 +55,196 @@ def reshape_inputs(img_list, mask_list, size=(576, 576)):
     return x, y
 
 
+def load_batch(img_list, mask_list, size=(576, 576), preprocess=None,
+               mask_max=None, resample=None):
+    """
+    Read a batch of images and masks, then resize, normalize and reshape them
+    for input to the model.
+
+    Parameters
+    ----------
+    img_list: list
+        list of input image filenames in the batch
+    mask_list: list
+        list of mask image filenames in the batch
+    size: tuple
+        desired size of the image as tuple
+    preprocess: callable or None (default None)
+        Function applied to the normalized images, e.g. the output of
+        segmentation_models.get_preprocessing(). Ignored if None.
+    mask_max: float or None (default None)
+        Value that masks are divided by to normalize them to 0-1. If None,
+        masks are divided by the largest value in the batch (all blank
+        batches are left as zeros). For binary masks this matches
+        reshape_inputs, whether masks are stored as 0/1 or 0/255.
+    resample: int or None (default None)
+        PIL resample filter used for resizing. None uses the PIL default.
+
+    Returns
+    -------
+    x, y: (np.array, np.array)
+        float32 arrays of shape (n, size, size, 3) and (n, size, size, 1)
+    """
+    x = np.empty((len(img_list), size[1], size[0], 3), dtype=np.uint8)
+    y = np.empty((len(img_list), size[1], size[0]), dtype=np.uint8)
+    for i, (image, mask) in enumerate(zip(img_list, mask_list)):
+        x[i], y[i] = load_tile(image, mask, size, resample)
+
+    return normalize_batch(x, y, preprocess, mask_max)
+
+
+def normalize_batch(x, y, preprocess=None, mask_max=None):
+    """
+    Normalize and reshape a batch of raw uint8 images and masks for input to
+    the model.
+
+    Parameters
+    ----------
+    x: np.array
+        uint8 images of shape (n, size, size, 3)
+    y: np.array
+        uint8 masks of shape (n, size, size)
+    preprocess: callable or None (default None)
+        Function applied to the normalized images, e.g. the output of
+        segmentation_models.get_preprocessing(). Ignored if None.
+    mask_max: float or None (default None)
+        Value that masks are divided by to normalize them to 0-1. If None,
+        masks are divided by the largest value in the batch.
+
+    Returns
+    -------
+    x, y: (np.array, np.array)
+        float32 arrays of shape (n, size, size, 3) and (n, size, size, 1)
+    """
+    x = x.astype(np.float32)
+    y = y.astype(np.float32)[..., np.newaxis]
+
+    # Normalize
+    x /= 255.0
+    if mask_max is None:
+        mask_max = max(np.max(y), 1.)
+    y /= mask_max
+
+    if preprocess is not None:
+        x = preprocess(x)
+
+    return x, y
+
+
+def batch_generator(img_list, mask_list, batch_size=16, size=(576, 576),
+                    preprocess=None, augment=None, shuffle=False, seed=None,
+                    repeat=False, prefetch=0, n_threads=1, mask_max=None,
+                    resample=None, cache_dir=None):
+    """
+    Stream normalized and preprocessed batches of images and masks from disk.
+    Only the batches in flight are held in memory, so peak memory depends on
+    the batch size and not the size of the dataset. The generator can be
+    passed directly to keras fit, evaluate and predict.
+
+    Parameters
+    ----------
+    img_list: list
+        list of input image filenames
+    mask_list: list
+        list of mask image filenames
+    batch_size: int (default 16)
+        Number of samples per batch. The last batch of a pass may be smaller.
+    size: tuple
+        desired size of the image as tuple
+    preprocess: callable or None (default None)
+        Function applied to the normalized images, e.g. the output of
+        segmentation_models.get_preprocessing(). Ignored if None.
+    augment: callable or None (default None)
+        Function called as x, y = augment(x, y) on each batch after
+        preprocessing. Ignored if None.
+    shuffle: bool (default False)
+        Shuffle the order of samples on every pass?
+    seed: int (default None)
+        Seed for the shuffle order.
+    repeat: bool (default False)
+        Loop over the data forever? Required for keras fit, where the number
+        of batches is set by steps_per_epoch.
+    prefetch: int (default 0)
+        Number of batches to load ahead in background threads. If 0, batches
+        are loaded only when requested.
+    n_threads: int (default 1)
+        Number of background threads used for prefetching.
+    mask_max: float or None (default None)
+        Value that masks are divided by to normalize them to 0-1. If None,
+        masks are divided by the largest value in the batch (all blank
+        batches are left as zeros). For binary masks this matches
+        reshape_inputs, whether masks are stored as 0/1 or 0/255.
+    resample: int or None (default None)
+        PIL resample filter used for resizing. None uses the PIL default.
+    cache_dir: str or None (default None)
+        Root directory of a tile cache (see model.tile_cache). If given, the
+        resized tiles are decoded once into memory mapped arrays, built on
+        first use, and batches are read from those instead of the image
+        files. If None, every batch is decoded from the image files.
+
+    Yields
+    ------
+    x, y: (np.array, np.array)
+        float32 batches of shape (n, size, size, 3) and (n, size, size, 1)
+    """
+    rng = np.random.RandomState(seed)
+    n = len(img_list)
+
+    def batch_indices():
+        while True:
+            order = rng.permutation(n) if shuffle else np.arange(n)
+            for start in range(0, n, batch_size):
+                yield order[start:start + batch_size]
+            if not repeat:
+                return
+
+    if cache_dir is not None:
+        x_all, y_all = open_tile_cache(img_list, mask_list, cache_dir, size,
+                                       resample)
+
+        def load(idx):
+            # Sorted reads are sequential on disk
+            idx = np.sort(idx)
+            return normalize_batch(x_all[idx], y_all[idx], preprocess,
+                                   mask_max)
+    else:
+        def load(idx):
+            return load_batch([img_list[i] for i in idx],
+                              [mask_list[i] for i in idx],
+                              size, preprocess, mask_max, resample)
+
+    if prefetch <= 0:
+        for idx in batch_indices():
+            x, y = load(idx)
+            if augment is not None:
+                x, y = augment(x, y)
+            yield x, y
+        return
+
+    # Keep up to `prefetch` batches loading in the background
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        pending = deque()
+        for idx in batch_indices():
+            pending.append(pool.submit(load, idx))
+            if len(pending) > prefetch:
+                x, y = pending.popleft().result()
+                if augment is not None:
+                    x, y = augment(x, y)
+                yield x, y
+        while pending:
+            x, y = pending.popleft().result()
+            if augment is not None:
+                x, y = augment(x, y)
+            yield x, y
+
+
+def n_batches(n_samples, batch_size):
+    """
+    Number of batches needed to cover a dataset once.
+    """
+    return int(np.ceil(n_samples / batch_size))
+
+
 def reshape_and_save(img_list, out_dir, size=(576, 576)):
     """
     Read images, resize and save them
@@ -92,15 +285,18 @@ def test_train_valid_split(img_dir, mask_dir, output_root, n_set=None,
         coming out will be: test_img_SEED, test_mask_SEED, train_img_SEED,
         train_mask_SEED
     exclude: iterable[str] (default None)
-        Exclude any filenames in the list. Routine will search for file
-        basenames that appear in any way within exclude. Ignore if None.
+        Exclude any filenames in the list. Entries may be basenames or full
+        paths, and are matched on their basename. Ignore if None.
     n_set: int (default 1000)
         Number of images in the total dataset. If None or 0, the whole list of
         images in the img_dir folder will be used.
     test_train_valid: list[float] (default [0.2, 0.72, 0.08])
         Fractions of test, train and valid sets relative to n_set.
     seed: int (default None)
-        The seed to use to initialize np.random.seed. If None, ignore.
+        The seed for the random number generator. A local generator is used,
+        so the global numpy.random state is untouched. The splits are the
+        same as those made by seeding numpy.random.seed with this value. If
+        None, the splits are not repeatable.
     img_ext: str (default "png")
         The file extension of the images in the directory
     overwrite: bool (default False)
@@ -134,24 +330,29 @@ def test_train_valid_split(img_dir, mask_dir, output_root, n_set=None,
             else:  # Overwrite
                 os.remove(i_file)
 
-    # Set seed if exists
-    if seed is not None:
-        np.random.seed(seed)
+    # Local generator. RandomState draws match the legacy global
+    # numpy.random functions, so a seed always produces the same split.
+    rng = np.random.RandomState(seed)
 
-    # Get full set of image files
-    all_fn = files_of_type(img_dir, "*." + img_ext, fullpath=False)
+    # Get full set of image files that have a matching mask
+    pairs, img_only, _ = pair_datasets(img_dir, mask_dir, img_ext)
+    if len(img_only) > 0:
+        print(f"{len(img_only)} images have no matching mask and will be "
+              f"ignored.")
+    mask_names = dict(pairs)
+    all_fn = [im for im, _ in pairs]
 
     # If exclude provided, pop them out of all_fn
     if exclude is not None:
-        for fn in all_fn.copy():
-            # this handles full context pathnames in both. If speed is an issue
-            # refactor to require basenames only in exclude
-            if any(os.path.basename(fn) in fstr for fstr in exclude):
-                all_fn.remove(fn)
+        exclude = set(os.path.basename(fstr) for fstr in exclude)
+        all_fn = [fn for fn in all_fn if fn not in exclude]
 
     # Get the subset if requested to do so
     if n_set is not None and n_set > 0:
-        all_fn = list(np.random.choice(all_fn, n_set, replace=False))
+        if n_set > len(all_fn):
+            raise ValueError(f"n_set ({n_set}) is larger than the number of "
+                             f"available images ({len(all_fn)}).")
+        all_fn = [all_fn[i] for i in rng.permutation(len(all_fn))[:n_set]]
     else:
         n_set = len(all_fn)
 
@@ -165,27 +366,16 @@ def test_train_valid_split(img_dir, mask_dir, output_root, n_set=None,
         print("Set does not split evenly, biasing towards train.")
         ntrain = n_set - ntest - nvalid
 
-    # choose files to mark as test
-    all_fn_cp = all_fn.copy()
-    test = list(np.random.choice(all_fn_cp, ntest, replace=False))
-    for item in test:
-        all_fn_cp.remove(item)
-    # Choose Train Files
-    train = list(np.random.choice(all_fn_cp, ntrain, replace=False))
-    for item in train:
-        all_fn_cp.remove(item)
-    # Valid remains
-    assert len(all_fn_cp) == nvalid
-    valid = all_fn_cp
-
-    # Get file extensions for each images and masks
-    img_extn = "." + img_ext  # this was easy
-    # Find the filename of the first test image excluding extension
-    first_im = os.path.splitext(os.path.basename(test[0]))[0]
-    # Get the corresponding mask file
-    mask_files = files_of_type(mask_dir, first_im + "*")
-    mask_extn = os.path.splitext(mask_files[0])[-1]
+    # Label every file as test (0), train (1) or valid (2). Test files are
+    # drawn first, then train files from whatever remains, in order.
+    split = np.full(n_set, 2)
+    remaining = np.arange(n_set)
+    split[remaining[rng.permutation(remaining.size)[:ntest]]] = 0
+    remaining = remaining[split[remaining] == 2]
+    split[remaining[rng.permutation(remaining.size)[:ntrain]]] = 1
+    assert np.count_nonzero(split == 2) == nvalid
 
+    labels = dict(zip(all_fn, split))
 
     all_fn.sort()
     with open(test_im_file, "w") as test_im, \
@@ -197,13 +387,13 @@ def test_train_valid_split(img_dir, mask_dir, output_root, n_set=None,
         # Save files
         for f in all_fn:
             im_file = f
-            msk_file = f.replace(img_dir, mask_dir).replace(img_extn, mask_extn)
+            msk_file = mask_names[f]
 
             # Store to file depending on name
-            if im_file in test:
+            if labels[f] == 0:
                 test_im.write(im_file+"\n")
                 test_msk.write(msk_file+"\n")
-            elif im_file in train:
+            elif labels[f] == 1:
                 train_im.write(im_file+"\n")
                 train_msk.write(msk_file+"\n")
             else:  # it's in valid
@@ -251,8 +441,9 @@ def limit_dataset_size(img_dir, mask_dir, output_root, n_limit, seed,
     verify_dir(output_root)
     i = 0
 
-    # Get all files
-    all_fn = files_of_type(img_dir, "*." + img_ext)
+    # Get all files that have a matching mask
+    pairs, _, _ = pair_datasets(img_dir, mask_dir, img_ext, img_ext)
+    all_fn = [im for im, _ in pairs]
 
     while len(all_fn) > n_limit:
 
@@ -275,11 +466,12 @@ def limit_dataset_size(img_dir, mask_dir, output_root, n_limit, seed,
 
         # copy files
         for f in subset:
-            all_fn.remove(f)
-            im_file = f
-            msk_file = f.replace(img_dir, mask_dir)
-            shutil.copy(im_file, im_file.replace(img_dir, out_img_dir))
-            shutil.copy(msk_file, msk_file.replace(mask_dir, out_msk_dir))
+            shutil.copy(os.path.join(img_dir, f), os.path.join(out_img_dir, f))
+            shutil.copy(os.path.join(mask_dir, f), os.path.join(out_msk_dir, f))
+
+        # Remove the subset from the remaining files
+        subset = set(subset)
+        all_fn = [f for f in all_fn if f not in subset]
 
         i += 1
 
@@ -299,10 +491,8 @@ def limit_dataset_size(img_dir, mask_dir, output_root, n_limit, seed,
 
     # copy files
     for f in all_fn:
-        im_file = f
-        msk_file = f.replace(img_dir, mask_dir)
-        shutil.copy(im_file, im_file.replace(img_dir, out_img_dir))
-        shutil.copy(msk_file, msk_file.replace(mask_dir, out_msk_dir))
+        shutil.copy(os.path.join(img_dir, f), os.path.join(out_img_dir, f))
+        shutil.copy(os.path.join(mask_dir, f), os.path.join(out_msk_dir, f))
 
 
 def make_combo_dataset_txt(input_files, out_file, root_paths=None, weights=None, total_imgs=1000, seed=None, overwrite=False):
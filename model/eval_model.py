@@ -1,11 +1,17 @@
 import glob
 
 import csv
-
-from model.dataset_manipulation import reshape_inputs
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing as mp
+
+from model.dataset_manipulation import batch_generator
+from model.metrics import confusion_counts, bce_sum, metrics_from_counts, METRIC_NAMES, COUNT_NAMES
+from model.prediction_writer import save_prediction, save_plot, reshape_arr
+from utils.prediction_store import save_prediction_png, write_prediction_chunk, PRED_FORMATS
+from utils.results_store import append_result
 import os
 import shutil
-import matplotlib.pyplot as plt
 import numpy as np
 
 from keras.preprocessing.image import ImageDataGenerator
@@ -18,67 +24,32 @@ import segmentation_models as sm
 from utils.fileio import read_file_list, verify_dir, is_dir_empty
 
 
-def eval_model(test_img_dir, test_mask_dir, test_img_file, test_mask_file, weight_file, result_file, pred_dir,
-               plot_dir=None, backbone="resnet34", img_size=(576, 576), batchnorm=False, overwrite=False):
+LOSS = sm.losses.bce_jaccard_loss
+METRICS = [sm.metrics.iou_score,
+           sm.metrics.precision,
+           sm.metrics.recall,
+           sm.metrics.f1_score]
+
+
+def load_model(weight_file, backbone="resnet34", img_size=(576, 576), batchnorm=False):
     """
-    Perform the evaluation of the model
+    Create the model, compile it and load its weights.
 
     Parameters
     ----------
-    test_img_dir: str
-        Directory with test images to predict. Use None for test_img_file that contains full paths.
-    test_mask_dir: str
-        Directory with test masks. Use None for test_img_file that contains full paths.
-    test_img_file: str
-        Full context of file containing list of train images
-    test_mask_file: str
-        Full context of file containing list of train mask images
     weight_file: str
         Full location of saved weights
-    result_file: str
-        Full location of file to save results to
-    pred_dir: str
-        Full location of path to save prediction images
-    plot_dir: str
-        Full location of path to save plot images
     backbone: str
         Model backbone
     img_size: tuple
         Image size in (xxx, yyy)
     batchnorm: bool (default: False)
         Use batchnorm
-    overwrite: bool (default: False)
-        Should files be overwritten?
-    """
-
-    # test and create directories
-    verify_dir(pred_dir)
-    if not is_dir_empty(pred_dir):
-        if not overwrite:
-            print("Prediction directory is not empty, skipping operation...")
-            return
-        else:
-            shutil.rmtree(pred_dir)
-            verify_dir(pred_dir)
-
-    if plot_dir is not None:
-        verify_dir(plot_dir)
-        if not is_dir_empty(plot_dir):
-            if not overwrite:
-                print("Plot directory is not empty, skipping operation...")
-                return
-            else:
-                shutil.rmtree(plot_dir)
-                verify_dir(plot_dir)
-
-    # Get the list of all input/output files
-    images = read_file_list(test_img_file, test_img_dir)
-    masks = read_file_list(test_mask_file, test_mask_dir)
-
-    # Load and reshape the data
-    print("==== Load and Resize Data ====")
-    x, y = reshape_inputs(images, masks, img_size)
 
+    Returns
+    -------
+    the compiled keras model
+    """
     # Create the model and define metrics
     print("==== Create Model ====")
     model = sm.Unet(backbone,
@@ -89,114 +60,341 @@ def eval_model(test_img_dir, test_mask_dir, test_img_file, test_mask_file, weigh
     print("==== Compile Model ====")
     model.compile(
         optimizer=SGD(),
-        loss=sm.losses.bce_jaccard_loss,
-        metrics=[sm.metrics.iou_score,
-                 sm.metrics.precision,
-                 sm.metrics.recall,
-                 sm.metrics.f1_score],
+        loss=LOSS,
+        metrics=METRICS,
     )
 
     # Load the model meights
     print("==== Load Weights ====")
     model.load_weights(weight_file)
+    return model
+
+
+def prepare_output_dirs(pred_dir, plot_dir=None, overwrite=False, result_file=None):
+    """
+    Create the prediction and plot directories, clearing them if overwriting.
+    The result file is written last, so it marks a finished evaluation. If
+    it is missing, outputs left by an interrupted run are cleared too.
+
+    Parameters
+    ----------
+    pred_dir: str
+        Full location of path to save prediction images
+    plot_dir: str
+        Full location of path to save plot images. Ignored if None.
+    overwrite: bool (default: False)
+        Should files be overwritten?
+    result_file: str (default: None)
+        Full location of the result file of the evaluation. Ignored if None.
 
-    # Perform the metric evaluation
-    print("==== Perform Evaluation ====")
-    res = model.evaluate(x, y, batch_size=16, verbose=1)
+    Returns
+    -------
+    bool: False if the outputs already exist and should be skipped
+    """
+    if result_file is not None and not os.path.exists(result_file):
+        overwrite = True
+    for out_dir, name in [(pred_dir, "Prediction"), (plot_dir, "Plot")]:
+        if out_dir is None:
+            continue
+        verify_dir(out_dir)
+        if not is_dir_empty(out_dir):
+            if not overwrite:
+                print(f"{name} directory is not empty, skipping operation...")
+                return False
+            else:
+                shutil.rmtree(out_dir)
+                verify_dir(out_dir)
+    return True
+
+
+def evaluate_test_set(model, images, masks, weight_file, result_file, pred_dir, plot_dir=None,
+                      img_size=(576, 576), batch_size=16, cache_dir=None, max_pending_writes=64,
+                      plot_workers=None, compress_level=6, pred_format="png", pred_dtype="uint8",
+                      chunk_size=256, results_db=None, run_info=None):
+    """
+    Evaluate a loaded model on one test set. The network runs once per batch,
+    and the same predictions are used for both the metrics and the prediction
+    images. Confusion counts are accumulated as the batches stream by, and
+    the metrics are computed from the totals at the end, so they are the
+    metrics of the whole test set taken as one batch. Prediction images are
+    written in a background thread and plots are rendered in a pool of
+    worker processes, both while the next batch is predicted.
+
+    Parameters
+    ----------
+    model: keras model
+        Output of load_model()
+    images: list[str]
+        Full paths of the test images
+    masks: list[str]
+        Full paths of the test masks
+    weight_file: str
+        Full location of the weights the model was loaded from. Only its name
+        is recorded in the result file.
+    result_file: str
+        Full location of file to save results to. Ignored if None.
+    pred_dir: str
+        Full location of path to save prediction images
+    plot_dir: str
+        Full location of path to save plot images. Ignored if None.
+    img_size: tuple
+        Image size in (xxx, yyy)
+    batch_size: int (default 16)
+        Number of images predicted at once
+    cache_dir: str (default: None)
+        Root directory of a tile cache. If given, the test tiles are decoded
+        once and memory mapped for every later evaluation of the same set.
+    max_pending_writes: int (default 64)
+        Maximum number of images and plots waiting to be written. Bounds the
+        memory used when writing is slower than prediction.
+    plot_workers: int (default None)
+        Number of processes used to render plots. None uses one per CPU. The
+        processes are spawned and import the main module again, which must
+        not import TensorFlow at module level. In a daemonic process (e.g. a
+        multiprocessing.Pool worker), which can't start child processes,
+        plots are rendered in threads instead.
+    compress_level: int (default 6)
+        PNG compression level, 0-9, of the predictions and plots. Lower is
+        faster but makes larger files.
+    pred_format: str (default "png")
+        How predictions are stored, see utils.prediction_store. "png" saves
+        a grayscale PNG of the probabilities per image, "npz" saves chunks of
+        chunk_size predictions to compressed .npz files and "rgba" saves the
+        older min-max scaled RGBA images.
+    pred_dtype: str (default "uint8")
+        "uint8" or "float16", the precision of predictions in "npz" chunks
+    chunk_size: int (default 256)
+        Number of predictions per "npz" chunk
+    results_db: str (default None)
+        Full location of a results database (see utils.results_store) to
+        append the results to. Ignored if None.
+    run_info: dict (default None)
+        Run metadata stored with the results in results_db, e.g. train_set,
+        test_set, backbone, seed and model_rev.
+
+    Returns
+    -------
+    dict of the metric values keyed by model.metrics.METRIC_NAMES
+    """
+    if pred_format not in PRED_FORMATS:
+        raise ValueError(f"pred_format must be one of {PRED_FORMATS}.")
+
+    print("==== Perform Evaluation and Predictions ====")
+    counts = np.zeros(len(COUNT_NAMES))
+    bce_total = 0.
+
+    if plot_dir is None:
+        plotter = None
+    elif mp.current_process().daemon:
+        plotter = ThreadPoolExecutor(max_workers=plot_workers)
+    else:
+        # Spawned workers don't fork TensorFlow's state, but they do import
+        # __main__ again, so scripts keep their TensorFlow imports inside
+        # functions (see notebooks.eval_script)
+        plotter = ProcessPoolExecutor(max_workers=plot_workers, mp_context=mp.get_context("spawn"))
+
+    batches = batch_generator(images, masks, batch_size, img_size, prefetch=2,
+                              cache_dir=cache_dir)
+    try:
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending = deque()
+            chunk_names = []
+            chunk_preds = []
+            chunk_id = 0
+            for start, (x, y) in zip(range(0, len(images), batch_size), batches):
+                pred_imgs = np.asarray(model.predict_on_batch(x))
+
+                # Accumulate the metrics of this batch
+                counts += confusion_counts(y, pred_imgs)
+                bce_total += bce_sum(y, pred_imgs)
+
+                pred_imgs = reshape_arr(pred_imgs)
+                x = reshape_arr(x)
+                y = reshape_arr(y)
+
+                # Queue the plots and images to be saved
+                for im_id in range(len(x)):
+                    img_name = os.path.basename(images[start + im_id])
+                    pred_file = os.path.join(pred_dir, img_name)
+                    if pred_format == "png":
+                        pending.append(writer.submit(save_prediction_png, pred_file, pred_imgs[im_id],
+                                                     compress_level))
+                    elif pred_format == "rgba":
+                        pending.append(writer.submit(save_prediction, pred_file, pred_imgs[im_id],
+                                                     compress_level))
+                    else:
+                        chunk_names.append(img_name)
+                        chunk_preds.append(pred_imgs[im_id])
+                        if len(chunk_names) == chunk_size:
+                            pending.append(writer.submit(write_prediction_chunk, pred_dir, chunk_id, chunk_names,
+                                                         np.stack(chunk_preds), pred_dtype))
+                            chunk_names, chunk_preds = [], []
+                            chunk_id += 1
+                    if plotter is not None:
+                        pending.append(plotter.submit(save_plot, os.path.join(plot_dir, img_name),
+                                                      x[im_id], y[im_id], pred_imgs[im_id], img_size,
+                                                      compress_level))
+                    while len(pending) > max_pending_writes:
+                        pending.popleft().result()
+
+            if chunk_names:
+                pending.append(writer.submit(write_prediction_chunk, pred_dir, chunk_id, chunk_names,
+                                             np.stack(chunk_preds), pred_dtype))
+
+            # Raise any errors from the writes
+            for future in pending:
+                future.result()
+    finally:
+        if plotter is not None:
+            plotter.shutdown()
+
+    res = metrics_from_counts(counts, bce_total)
 
     # Write to file
     print("==== Save Evaluation ====")
-    csv_cols = ["weight file"] + list(model.metrics_names)
-    csv_row = [os.path.basename(weight_file)] + list(res)
+    csv_cols = ["weight file"] + METRIC_NAMES + COUNT_NAMES
+    csv_row = [os.path.basename(weight_file)] + [res[name] for name in METRIC_NAMES] + list(counts)
 
     print(csv_cols)
     print(csv_row)
 
-    with open(result_file, 'w', newline="") as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow(csv_cols)
-        writer.writerow(csv_row)
-
-    # Perform the prediction (images)
-    print("==== Perform Predictions ====")
-    pred_imgs = model.predict(x, batch_size=16)
-    pred_imgs = reshape_arr(pred_imgs)
-
-    x = reshape_arr(x)
-    y = reshape_arr(y)
-
-    # Save plots and images
-    print("==== Save Predictions ====")
-    figsize = 7
-    cols = 4
-    alpha = 0.5
-
-    for im_id, imname in enumerate(images):
-        img_name = os.path.basename(imname)
-        plt.imsave(os.path.join(pred_dir, img_name), pred_imgs[im_id],
-                   cmap=plt.cm.gray)
-
-        if plot_dir is not None:
-            fig, axes = plt.subplots(1, cols,
-                                     figsize=(cols * figsize, figsize))
-            axes[0].set_title("original", fontsize=15)
-            axes[1].set_title("ground truth", fontsize=15)
-            axes[2].set_title("prediction", fontsize=15)
-            axes[3].set_title("overlay", fontsize=15)
-            axes[0].imshow(x[im_id], cmap=get_cmap(x))
-            axes[0].set_axis_off()
-            axes[1].imshow(y[im_id], cmap=get_cmap(y))
-            axes[1].set_axis_off()
-
-            axes[2].imshow(pred_imgs[im_id], cmap=get_cmap(pred_imgs))
-            axes[2].set_axis_off()
-            axes[3].imshow(x[im_id], cmap=get_cmap(x))
-            axes[3].imshow(mask_to_red(zero_pad_mask(pred_imgs[im_id],
-                                                     desired_size=img_size[0])),
-                           cmap=get_cmap(pred_imgs),
-                           alpha=alpha)
-            axes[3].set_axis_off()
-            fig.savefig(os.path.join(plot_dir, img_name))
-            plt.close(fig)
-
-
-def zero_pad_mask(mask, desired_size):
-    pad = (desired_size - mask.shape[0]) // 2
-    padded_mask = np.pad(mask, pad, mode="constant")
-    return padded_mask
-
-
-def reshape_arr(arr):
-    if arr.ndim == 3:
-        return arr
-    elif arr.ndim == 4:
-        if arr.shape[3] == 3:
-            return arr
-        elif arr.shape[3] == 1:
-            return arr.reshape(arr.shape[0], arr.shape[1], arr.shape[2])
-
-
-def get_cmap(arr):
-    if arr.ndim == 3:
-        return 'gray'
-    elif arr.ndim == 4:
-        if arr.shape[3] == 3:
-            return 'jet'
-        elif arr.shape[3] == 1:
-            return 'gray'
-
-
-def mask_to_red(mask):
+    if result_file is not None:
+        verify_dir(os.path.dirname(result_file))
+        with open(result_file, 'w', newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(csv_cols)
+            writer.writerow(csv_row)
+
+    if results_db is not None:
+        run = dict(run_info or {}, weight_file=os.path.basename(weight_file))
+        append_result(results_db, run, dict(res, **dict(zip(COUNT_NAMES, counts))))
+
+    return res
+
+
+def eval_model(test_img_dir, test_mask_dir, test_img_file, test_mask_file, weight_file, result_file, pred_dir,
+               plot_dir=None, backbone="resnet34", img_size=(576, 576), batchnorm=False, overwrite=False,
+               cache_dir=None, plot_workers=None, compress_level=6, pred_format="png", results_db=None,
+               run_info=None):
+    """
+    Perform the evaluation of the model
+
+    Parameters
+    ----------
+    test_img_dir: str
+        Directory with test images to predict. Use None for test_img_file that contains full paths.
+    test_mask_dir: str
+        Directory with test masks. Use None for test_img_file that contains full paths.
+    test_img_file: str
+        Full context of file containing list of train images
+    test_mask_file: str
+        Full context of file containing list of train mask images
+    weight_file: str
+        Full location of saved weights
+    result_file: str
+        Full location of file to save results to
+    pred_dir: str
+        Full location of path to save prediction images
+    plot_dir: str
+        Full location of path to save plot images
+    backbone: str
+        Model backbone
+    img_size: tuple
+        Image size in (xxx, yyy)
+    batchnorm: bool (default: False)
+        Use batchnorm
+    overwrite: bool (default: False)
+        Should files be overwritten? Test sets without a result file are
+        always evaluated, clearing any outputs of an interrupted run.
+    cache_dir: str (default: None)
+        Root directory of a tile cache. If given, the test tiles are decoded
+        once and memory mapped for every later evaluation of the same set.
+    plot_workers: int (default None)
+        Number of processes used to render plots. None uses one per CPU.
+    compress_level: int (default 6)
+        PNG compression level, 0-9, of the predictions and plots.
+    pred_format: str (default "png")
+        How predictions are stored: "png", "npz" or "rgba". See
+        evaluate_test_set().
+    results_db: str (default None)
+        Full location of a results database to append the results to.
+    run_info: dict (default None)
+        Run metadata stored with the results in results_db. See
+        evaluate_test_set().
+    """
+    test_set = dict(test_img_dir=test_img_dir, test_mask_dir=test_mask_dir,
+                    test_img_file=test_img_file, test_mask_file=test_mask_file,
+                    result_file=result_file, pred_dir=pred_dir, plot_dir=plot_dir,
+                    results_db=results_db, run_info=run_info)
+    eval_model_many(weight_file, [test_set], backbone=backbone, img_size=img_size,
+                    batchnorm=batchnorm, overwrite=overwrite, cache_dir=cache_dir,
+                    plot_workers=plot_workers, compress_level=compress_level, pred_format=pred_format)
+
+
+def eval_model_many(weight_file, test_sets, backbone="resnet34", img_size=(576, 576), batchnorm=False,
+                    overwrite=False, cache_dir=None, plot_workers=None, compress_level=6, pred_format="png"):
     """
-    Converts binary segmentation mask from white to red color.
-    Also adds alpha channel to make black background transparent.
+    Evaluate one model on several test sets. The model is created and its
+    weights loaded only once, then each test set is streamed through it. The
+    outputs for each test set are the same as from eval_model().
+
+    Parameters
+    ----------
+    weight_file: str
+        Full location of saved weights
+    test_sets: list[dict]
+        One dict per test set, with the keys test_img_dir, test_mask_dir,
+        test_img_file, test_mask_file, result_file, pred_dir and plot_dir,
+        as for the arguments of eval_model(). plot_dir may be None. The
+        optional keys results_db and run_info are passed to
+        evaluate_test_set().
+    backbone: str
+        Model backbone
+    img_size: tuple
+        Image size in (xxx, yyy)
+    batchnorm: bool (default: False)
+        Use batchnorm
+    overwrite: bool (default: False)
+        Should files be overwritten? Test sets without a result file are
+        always evaluated, clearing any outputs of an interrupted run.
+    cache_dir: str (default: None)
+        Root directory of a tile cache. If given, the test tiles are decoded
+        once and memory mapped for every later evaluation of the same set.
+    plot_workers: int (default None)
+        Number of processes used to render plots. None uses one per CPU.
+    compress_level: int (default 6)
+        PNG compression level, 0-9, of the predictions and plots.
+    pred_format: str (default "png")
+        How predictions are stored: "png", "npz" or "rgba". See
+        evaluate_test_set().
+
+    Returns
+    -------
+    list of the metric dicts for each test set, None for skipped test sets
     """
-    img_size = mask.shape[0]
-    c1 = mask.reshape(img_size, img_size)
-    c2 = np.zeros((img_size, img_size))
-    c3 = np.zeros((img_size, img_size))
-    c4 = mask.reshape(img_size, img_size)
-    return np.stack((c1, c2, c3, c4), axis=-1)
+    # Check outputs first so that the model isn't loaded if nothing will run
+    todo = [prepare_output_dirs(t['pred_dir'], t.get('plot_dir'), overwrite, t['result_file'])
+            for t in test_sets]
+    results = [None] * len(test_sets)
+    if not any(todo):
+        return results
+
+    model = load_model(weight_file, backbone, img_size, batchnorm)
+
+    for i, test_set in enumerate(test_sets):
+        if not todo[i]:
+            continue
+        # Get the list of all input/output files
+        images = read_file_list(test_set['test_img_file'], test_set['test_img_dir'])
+        masks = read_file_list(test_set['test_mask_file'], test_set['test_mask_dir'])
+
+        results[i] = evaluate_test_set(model, images, masks, weight_file, test_set['result_file'],
+                                       test_set['pred_dir'], test_set.get('plot_dir'), img_size,
+                                       cache_dir=cache_dir, plot_workers=plot_workers,
+                                       compress_level=compress_level, pred_format=pred_format,
+                                       results_db=test_set.get('results_db'),
+                                       run_info=test_set.get('run_info'))
+    return results
 
 
 if __name__ == '__main__':
@@ -0,0 +1,97 @@
+import numpy as np
+
+
+METRIC_NAMES = ["loss", "iou_score", "precision", "recall", "f1-score"]
+COUNT_NAMES = ["tp", "fp", "fn", "tn"]
+
+
+def confusion_counts(y_true, y_pred, threshold=None):
+    """
+    Sum the confusion matrix counts of a batch of masks and predictions. With
+    no threshold the counts are soft, using the prediction probabilities as
+    weights, which is how segmentation_models computes its metrics.
+
+    Parameters
+    ----------
+    y_true: np.array
+        Ground truth masks with values in 0-1
+    y_pred: np.array
+        Predicted probabilities, same shape as y_true
+    threshold: float or None (default None)
+        If given, predictions are binarized at this value first.
+
+    Returns
+    -------
+    np.array of float64 [tp, fp, fn, tn]
+    """
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    if threshold is not None:
+        y_pred = (y_pred > threshold).astype(np.float64)
+
+    tp = np.sum(y_true * y_pred)
+    pred_pos = np.sum(y_pred)
+    true_pos = np.sum(y_true)
+    fp = pred_pos - tp
+    fn = true_pos - tp
+    tn = y_true.size - tp - fp - fn
+    return np.array([tp, fp, fn, tn])
+
+
+def bce_sum(y_true, y_pred, eps=1e-7):
+    """
+    Sum of the per-pixel binary crossentropy, clipped like keras.
+
+    Parameters
+    ----------
+    y_true: np.array
+        Ground truth masks with values in 0-1
+    y_pred: np.array
+        Predicted probabilities, same shape as y_true
+    eps: float (default 1e-7)
+        Clipping value for the probabilities, keras' default epsilon
+
+    Returns
+    -------
+    float
+    """
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.clip(np.asarray(y_pred, dtype=np.float64), eps, 1 - eps)
+    return float(-np.sum(y_true * np.log(y_pred) +
+                         (1 - y_true) * np.log(1 - y_pred)))
+
+
+def metrics_from_counts(counts, bce_total=None, smooth=1e-5):
+    """
+    Compute the segmentation metrics from accumulated confusion counts, with
+    the same formulas and smoothing as segmentation_models. Counts summed
+    over a whole test set give the metrics of the set as one batch.
+
+    Parameters
+    ----------
+    counts: np.array
+        [tp, fp, fn, tn], e.g. summed output of confusion_counts()
+    bce_total: float (default None)
+        Summed output of bce_sum() over the same pixels. If None, the loss is
+        returned as NaN.
+    smooth: float (default 1e-5)
+        Smoothing value added to numerator and denominator
+
+    Returns
+    -------
+    dict keyed by METRIC_NAMES. The loss is bce_jaccard_loss, i.e. the mean
+    binary crossentropy plus 1 - iou.
+    """
+    tp, fp, fn, tn = [float(c) for c in counts]
+
+    iou = (tp + smooth) / (tp + fp + fn + smooth)
+    precision = (tp + smooth) / (tp + fp + smooth)
+    recall = (tp + smooth) / (tp + fn + smooth)
+    f1 = (2 * tp + smooth) / (2 * tp + fn + fp + smooth)
+
+    if bce_total is None:
+        loss = np.nan
+    else:
+        loss = bce_total / (tp + fp + fn + tn) + 1 - iou
+
+    return dict(zip(METRIC_NAMES, [loss, iou, precision, recall, f1]))
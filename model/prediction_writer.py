@@ -0,0 +1,97 @@
+from matplotlib.figure import Figure
+from matplotlib.image import imsave
+import numpy as np
+
+
+def save_prediction(pred_file, pred, compress_level=6):
+    """
+    Save a single prediction in the older RGBA format, scaled to its own min
+    and max by matplotlib's imsave. See utils.prediction_store for the compact formats
+    that keep the absolute probabilities.
+
+    Parameters
+    ----------
+    pred_file: str
+        Full path of the output image
+    pred: np.array
+        The prediction, shape (size, size)
+    compress_level: int (default 6)
+        PNG compression level, 0-9. Lower is faster but makes larger files.
+    """
+    imsave(pred_file, pred, cmap="gray", pil_kwargs={"compress_level": compress_level})
+
+
+def save_plot(plot_file, x, y, pred, img_size=(576, 576), compress_level=6):
+    """
+    Render and save the 4-panel plot of an image, its ground truth, the
+    prediction and the prediction overlaid on the image. Uses the object
+    oriented matplotlib API rather than pyplot, so it is safe to call from
+    worker threads and processes.
+
+    Parameters
+    ----------
+    plot_file: str
+        Full path of the output image
+    x: np.array
+        The image, shape (size, size, 3)
+    y: np.array
+        The ground truth mask, shape (size, size)
+    pred: np.array
+        The prediction, shape (size, size)
+    img_size: tuple
+        Image size in (xxx, yyy)
+    compress_level: int (default 6)
+        PNG compression level, 0-9. Lower is faster but makes larger files.
+    """
+    figsize = 7
+    cols = 4
+    alpha = 0.5
+
+    fig = Figure(figsize=(cols * figsize, figsize))
+    axes = fig.subplots(1, cols)
+    axes[0].set_title("original", fontsize=15)
+    axes[1].set_title("ground truth", fontsize=15)
+    axes[2].set_title("prediction", fontsize=15)
+    axes[3].set_title("overlay", fontsize=15)
+    axes[0].imshow(x)
+    axes[0].set_axis_off()
+    axes[1].imshow(y, cmap='gray')
+    axes[1].set_axis_off()
+
+    axes[2].imshow(pred, cmap='gray')
+    axes[2].set_axis_off()
+    axes[3].imshow(x)
+    axes[3].imshow(mask_to_red(zero_pad_mask(pred, desired_size=img_size[0])),
+                   cmap='gray',
+                   alpha=alpha)
+    axes[3].set_axis_off()
+    fig.savefig(plot_file, pil_kwargs={"compress_level": compress_level})
+
+
+def zero_pad_mask(mask, desired_size):
+    pad = (desired_size - mask.shape[0]) // 2
+    padded_mask = np.pad(mask, pad, mode="constant")
+    return padded_mask
+
+
+def reshape_arr(arr):
+    if arr.ndim == 3:
+        return arr
+    elif arr.ndim == 4:
+        if arr.shape[3] == 3:
+            return arr
+        elif arr.shape[3] == 1:
+            return arr.reshape(arr.shape[0], arr.shape[1], arr.shape[2])
+
+
+def mask_to_red(mask):
+    """
+    Converts binary segmentation mask from white to red color.
+    Also adds alpha channel to make black background transparent.
+    """
+    img_size = mask.shape[0]
+    c1 = mask.reshape(img_size, img_size)
+    c2 = np.zeros((img_size, img_size))
+    c3 = np.zeros((img_size, img_size))
+    c4 = mask.reshape(img_size, img_size)
+    return np.stack((c1, c2, c3, c4), axis=-1)
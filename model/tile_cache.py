@@ -0,0 +1,186 @@
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+from PIL import Image
+
+from utils.fileio import verify_dir
+
+
+CACHE_VERSION = 1
+
+
+def load_tile(image, mask, size=(576, 576), resample=None):
+    """
+    Read a single image and mask pair and resize them.
+
+    Parameters
+    ----------
+    image: str
+        input image filename
+    mask: str
+        mask image filename
+    size: tuple
+        desired size of the image as tuple
+    resample: int or None (default None)
+        PIL resample filter used for resizing. None uses the PIL default.
+
+    Returns
+    -------
+    x, y: (np.array, np.array)
+        uint8 image of shape (size, size, 3) and mask of shape (size, size)
+    """
+    resize_args = (size,) if resample is None else (size, resample)
+
+    with Image.open(image) as im_X:
+        im_X = im_X.convert('RGB')
+        im_X = im_X.resize(*resize_args)
+        x = np.array(im_X)
+
+    with Image.open(mask) as im_Y:
+        y = np.array(im_Y.resize(*resize_args))
+
+    return x, y
+
+
+def tile_cache_key(img_list, mask_list, size=(576, 576), resample=None):
+    """
+    Compute the key of a tile cache. The key covers the cache layout version,
+    the ordered list of files with their size and modification time, the
+    output size and the resample mode, so any change to the inputs or the
+    resize settings produces a new cache.
+
+    Parameters
+    ----------
+    img_list: list
+        list of input image filenames
+    mask_list: list
+        list of mask image filenames
+    size: tuple
+        desired size of the image as tuple
+    resample: int or None (default None)
+        PIL resample filter used for resizing. None uses the PIL default.
+
+    Returns
+    -------
+    str: hex digest identifying the cache
+    """
+    h = hashlib.sha1()
+    h.update(f"v{CACHE_VERSION};{tuple(size)};{resample}\n".encode())
+    for image, mask in zip(img_list, mask_list):
+        for fn in (image, mask):
+            st = os.stat(fn)
+            h.update(f"{os.path.abspath(fn)};{st.st_size};"
+                     f"{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def build_tile_cache(img_list, mask_list, cache_dir, size=(576, 576),
+                     resample=None, verbose=True):
+    """
+    Decode and resize a dataset once and store it as uint8 .npy arrays that
+    can be memory mapped. Images are stored as x.npy with shape
+    (n, size, size, 3) and masks as y.npy with shape (n, size, size). The
+    arrays are written to a temporary directory that is renamed into place
+    when complete, so a partial cache is never used. If the cache already
+    exists it is not rebuilt.
+
+    Parameters
+    ----------
+    img_list: list
+        list of input image filenames
+    mask_list: list
+        list of mask image filenames
+    cache_dir: str
+        Root directory of the cache. Each dataset is stored in a subdirectory
+        named by tile_cache_key().
+    size: tuple
+        desired size of the image as tuple
+    resample: int or None (default None)
+        PIL resample filter used for resizing. None uses the PIL default.
+    verbose: bool (default True)
+        Print status?
+
+    Returns
+    -------
+    str: full path of the cache subdirectory for this dataset
+    """
+    if len(img_list) != len(mask_list):
+        raise ValueError("Image and mask lists have different lengths.")
+
+    key = tile_cache_key(img_list, mask_list, size, resample)
+    out_dir = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(out_dir, "meta.json")):
+        return out_dir
+
+    if verbose:
+        print(f"Building tile cache for {len(img_list)} tiles in {out_dir}")
+
+    verify_dir(cache_dir)
+    tmp_dir = os.path.join(cache_dir, f".{key}.{os.getpid()}")
+    verify_dir(tmp_dir)
+
+    n = len(img_list)
+    x = np.lib.format.open_memmap(os.path.join(tmp_dir, "x.npy"), mode="w+",
+                                  dtype=np.uint8,
+                                  shape=(n, size[1], size[0], 3))
+    y = np.lib.format.open_memmap(os.path.join(tmp_dir, "y.npy"), mode="w+",
+                                  dtype=np.uint8,
+                                  shape=(n, size[1], size[0]))
+    for i, (image, mask) in enumerate(zip(img_list, mask_list)):
+        x[i], y[i] = load_tile(image, mask, size, resample)
+    x.flush()
+    y.flush()
+    del x, y
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({"version": CACHE_VERSION,
+                   "size": list(size),
+                   "resample": resample,
+                   "images": list(img_list),
+                   "masks": list(mask_list)}, f)
+
+    try:
+        os.rename(tmp_dir, out_dir)
+    except OSError:
+        # Someone else finished the same cache first
+        shutil.rmtree(tmp_dir)
+
+    return out_dir
+
+
+def open_tile_cache(img_list, mask_list, cache_dir, size=(576, 576),
+                    resample=None, verbose=True):
+    """
+    Memory map the cached arrays of a dataset, building the cache first if
+    it doesn't exist yet. The arrays are read only and are paged in from disk
+    as they are indexed, so the dataset is never decoded again on warm runs.
+
+    Parameters
+    ----------
+    img_list: list
+        list of input image filenames
+    mask_list: list
+        list of mask image filenames
+    cache_dir: str
+        Root directory of the cache
+    size: tuple
+        desired size of the image as tuple
+    resample: int or None (default None)
+        PIL resample filter used for resizing. None uses the PIL default.
+    verbose: bool (default True)
+        Print status?
+
+    Returns
+    -------
+    x, y: (np.memmap, np.memmap)
+        uint8 images of shape (n, size, size, 3) and masks of shape
+        (n, size, size)
+    """
+    out_dir = build_tile_cache(img_list, mask_list, cache_dir, size,
+                               resample, verbose)
+    x = np.load(os.path.join(out_dir, "x.npy"), mmap_mode="r")
+    y = np.load(os.path.join(out_dir, "y.npy"), mmap_mode="r")
+    return x, y
@@ -1,10 +1,12 @@
 import glob, os
+from functools import partial
+
+import numpy as np
 # import argparse
 #
-# import tensorflow as tf
+import tensorflow as tf
 # gpu_options = tf.compat.v1.GPUOptions(allow_growth=True)
 # session = tf.compat.v1.InteractiveSession(config=tf.compat.v1.ConfigProto(gpu_options=gpu_options))
-from keras.preprocessing.image import ImageDataGenerator
 from sklearn.model_selection import train_test_split
 from keras.callbacks import ModelCheckpoint, CSVLogger, EarlyStopping
 from keras.optimizers import Adam, SGD
@@ -16,7 +18,7 @@ import segmentation_models as sm
 # from livelossplot import PlotLossesKeras
 
 
-from model.dataset_manipulation import reshape_inputs
+from model.dataset_manipulation import batch_generator, n_batches
 from utils.fileio import read_file_list, verify_dir
 
 
@@ -49,6 +51,203 @@ def write_header(csvfile, train_img_dir, train_mask_dir,
         f.write("epoch,train_loss,train_IOU,val_loss,val_IOU\n")
 
 
+FILL_MODES = {"constant": "CONSTANT", "nearest": "NEAREST",
+              "reflect": "REFLECT", "wrap": "WRAP"}
+
+AUGMENT_KEYS = ["rotation_range", "width_shift_range", "height_shift_range",
+                "shear_range", "zoom_range", "horizontal_flip",
+                "vertical_flip", "fill_mode", "cval"]
+
+
+def random_transforms(seed, n, height, width, rotation_range=0.,
+                      width_shift_range=0., height_shift_range=0.,
+                      shear_range=0., zoom_range=0., horizontal_flip=False,
+                      vertical_flip=False):
+    """
+    Draw random affine transforms with the same distributions and the same
+    composition (rotation, shift, shear, zoom about the image center, then
+    flips) as keras ImageDataGenerator.get_random_transform.
+
+    Parameters
+    ----------
+    seed: tf.Tensor
+        int64 tensor of shape [2], seed for the stateless random ops
+    n: int or tf.Tensor
+        Number of transforms to draw
+    height: int
+        Image height in pixels
+    width: int
+        Image width in pixels
+    rotation_range: float (default 0.)
+        Degree range for random rotations
+    width_shift_range: float (default 0.)
+        Horizontal shift as a fraction of the width if < 1, else pixels
+    height_shift_range: float (default 0.)
+        Vertical shift as a fraction of the height if < 1, else pixels
+    shear_range: float (default 0.)
+        Shear angle range in degrees
+    zoom_range: float or [lower, upper] (default 0.)
+        Range for random zoom. A float z is the range [1-z, 1+z].
+    horizontal_flip: bool (default False)
+        Randomly flip half of the images left-right?
+    vertical_flip: bool (default False)
+        Randomly flip half of the images up-down?
+
+    Returns
+    -------
+    tf.Tensor of shape [n, 8], transforms in the format used by
+    ImageProjectiveTransformV3, mapping output pixels to input pixels
+    """
+    seeds = tf.random.experimental.stateless_split(seed, 8)
+
+    def uniform(i, lo, hi):
+        return tf.random.stateless_uniform([n], seeds[i], lo, hi)
+
+    if height_shift_range < 1:
+        height_shift_range *= height
+    if width_shift_range < 1:
+        width_shift_range *= width
+    if np.isscalar(zoom_range):
+        zoom_range = [1 - zoom_range, 1 + zoom_range]
+
+    theta = uniform(0, -rotation_range, rotation_range) * np.pi / 180
+    tx = uniform(1, -height_shift_range, height_shift_range)
+    ty = uniform(2, -width_shift_range, width_shift_range)
+    shear_angle = uniform(3, -shear_range, shear_range) * np.pi / 180
+    zx = uniform(4, zoom_range[0], zoom_range[1])
+    zy = uniform(5, zoom_range[0], zoom_range[1])
+    flip_h = tf.logical_and(horizontal_flip, uniform(6, 0., 1.) < 0.5)
+    flip_v = tf.logical_and(vertical_flip, uniform(7, 0., 1.) < 0.5)
+
+    zeros = tf.zeros([n])
+    ones = tf.ones([n])
+
+    def matrix(rows):
+        return tf.stack([tf.stack(row, axis=-1) for row in rows], axis=-2)
+
+    # Same matrices as keras, in (row, col) coordinates
+    rotation = matrix([[tf.cos(theta), -tf.sin(theta), zeros],
+                       [tf.sin(theta), tf.cos(theta), zeros],
+                       [zeros, zeros, ones]])
+    shift = matrix([[ones, zeros, tx], [zeros, ones, ty], [zeros, zeros, ones]])
+    shear = matrix([[ones, -tf.sin(shear_angle), zeros],
+                    [zeros, tf.cos(shear_angle), zeros],
+                    [zeros, zeros, ones]])
+    zoom = matrix([[zx, zeros, zeros], [zeros, zy, zeros], [zeros, zeros, ones]])
+    transform = rotation @ shift @ shear @ zoom
+
+    # Transform about the image center, with keras' offset convention
+    o_r = height / 2 + 0.5
+    o_c = width / 2 + 0.5
+    offset = matrix([[ones, zeros, o_r * ones], [zeros, ones, o_c * ones],
+                     [zeros, zeros, ones]])
+    reset = matrix([[ones, zeros, -o_r * ones], [zeros, ones, -o_c * ones],
+                    [zeros, zeros, ones]])
+    transform = offset @ transform @ reset
+
+    # Swap to (x, y) = (col, row) coordinates
+    swap = tf.constant([[0., 1., 0.], [1., 0., 0.], [0., 0., 1.]])
+    transform = swap @ transform @ swap
+
+    # Flips are applied to the output, so they act on the output coordinates
+    sx = tf.where(flip_h, -ones, ones)
+    sy = tf.where(flip_v, -ones, ones)
+    flips = matrix([[sx, zeros, tf.where(flip_h, (width - 1) * ones, zeros)],
+                    [zeros, sy, tf.where(flip_v, (height - 1) * ones, zeros)],
+                    [zeros, zeros, ones]])
+    transform = transform @ flips
+
+    return tf.reshape(transform, [-1, 9])[:, :8]
+
+
+def get_tf_augmenter(data_gen_args, seed=0):
+    """
+    Build a function that applies random augmentation to a batch of images
+    and masks inside a tf.data pipeline. The images and masks are stacked
+    along the channel axis and transformed together, so each mask always
+    gets exactly the same geometry as its image. Randomness is stateless and
+    derived from the seed and the batch number, so results do not depend on
+    the number of parallel calls.
+
+    Parameters
+    ----------
+    data_gen_args: dict
+        keyword arguments as for keras ImageDataGenerator. Supported keys are
+        rotation_range, width_shift_range, height_shift_range, shear_range,
+        zoom_range, horizontal_flip, vertical_flip, fill_mode and cval.
+    seed: int (default 0)
+        random number initialization value
+
+    Returns
+    -------
+    augment: callable
+        Function called as x, y = augment(step, (x, y)) on a batch, where
+        step is the batch number (e.g. from tf.data.Dataset.enumerate)
+    """
+    unknown = set(data_gen_args) - set(AUGMENT_KEYS)
+    if unknown:
+        raise ValueError(f"Unsupported augmentation arguments: {unknown}")
+
+    args = dict(data_gen_args)
+    fill_mode = FILL_MODES[args.pop("fill_mode", "nearest")]
+    fill_value = float(args.pop("cval", 0.))
+    seed = 0 if seed is None else seed
+
+    def augment(step, batch):
+        x, y = batch
+        n_x = x.shape[-1]
+        shape = tf.shape(x)
+        transforms = random_transforms(tf.stack([tf.cast(seed, tf.int64), step]),
+                                       shape[0], x.shape[1], x.shape[2],
+                                       **args)
+        xy = tf.raw_ops.ImageProjectiveTransformV3(
+            images=tf.concat([x, y], axis=-1),
+            transforms=transforms,
+            output_shape=shape[1:3],
+            fill_value=fill_value,
+            interpolation="BILINEAR",
+            fill_mode=fill_mode)
+        return xy[..., :n_x], xy[..., n_x:]
+
+    return augment
+
+
+def augment_dataset(dataset, data_gen_args, seed=0, num_parallel_calls=None,
+                    prefetch=None):
+    """
+    Add random augmentation and prefetching to a tf.data.Dataset of
+    (images, masks) batches.
+
+    Parameters
+    ----------
+    dataset: tf.data.Dataset
+        Dataset yielding batches of images (n, h, w, c) and masks (n, h, w, 1)
+    data_gen_args: dict
+        keyword arguments as for keras ImageDataGenerator. See
+        get_tf_augmenter() for the supported keys.
+    seed: int (default 0)
+        random number initialization value
+    num_parallel_calls: int (default None)
+        Number of batches to augment in parallel. None lets tf.data tune it.
+    prefetch: int (default None)
+        Number of batches to prefetch. None lets tf.data tune it.
+
+    Returns
+    -------
+    tf.data.Dataset of augmented (images, masks) batches
+    """
+    if num_parallel_calls is None:
+        num_parallel_calls = tf.data.AUTOTUNE
+    if prefetch is None:
+        prefetch = tf.data.AUTOTUNE
+
+    augment = get_tf_augmenter(data_gen_args, seed)
+    dataset = dataset.enumerate().map(augment,
+                                      num_parallel_calls=num_parallel_calls,
+                                      deterministic=True)
+    return dataset.prefetch(prefetch)
+
+
 def get_augmented(
         X_train,
         Y_train,
@@ -61,42 +260,70 @@ def get_augmented(
             horizontal_flip=True,
             vertical_flip=False,
             fill_mode="constant",
-        )
+        ),
+        num_parallel_calls=None,
+        prefetch=None
     ):
     """
-    Copied from keras_unet: https://github.com/karolzak/keras-unet
-    Duplicated here just to reduce dependencies
+    Originally copied from keras_unet: https://github.com/karolzak/keras-unet
+    Now built on tf.data instead of a pair of ImageDataGenerators, so the
+    image and mask transforms are identical by construction and batches are
+    augmented in parallel.
 
     Note that because get_augmented is only used for the training data, this
     may be one cause of validation loss being lower than training loss.
 
     Parameters
     ----------
-    X_train
-    Y_train
-    batch_size
-    seed
-    data_gen_args
+    X_train: np.array
+        Images of shape (n, h, w, 3)
+    Y_train: np.array
+        Masks of shape (n, h, w, 1)
+    batch_size: int (default 32)
+        Number of samples per batch
+    seed: int (default 0)
+        random number initialization value
+    data_gen_args: dict
+        keyword arguments as for keras ImageDataGenerator. See
+        get_tf_augmenter() for the supported keys.
+    num_parallel_calls: int (default None)
+        Number of batches to augment in parallel. None lets tf.data tune it.
+    prefetch: int (default None)
+        Number of batches to prefetch. None lets tf.data tune it.
 
     Returns
     -------
+    tf.data.Dataset repeating shuffled, augmented (images, masks) batches
+    """
+    dataset = tf.data.Dataset.from_tensor_slices((X_train, Y_train))
+    dataset = dataset.shuffle(len(X_train), seed=seed).repeat()
+    dataset = dataset.batch(batch_size)
+    return augment_dataset(dataset, data_gen_args, seed, num_parallel_calls,
+                           prefetch)
+
 
+def generator_dataset(make_generator, img_size):
     """
-    # Train data, provide the same seed and keyword arguments to the fit and
-    # flow methods
-    X_datagen = ImageDataGenerator(**data_gen_args)
-    Y_datagen = ImageDataGenerator(**data_gen_args)
-    X_datagen.fit(X_train, augment=True, seed=seed)
-    Y_datagen.fit(Y_train, augment=True, seed=seed)
-    X_train_augmented = X_datagen.flow(
-        X_train, batch_size=batch_size, shuffle=True, seed=seed
-    )
-    Y_train_augmented = Y_datagen.flow(
-        Y_train, batch_size=batch_size, shuffle=True, seed=seed
-    )
+    Wrap a batch_generator() in a tf.data.Dataset.
 
-    train_generator = zip(X_train_augmented, Y_train_augmented)
-    return train_generator
+    Parameters
+    ----------
+    make_generator: callable
+        Called with no arguments to create a new batch_generator() each time
+        the dataset is iterated, so every iteration starts from the first
+        batch.
+    img_size: tuple
+        Image size in (xxx, yyy)
+
+    Returns
+    -------
+    tf.data.Dataset of (images, masks) batches
+    """
+    signature = (
+        tf.TensorSpec((None, img_size[1], img_size[0], 3), tf.float32),
+        tf.TensorSpec((None, img_size[1], img_size[0], 1), tf.float32))
+    return tf.data.Dataset.from_generator(make_generator,
+                                          output_signature=signature)
 
 
 # Questions:
@@ -110,7 +337,7 @@ def train_unet(train_img_dir, train_mask_dir,
                log_file, best_weight_file, end_weight_file=None, valid_img_dir=None, valid_mask_dir=None,
                backbone="resnet34", seed=42, img_size=(576, 576),
                epochs=350, freeze_encoder=True, patience=0, batchnorm=False,
-               overwrite=False):
+               overwrite=False, cache_dir=None):
     """
 
     Parameters
@@ -155,6 +382,10 @@ def train_unet(train_img_dir, train_mask_dir,
         Use batch norm?
     overwrite: bool (default=False)
         Overwrite existing data?
+    cache_dir: str (default None)
+        Root directory of a tile cache. If given, the resized tiles are
+        decoded once and then memory mapped on later runs. Use None to decode
+        the image files for every batch.
     """
 
     if os.path.exists(best_weight_file) and not overwrite:
@@ -176,30 +407,18 @@ def train_unet(train_img_dir, train_mask_dir,
     valid_imgs = read_file_list(valid_img_file, valid_img_dir)
     valid_masks = read_file_list(valid_mask_file, valid_mask_dir)
 
-    # Load and split the data
+    # Stream the data from disk in batches
     print("==== Load and Split Data ====")
-    x_train, y_train = reshape_inputs(train_imgs, train_masks, img_size)
-    x_val, y_val = reshape_inputs(valid_imgs, valid_masks, img_size)
-
-    # assert y_val.shape == x_val.shape
-    # assert y_train.shape == x_train.shape
-    print("x_train: ", x_train.shape)
-    print("y_train: ", y_train.shape)
-    print("x_val: ", x_val.shape)
-    print("y_val: ", y_val.shape)
+    print("n_train: ", len(train_imgs))
+    print("n_val: ", len(valid_imgs))
 
     # Preprocess the inputs via segmentation_model
     print("==== Preprocess Data ====")
     preprocess_input = sm.get_preprocessing(backbone)
-    x_train = preprocess_input(x_train)
-    x_val = preprocess_input(x_val)
 
     print("==== Augment Data ====")
-    # Augment the data
-    # Memory problems on this step
-    # For more fixes see:
-    #   https://github.com/keras-team/keras/issues/1627
-    #   https://stackoverflow.com/questions/46705600/keras-fit-image-augmentations-to-training-data-using-flow-from-directory
+    # Augment the data. Batches are streamed from disk and transformed in
+    # parallel by tf.data, so the full dataset never has to sit in memory.
     augment_dict = dict(
             rotation_range=30.,
             width_shift_range=0.1,
@@ -210,13 +429,35 @@ def train_unet(train_img_dir, train_mask_dir,
             # vertical_flip=True,
             # fill_mode='constant'
         )
-    train_gen = get_augmented(
-        x_train,
-        y_train,
+    batch_size = 4  # 2
+    train_gen = partial(
+        batch_generator,
+        train_imgs,
+        train_masks,
+        batch_size=batch_size,
+        size=img_size,
+        preprocess=preprocess_input,
+        shuffle=True,
         seed=seed,
-        batch_size=4,  # 2
-        data_gen_args=augment_dict
+        repeat=True,
+        prefetch=2,
+        cache_dir=cache_dir
+    )
+    train_data = augment_dataset(generator_dataset(train_gen, img_size),
+                                 augment_dict, seed=seed)
+    val_batch_size = 16
+    val_gen = partial(
+        batch_generator,
+        valid_imgs,
+        valid_masks,
+        batch_size=val_batch_size,
+        size=img_size,
+        preprocess=preprocess_input,
+        repeat=True,
+        prefetch=2,
+        cache_dir=cache_dir
     )
+    val_data = generator_dataset(val_gen, img_size).prefetch(tf.data.AUTOTUNE)
 
     # Setup outputs
     print("==== Setup Callbacks ====")
@@ -256,10 +497,11 @@ def train_unet(train_img_dir, train_mask_dir,
 
     print("==== Train ====")
     history = model.fit(
-        train_gen,
-        steps_per_epoch=x_train.shape[0]//4,
+        train_data,
+        steps_per_epoch=len(train_imgs)//batch_size,
         epochs=epochs,
-        validation_data=(x_val, y_val),
+        validation_data=val_data,
+        validation_steps=n_batches(len(valid_imgs), val_batch_size),
         callbacks=callbacks,
         verbose=2
     )
@@ -1,14 +1,16 @@
 from model.dataset_manipulation import test_train_valid_split, make_combo_dataset_txt
-from model.train_model import train_unet
-from model.eval_model import eval_model
-
 from postprocess.images_to_plots import multimodel_plot, model_boundary_plot
-from postprocess.summarize_results import generate_run_summary
-from postprocess.imagewise_metrics import aggregate_imagewise_metrics
+from postprocess.summarize_results import generate_results_summary
+from postprocess.imagewise_metrics import aggregate_imagewise_metrics, threshold_sweep
+from notebooks.job_scheduler import make_job, run_jobs
+from notebooks.experiment_layout import ExperimentLayout
 import os
 import gc
 from collections import OrderedDict
 
+# model.train_model and model.eval_model load TensorFlow, so they are imported inside the functions that use them.
+# Spawned workers, e.g. eval_model's plot workers, import this script again.
+
 
 def run():
     # #### SETTINGS #####
@@ -35,6 +37,10 @@ def run():
     myseeds = [42]
     n_set = 1000
 
+    # Resized tiles are decoded once and memory mapped here. Set to None to
+    # always decode the image files.
+    tile_cache = os.path.join(dataroot, "tile_cache")
+
     # ## Train ##
     do_train_models = True
 
@@ -58,7 +64,20 @@ def run():
     do_summary = True
     do_boundary_plots = False
     do_multi_plots = False
+    fast_plots = False  # Compose the plots as image mosaics, much faster than matplotlib figures but without a legend
     do_imagewise_metrics = True
+    do_threshold_sweep = True
+    post_workers = os.cpu_count()  # Worker processes for the per-image postprocessing
+
+    # ## Scheduler ##
+    # Run train, test and post as a DAG of jobs, each in its own process. Job
+    # state is saved so that an interrupted sweep picks up where it stopped.
+    use_scheduler = True
+
+    n_workers = 1  # Keep at 1 when all jobs share a single GPU
+    threads_per_job = None
+    job_state_file = os.path.join(dataroot, "results", "job_state.json")
+    skip_existing = True  # Leave out train and eval jobs whose outputs already exist
 
     # #### END SETTINGS ####
 
@@ -73,24 +92,37 @@ def run():
         print("\n\n===== BUILD DATASETS =====\n\n")
         build_datasets(paths, train_sets, myseeds, n_set, splits, combo_sets)
 
+    if use_scheduler:
+        print("\n\n===== RUN JOBS =====\n\n")
+        jobs = build_jobs(paths, train_sets, myseeds, mybackbones, model_revs, test_sets, mysize, epochs, freeze,
+                          patience, norm, test_weights, do_plots, do_train_models, do_test_models, do_post,
+                          do_summary, do_boundary_plots, do_multi_plots, do_imagewise_metrics, do_threshold_sweep,
+                          cache_dir=tile_cache, skip_existing=skip_existing, post_workers=post_workers,
+                          fast_plots=fast_plots)
+        run_jobs(jobs, job_state_file, n_workers=n_workers, threads_per_job=threads_per_job)
+        return
+
     if do_train_models:
         print("\n\n===== TRAINING =====\n\n")
-        train_models(paths, train_sets, myseeds, mybackbones, model_revs, mysize, epochs, freeze, patience, norm)
+        train_models(paths, train_sets, myseeds, mybackbones, model_revs, mysize, epochs, freeze, patience, norm,
+                     cache_dir=tile_cache)
 
     if do_test_models:
         print("\n\n===== TESTING =====\n\n")
-        eval_models(paths, train_sets, myseeds, mybackbones, model_revs, test_sets, mysize, norm, test_weights, do_plots)
+        eval_models(paths, train_sets, myseeds, mybackbones, model_revs, test_sets, mysize, norm, test_weights, do_plots,
+                    cache_dir=tile_cache)
 
     if do_post:
         print("\n\n===== POST =====\n\n")
-        postprocess(paths, train_sets, myseeds, mybackbones, model_revs, test_sets, do_summary, do_boundary_plots, do_multi_plots, do_imagewise_metrics)
+        postprocess(paths, train_sets, myseeds, mybackbones, model_revs, test_sets, do_summary, do_boundary_plots, do_multi_plots, do_imagewise_metrics,
+                    do_threshold_sweep, n_workers=post_workers, fast_plots=fast_plots)
 
 
 def configure_paths(data_root_dir, train_sets, seeds, backbones, model_revs, test_sets):
     """
     Generate a paths data object holding the conventional paths for the project.
 
-    Nested dicts of paths[train_set][seed][backbone][model_rev][test_set] with things at various levels
+    Indexed as paths[train_set][seed][backbone][model_rev][test_set] with things at various levels
         [train_set]
             Stores directory paths germane to the different training datasets
             - tiles: the root tile directory for the dataset.  e.g. d:/solardnn/NY-Q/tiles
@@ -116,7 +148,8 @@ def configure_paths(data_root_dir, train_sets, seeds, backbones, model_revs, tes
             - train_log: Location of log file from training. e.g. d:/solardnn/NY-Q/models/NY-Q_resnet34_42_v1_trainlog.csv
             - result_root: Location of global results when using any model with these configurations. e.g. d:/solardnn/results/resnet34_42_v1
             - summary_file: Location of global results Excel summary when any model with these configurations. e.g. d:/solardnn/results/resnet34_42_v1/resnet34_42_v1_summary.xlsx
-            ** Note: result_root and summary_file don't depend on the train set at all, because they are computed across multiple train sets
+            - results_db: Location of the results database that every evaluation with these configurations appends to. e.g. d:/solardnn/results/resnet34_42_v1/resnet34_42_v1_results.sqlite
+            ** Note: result_root, summary_file and results_db don't depend on the train set at all, because they are computed across multiple train sets
         test_set:
             Stores info about the outputs when we test a model. Stored nested below the predictions root dir for the
             training set. The subdir name will always be /{train_set}_{backbone}_{seed}_v{model_rev}_predicting_{test_set}/
@@ -128,6 +161,7 @@ def configure_paths(data_root_dir, train_sets, seeds, backbones, model_revs, tes
                 e.g. d:/solardnn/NY-Q/predictions/NY-Q_resnet34_42_v1_predicting_CA-F/NY-Q_resnet34_42_v1_predicting_CA-F_data.csv
             - boundary_plot_root: Location of global boundary plot results when using this test set. e.g. d:/solardnn/results/resnet34_42_v1/CA-F_test/boundary_plot
             - multi_plot_root: Location of global multi-model plot results when using this test set. e.g. d:/solardnn/results/resnet34_42_v1/CA-F_test/multi_plot
+            - threshold_sweep_file: Location of global threshold sweep results for this test set. e.g. d:/solardnn/results/resnet34_42_v1/CA-F_test/resnet34_42_v1_CA-F_thresholds.xlsx
             ** Note: boundary_plot_root and multi_plot_root don't depend on the train set at all, because they are computed across multiple train sets
             ** Thus, they can be called for the test_set in both set slots. i.e. paths[test_set][seed][backbone][model_rev][test_set]['boundary_plot_root']
 
@@ -153,72 +187,12 @@ def configure_paths(data_root_dir, train_sets, seeds, backbones, model_revs, tes
 
     Returns
     -------
-    Deeply nested dictionary following conventions notated above.
+    notebooks.experiment_layout.ExperimentLayout, indexed following conventions notated above.
         paths[train_set][seed][backbone][model_rev][test_set]
+    Paths are computed when they are looked up, so the layout is cheap to build for large grids and to send to worker
+    processes. It can also list which artifacts of the grid already exist or are missing.
     """
-    paths = {}
-
-    for train_set in train_sets:
-        paths[train_set] = {}
-        siteroot = os.path.join(data_root_dir, train_set)
-        tileroot = os.path.join(data_root_dir, train_set, "tiles")
-        modeloutroot = os.path.join(siteroot, "models")
-        predictionroot = os.path.join(siteroot, "predictions")
-
-        if "CMB" in train_set:  # let the img_root be pulled from the file
-            img_root = None
-            mask_root = None
-        else:
-            img_root = os.path.join(tileroot, f"img")
-            mask_root = os.path.join(tileroot, f"mask")
-
-        paths[train_set]['tiles'] = tileroot
-        paths[train_set]['img_root'] = img_root
-        paths[train_set]['mask_root'] = mask_root
-        paths[train_set]['model_out_root'] = modeloutroot
-        paths[train_set]['prediction_root'] = predictionroot
-
-        for seed in seeds:
-            paths[train_set][seed] = {}
-
-            paths[train_set][seed]['test_im'] = os.path.join(tileroot, f"test_img_{seed}.txt")
-            paths[train_set][seed]['test_mask'] = os.path.join(tileroot, f"test_mask_{seed}.txt")
-            paths[train_set][seed]['train_im'] = os.path.join(tileroot, f"train_img_{seed}.txt")
-            paths[train_set][seed]['train_mask'] = os.path.join(tileroot, f"train_mask_{seed}.txt")
-            paths[train_set][seed]['valid_im'] = os.path.join(tileroot, f"valid_img_{seed}.txt")
-            paths[train_set][seed]['valid_mask'] = os.path.join(tileroot, f"valid_mask_{seed}.txt")
-
-            for backbone in backbones:
-                paths[train_set][seed][backbone] = {}
-                for model_rev in model_revs:
-                    paths[train_set][seed][backbone][model_rev] = {}
-                    paths[train_set][seed][backbone][model_rev]['best_weights'] = os.path.join(modeloutroot,
-                                                                                               f"{train_set}_{backbone}_{seed}_v{model_rev}_weights_best.h5")
-                    paths[train_set][seed][backbone][model_rev]['final_weights'] = os.path.join(modeloutroot,
-                                                                                                f"{train_set}_{backbone}_{seed}_v{model_rev}_weights_final.h5")
-                    paths[train_set][seed][backbone][model_rev]['train_log'] = os.path.join(modeloutroot,
-                                                                                            f"{train_set}_{backbone}_{seed}_v{model_rev}_trainlog.csv")
-
-                    global_result_root_dir = os.path.join(data_root_dir, fr"results\{backbone}_{seed}_{model_rev}")
-                    summary_file = os.path.join(global_result_root_dir, rf"{backbone}_{seed}_v{model_rev}_summary.xlsx")
-                    paths[train_set][seed][backbone][model_rev]['result_root'] = global_result_root_dir
-                    paths[train_set][seed][backbone][model_rev]['summary_file'] = summary_file
-
-                    for test_set in test_sets:
-                        paths[train_set][seed][backbone][model_rev][test_set] = {}
-                        test_result_subdir = os.path.join(predictionroot, f"{train_set}_{backbone}_{seed}_v{model_rev}_predicting_{test_set}")
-                        paths[train_set][seed][backbone][model_rev][test_set]['prediction_dir'] = os.path.join(test_result_subdir, "pred_masks")
-                        paths[train_set][seed][backbone][model_rev][test_set]['plot_dir'] = os.path.join(test_result_subdir, "plots")
-                        paths[train_set][seed][backbone][model_rev][test_set]['result_file'] = os.path.join(test_result_subdir, f"{train_set}_{backbone}_{seed}_v{model_rev}_predicting_{test_set}_data.csv")
-
-                        boundary_plot_dir = os.path.join(global_result_root_dir, rf"{test_set}_test", "boundary_plot")
-                        multi_plot_dir = os.path.join(global_result_root_dir, rf"{test_set}_test", "multi_plot")
-
-                        paths[train_set][seed][backbone][model_rev][test_set]['boundary_plot_root'] = boundary_plot_dir
-                        paths[train_set][seed][backbone][model_rev][test_set]['multi_plot_root'] = multi_plot_dir
-                        paths[train_set][seed][backbone][model_rev][test_set]['imagewise_metric_file'] = os.path.join(global_result_root_dir, rf"{test_set}_test", f"{backbone}_{seed}_v{model_rev}_{test_set}_imgmetrics.xlsx")
-
-    return paths
+    return ExperimentLayout(data_root_dir, train_sets, seeds, backbones, model_revs, test_sets)
 
 
 def build_datasets(paths, train_sets, seeds, n_set, test_train_valid, combo_sets=None):
@@ -291,7 +265,8 @@ def build_datasets(paths, train_sets, seeds, n_set, test_train_valid, combo_sets
                 test_train_valid_split(imdir, maskdir, tiledir, test_train_valid=test_train_valid, seed=seed, n_set=n_set)
 
 
-def train_models(paths, train_sets, seeds, backbones, model_revs, img_size, epochs, freeze_encoder, patience, batchnorm):
+def train_models(paths, train_sets, seeds, backbones, model_revs, img_size, epochs, freeze_encoder, patience, batchnorm,
+                 cache_dir=None):
     """
     Wrapper to help calling the training for multiple models at once
 
@@ -319,7 +294,11 @@ def train_models(paths, train_sets, seeds, backbones, model_revs, img_size, epoc
         Patience that should be used in early stopping. Set to 0 to run for full epochs.
     batchnorm: bool
         Should batch normalization be used?
+    cache_dir: str (default None)
+        Root directory of the tile cache. Set to None to disable caching.
     """
+    from model.train_model import train_unet
+
     for train_set in train_sets:
         for seed in seeds:
             for backbone in backbones:
@@ -339,12 +318,14 @@ def train_models(paths, train_sets, seeds, backbones, model_revs, img_size, epoc
 
                     train_unet(imdir, maskdir, tr_im_f, tr_m_f, v_im_f, v_m_f, log_file=log, best_weight_file=best_wgt,
                                end_weight_file=final_wgt, backbone=backbone, seed=seed, img_size=(img_size, img_size),
-                               epochs=epochs, freeze_encoder=freeze_encoder, patience=patience, batchnorm=batchnorm)
+                               epochs=epochs, freeze_encoder=freeze_encoder, patience=patience, batchnorm=batchnorm,
+                               cache_dir=cache_dir)
 
                     gc.collect()
 
 
-def eval_models(paths, train_sets, seeds, backbones, model_revs, test_sets, img_size, batchnorm, weight_type, gen_plots=False):
+def eval_models(paths, train_sets, seeds, backbones, model_revs, test_sets, img_size, batchnorm, weight_type, gen_plots=False,
+                cache_dir=None):
     """
     Wrapper to help perform the model evaluation for a large set of models
 
@@ -373,44 +354,199 @@ def eval_models(paths, train_sets, seeds, backbones, model_revs, test_sets, img_
         One of 'best' or 'final'. Which weights file should be read for the trained model.
     gen_plots: bool (default False)
         Should plots be generated?
+    cache_dir: str (default None)
+        Root directory of the tile cache. Each test set is decoded once and
+        reused for every model. Set to None to disable caching.
     """
+    from model.eval_model import eval_model_many
+
     for train_set in train_sets:
         for seed in seeds:
             for backbone in backbones:
                 for model_rev in model_revs:
-                    for test_set in test_sets:
-                        print("============")
-                        print(f"Testing: \nModel: {train_set}\nSeed: {seed}\nBackbone: {backbone}\nRev: v{model_rev}\nTest Set: {test_set}\n")
+                    print("============")
+                    print(f"Testing: \nModel: {train_set}\nSeed: {seed}\nBackbone: {backbone}\nRev: v{model_rev}\nTest Sets: {test_sets}\n")
+
+                    if weight_type == 'best':
+                        wgt_file = paths[train_set][seed][backbone][model_rev]['best_weights']
+                    elif weight_type == 'final':
+                        wgt_file = paths[train_set][seed][backbone][model_rev]['final_weights']
+                    else:
+                        print("Weights not found!")
+                        continue
+
+                    # The model is loaded once and evaluated on every test set
+                    eval_model_many(wgt_file, test_set_specs(paths, train_set, seed, backbone, model_rev, test_sets,
+                                                             gen_plots),
+                                    backbone=backbone, img_size=(img_size, img_size), batchnorm=batchnorm,
+                                    cache_dir=cache_dir)
 
-                        tst_im_f = paths[test_set][seed]['test_im']
-                        tst_m_f = paths[test_set][seed]['test_mask']
+                    gc.collect()
 
-                        imdir = paths[test_set]['img_root']
-                        maskdir = paths[test_set]['mask_root']
 
-                        if weight_type == 'best':
-                            wgt_file = paths[train_set][seed][backbone][model_rev]['best_weights']
-                        elif weight_type == 'final':
-                            wgt_file = paths[train_set][seed][backbone][model_rev]['final_weights']
-                        else:
-                            print("Weights not found!")
-                            continue
+def test_set_specs(paths, train_set, seed, backbone, model_rev, test_sets, gen_plots=False):
+    """
+    Collect the inputs and outputs of each test set for one model, in the format used by
+    model.eval_model.eval_model_many().
 
-                        pred_dir = paths[train_set][seed][backbone][model_rev][test_set]['prediction_dir']
-                        res_file = paths[train_set][seed][backbone][model_rev][test_set]['result_file']
+    Parameters
+    ----------
+    paths: nested dict
+        Output from configure_paths(). See docs for configure_paths() for a description.
+    train_set: str
+        The training set of the model
+    seed: int
+        The seed of the model
+    backbone: str
+        The backbone of the model
+    model_rev: str
+        The revision of the model
+    test_sets: list[str]
+        List of strings representing all the test data sets to consider.
+    gen_plots: bool (default False)
+        Should plots be generated?
 
-                        if gen_plots:
-                            plot_dir = paths[train_set][seed][backbone][model_rev][test_set]['plot_dir']
-                        else:
-                            plot_dir = None
+    Returns
+    -------
+    list[dict], one per test set
+    """
+    specs = []
+    for test_set in test_sets:
+        model_paths = paths[train_set][seed][backbone][model_rev][test_set]
+        specs.append(dict(test_img_dir=paths[test_set]['img_root'],
+                          test_mask_dir=paths[test_set]['mask_root'],
+                          test_img_file=paths[test_set][seed]['test_im'],
+                          test_mask_file=paths[test_set][seed]['test_mask'],
+                          result_file=model_paths['result_file'],
+                          pred_dir=model_paths['prediction_dir'],
+                          plot_dir=model_paths['plot_dir'] if gen_plots else None,
+                          results_db=paths[train_set][seed][backbone][model_rev]['results_db'],
+                          run_info=dict(train_set=train_set, test_set=test_set, backbone=backbone, seed=seed,
+                                        model_rev=str(model_rev))))
+    return specs
+
+
+def build_jobs(paths, train_sets, seeds, backbones, model_revs, test_sets, img_size, epochs, freeze_encoder, patience,
+               batchnorm, weight_type, gen_plots=False, do_train=True, do_test=True, do_post=True, gen_summary=True,
+               gen_boundary_plots=False, gen_multi_plots=False, gen_imagewise_metrics=False, gen_threshold_sweep=False,
+               cache_dir=None, skip_existing=False, post_workers=None,
+               fast_plots=False):
+    """
+    Turn the paths grid into a DAG of jobs for notebooks.job_scheduler.run_jobs(). There is one train job per model,
+    one eval job per model that covers all test sets and waits for that model's training, and one post job per
+    seed/backbone/revision that waits for all of its evaluations. Arguments are the same as for train_models(),
+    eval_models() and postprocess().
 
-                        eval_model(imdir, maskdir, tst_im_f, tst_m_f, wgt_file, res_file, pred_dir, plot_dir,
-                                   backbone=backbone, img_size=(img_size, img_size), batchnorm=batchnorm)
+    Parameters
+    ----------
+    paths: nested dict
+        Output from configure_paths(). See docs for configure_paths() for a description.
+    train_sets: list[str]
+        List of strings representing all the training sets to consider. e.g. ['CA-F','NY-Q','CMB-6']
+    seeds: list[int]
+        List of all seeds to consider. e.g. [42]
+    backbones: list[str]
+        List of all backbones to run. e.g. ['resnet34','resnet50']
+    model_revs: list[str]
+        List of revision flags to add to the models.
+    test_sets: list[str]
+        List of strings representing all the test data sets to consider. These should never include combos.
+    img_size: int
+        Size images should be resized to. Images will be resized to (img_size x img_size)
+    epochs: int
+        Max number of epochs
+    freeze_encoder: bool
+        Should the encoder be frozen?
+    patience: int
+        Patience that should be used in early stopping. Set to 0 to run for full epochs.
+    batchnorm: bool
+        Should batch normalization be used?
+    weight_type: str
+        One of 'best' or 'final'. Which weights file should be read for the trained model.
+    gen_plots: bool (default False)
+        Should plots be generated during evaluation?
+    do_train: bool (default True)
+        Include the train jobs?
+    do_test: bool (default True)
+        Include the eval jobs?
+    do_post: bool (default True)
+        Include the post jobs?
+    gen_summary, gen_boundary_plots, gen_multi_plots, gen_imagewise_metrics, gen_threshold_sweep: bool
+        Passed to postprocess()
+    cache_dir: str (default None)
+        Root directory of the tile cache. Set to None to disable caching.
+    skip_existing: bool (default False)
+        Only plan the missing work? Train jobs are left out for models whose best weights exist, and eval jobs for
+        models that have a result file for every test set. Within an eval job, test sets without a result file are
+        evaluated again even if an interrupted run left predictions behind.
+    post_workers: int or None (default None)
+        Passed to postprocess() as n_workers
+    fast_plots: bool (default False)
+        Passed to postprocess()
 
-                        gc.collect()
+    Returns
+    -------
+    list of jobs created by notebooks.job_scheduler.make_job()
+    """
+    from model.train_model import train_unet
+    from model.eval_model import eval_model_many
 
+    if weight_type not in ('best', 'final'):
+        raise ValueError("weight_type must be 'best' or 'final'.")
+    weight_key = 'best_weights' if weight_type == 'best' else 'final_weights'
 
-def postprocess(paths, train_sets, seeds, backbones, model_revs, test_sets, gen_summary=True, gen_boundary_plots=False, gen_multi_plots=False, gen_imagewise_metrics=False):
+    jobs = []
+    for seed in seeds:
+        for backbone in backbones:
+            for model_rev in model_revs:
+                eval_names = []
+                for train_set in train_sets:
+                    model_name = f"{train_set}_{backbone}_{seed}_v{model_rev}"
+                    model_paths = paths[train_set][seed][backbone][model_rev]
+                    train_name = "train/" + model_name
+
+                    trained = skip_existing and os.path.exists(model_paths['best_weights'])
+                    if do_train and not trained:
+                        jobs.append(make_job(train_name, train_unet, dict(
+                            train_img_dir=paths[train_set]['img_root'],
+                            train_mask_dir=paths[train_set]['mask_root'],
+                            train_img_file=paths[train_set][seed]['train_im'],
+                            train_mask_file=paths[train_set][seed]['train_mask'],
+                            valid_img_file=paths[train_set][seed]['valid_im'],
+                            valid_mask_file=paths[train_set][seed]['valid_mask'],
+                            log_file=model_paths['train_log'],
+                            best_weight_file=model_paths['best_weights'],
+                            end_weight_file=model_paths['final_weights'],
+                            backbone=backbone, seed=seed, img_size=(img_size, img_size), epochs=epochs,
+                            freeze_encoder=freeze_encoder, patience=patience, batchnorm=batchnorm,
+                            cache_dir=cache_dir)))
+
+                    if not do_test:
+                        continue
+                    if skip_existing and not paths.missing('result_file', train_set=train_set, seed=seed,
+                                                           backbone=backbone, model_rev=model_rev):
+                        continue
+                    eval_name = "eval/" + model_name
+                    jobs.append(make_job(eval_name, eval_model_many, dict(
+                        weight_file=model_paths[weight_key],
+                        test_sets=test_set_specs(paths, train_set, seed, backbone, model_rev, test_sets, gen_plots),
+                        backbone=backbone, img_size=(img_size, img_size), batchnorm=batchnorm,
+                        cache_dir=cache_dir), deps=[train_name] if do_train and not trained else []))
+                    eval_names.append(eval_name)
+
+                if do_post:
+                    jobs.append(make_job(f"post/{backbone}_{seed}_v{model_rev}", postprocess, dict(
+                        paths=paths, train_sets=train_sets, seeds=[seed], backbones=[backbone],
+                        model_revs=[model_rev], test_sets=test_sets, gen_summary=gen_summary,
+                        gen_boundary_plots=gen_boundary_plots, gen_multi_plots=gen_multi_plots,
+                        gen_imagewise_metrics=gen_imagewise_metrics, gen_threshold_sweep=gen_threshold_sweep,
+                        n_workers=post_workers, fast_plots=fast_plots), deps=eval_names))
+
+    return jobs
+
+
+def postprocess(paths, train_sets, seeds, backbones, model_revs, test_sets, gen_summary=True, gen_boundary_plots=False, gen_multi_plots=False, gen_imagewise_metrics=False,
+                gen_threshold_sweep=False, n_workers=None, fast_plots=False):
     """
         Wrapper to help perform the postprocessing for a large set of models
 
@@ -439,6 +575,13 @@ def postprocess(paths, train_sets, seeds, backbones, model_revs, test_sets, gen_
             Should global multi_plot representations be generated?
         gen_imagewise_metrics: bool (default False)
             Should imagewise metrics be calculated?
+        gen_threshold_sweep: bool (default False)
+            Should the metrics be swept over all thresholds to find the best threshold of each model?
+        n_workers: int or None (default None)
+            Number of worker processes for the plots, imagewise metrics and threshold sweep. If None or 1, images
+            are processed in the current process.
+        fast_plots: bool (default False)
+            Compose the boundary and multi plots directly as image mosaics rather than rendering matplotlib figures?
         """
     for seed in seeds:
         for backbone in backbones:
@@ -446,17 +589,19 @@ def postprocess(paths, train_sets, seeds, backbones, model_revs, test_sets, gen_
                 if gen_summary:
                     # These happen at a global level assuming multiple models all trained the same way, but spanning
                     # all train sets against all test sets
-
-                    # Build the nested list of files that will be summarized
-                    res_files = OrderedDict()
                     summary_file = paths[train_sets[0]][seed][backbone][model_rev]['summary_file']
+                    results_db = paths[train_sets[0]][seed][backbone][model_rev]['results_db']
+                    # Runs evaluated before the results database existed only have result files, which fill in
+                    # the cells the database has nothing for
+                    res_files = OrderedDict()
                     for test_set in test_sets:
                         res_files[test_set] = OrderedDict()
                         for train_set in train_sets:
                             res_files[test_set][train_set] = paths[train_set][seed][backbone][model_rev][test_set][
                                 'result_file']
-                    # Do the summary
-                    generate_run_summary(res_files, summary_file)
+                    generate_results_summary(results_db, summary_file, row_names=train_sets, col_names=test_sets,
+                                             result_files=res_files, backbone=backbone, seed=seed,
+                                             model_rev=str(model_rev), threshold=None)
 
                 # The summary plots occur for an entire test set but encompass multiple training sets
                 for test_set in test_sets:
@@ -474,20 +619,28 @@ def postprocess(paths, train_sets, seeds, backbones, model_revs, test_sets, gen_
                         bnddir = paths[test_set][seed][backbone][model_rev][test_set]['boundary_plot_root']
 
                         print(f"\n=={test_set} BORDER==")
-                        model_boundary_plot(test_img_path, test_mask_path, pred_dirs, bnddir, model_names=train_sets)
+                        model_boundary_plot(test_img_path, test_mask_path, pred_dirs, bnddir, model_names=train_sets,
+                                            n_workers=n_workers, fast=fast_plots)
 
                     if gen_multi_plots:
                         # All train_sets have the same directories paths, so just use test_set as the train_set
                         multidir = paths[test_set][seed][backbone][model_rev][test_set]['multi_plot_root']
 
                         print(f"\n=={test_set} COMBO==")
-                        multimodel_plot(test_img_path, test_mask_path, pred_dirs, multidir, model_names=train_sets)
+                        multimodel_plot(test_img_path, test_mask_path, pred_dirs, multidir, model_names=train_sets,
+                                        n_workers=n_workers, fast=fast_plots)
 
                     # Run the metrics
                     if gen_imagewise_metrics:
                         print(f"\n=={test_set} Imagewise==")
                         imgmetricfile = paths[test_set][seed][backbone][model_rev][test_set]['imagewise_metric_file']
-                        aggregate_imagewise_metrics(test_mask_path, pred_dirs, imgmetricfile, model_names=train_sets)
+                        aggregate_imagewise_metrics(test_mask_path, pred_dirs, imgmetricfile, model_names=train_sets,
+                                                    n_workers=n_workers)
+
+                    if gen_threshold_sweep:
+                        print(f"\n=={test_set} Threshold Sweep==")
+                        sweepfile = paths[test_set][seed][backbone][model_rev][test_set]['threshold_sweep_file']
+                        threshold_sweep(test_mask_path, pred_dirs, sweepfile, model_names=train_sets, n_workers=n_workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,248 @@
+import os
+import glob
+import itertools
+
+
+LEVELS = ["train_set", "seed", "backbone", "model_rev", "test_set"]
+
+# Artifact name to the level it lives at. The paths themselves are built by ExperimentLayout.path().
+ARTIFACTS = {
+    "tiles": "train_set",
+    "img_root": "train_set",
+    "mask_root": "train_set",
+    "model_out_root": "train_set",
+    "prediction_root": "train_set",
+    "test_im": "seed",
+    "test_mask": "seed",
+    "train_im": "seed",
+    "train_mask": "seed",
+    "valid_im": "seed",
+    "valid_mask": "seed",
+    "best_weights": "model_rev",
+    "final_weights": "model_rev",
+    "train_log": "model_rev",
+    "result_root": "model_rev",
+    "summary_file": "model_rev",
+    "results_db": "model_rev",
+    "prediction_dir": "test_set",
+    "plot_dir": "test_set",
+    "result_file": "test_set",
+    "boundary_plot_root": "test_set",
+    "multi_plot_root": "test_set",
+    "imagewise_metric_file": "test_set",
+    "threshold_sweep_file": "test_set",
+}
+
+
+class ExperimentLayout:
+    """
+    The conventional paths of an experiment grid, computed on demand. Holds only the root directory and the lists that
+    define the grid, so it is cheap to build and to pickle to worker processes.
+
+    Paths are looked up either with path(), e.g. layout.path('result_file', 'NY-Q', 42, 'resnet34', '1', 'CA-F'), or
+    by indexing like the nested dicts configure_paths() used to return, e.g.
+    layout['NY-Q'][42]['resnet34']['1']['CA-F']['result_file']. See configure_paths() for the meaning of each artifact.
+    """
+
+    def __init__(self, data_root_dir, train_sets, seeds, backbones, model_revs, test_sets):
+        """
+        Parameters
+        ----------
+        data_root_dir: str
+            Root directory for all the data. Sites should be subdirs here.
+        train_sets: list[str]
+            All the training sets to consider. e.g. ['CA-F','NY-Q','CMB-6']
+        seeds: list[int]
+            All seeds to consider. e.g. [42]
+        backbones: list[str]
+            All backbones to run. e.g. ['resnet34','resnet50']
+        model_revs: list[str]
+            Revision flags of the models. e.g. ['1']
+        test_sets: list[str]
+            All the test data sets to consider. These should never include combos.
+        """
+        self.data_root_dir = data_root_dir
+        self.train_sets = list(train_sets)
+        self.seeds = list(seeds)
+        self.backbones = list(backbones)
+        self.model_revs = list(model_revs)
+        self.test_sets = list(test_sets)
+
+    def __getitem__(self, key):
+        return _LayoutView(self, ())[key]
+
+    def __repr__(self):
+        return (f"ExperimentLayout({self.data_root_dir!r}, {self.train_sets}, {self.seeds}, {self.backbones}, "
+                f"{self.model_revs}, {self.test_sets})")
+
+    def values(self, level):
+        """
+        The values of one level of the grid. Sites at the train_set level include the test sets, since their tiles
+        and dataset files are looked up the same way.
+        """
+        if level == "train_set":
+            return self.train_sets + [s for s in self.test_sets if s not in self.train_sets]
+        return {"seed": self.seeds, "backbone": self.backbones, "model_rev": self.model_revs,
+                "test_set": self.test_sets}[level]
+
+    def path(self, name, train_set=None, seed=None, backbone=None, model_rev=None, test_set=None):
+        """
+        Compute the path of an artifact.
+
+        Parameters
+        ----------
+        name: str
+            Name of the artifact, one of ARTIFACTS
+        train_set, seed, backbone, model_rev, test_set:
+            Coordinates of the artifact. Only those down to the artifact's level are used.
+
+        Returns
+        -------
+        str, or None for the img_root and mask_root of combo sets, which are read from the dataset files
+        """
+        if name not in ARTIFACTS:
+            raise KeyError(f"Unknown artifact {name}.")
+
+        site_root = os.path.join(self.data_root_dir, train_set)
+        tile_root = os.path.join(site_root, "tiles")
+        model_root = os.path.join(site_root, "models")
+        prediction_root = os.path.join(site_root, "predictions")
+
+        if name == "tiles":
+            return tile_root
+        if name in ("img_root", "mask_root"):
+            if "CMB" in train_set:  # let the img_root be pulled from the file
+                return None
+            return os.path.join(tile_root, "img" if name == "img_root" else "mask")
+        if name == "model_out_root":
+            return model_root
+        if name == "prediction_root":
+            return prediction_root
+
+        if ARTIFACTS[name] == "seed":
+            kind, part = name.split("_")
+            part = "img" if part == "im" else part
+            return os.path.join(tile_root, f"{kind}_{part}_{seed}.txt")
+
+        model_name = f"{train_set}_{backbone}_{seed}_v{model_rev}"
+        result_root = os.path.join(self.data_root_dir, "results", f"{backbone}_{seed}_{model_rev}")
+        if name == "best_weights":
+            return os.path.join(model_root, f"{model_name}_weights_best.h5")
+        if name == "final_weights":
+            return os.path.join(model_root, f"{model_name}_weights_final.h5")
+        if name == "train_log":
+            return os.path.join(model_root, f"{model_name}_trainlog.csv")
+        if name == "result_root":
+            return result_root
+        if name == "summary_file":
+            return os.path.join(result_root, f"{backbone}_{seed}_v{model_rev}_summary.xlsx")
+        if name == "results_db":
+            return os.path.join(result_root, f"{backbone}_{seed}_v{model_rev}_results.sqlite")
+
+        test_result_subdir = os.path.join(prediction_root, f"{model_name}_predicting_{test_set}")
+        test_root = os.path.join(result_root, f"{test_set}_test")
+        if name == "prediction_dir":
+            return os.path.join(test_result_subdir, "pred_masks")
+        if name == "plot_dir":
+            return os.path.join(test_result_subdir, "plots")
+        if name == "result_file":
+            return os.path.join(test_result_subdir, f"{model_name}_predicting_{test_set}_data.csv")
+        if name == "boundary_plot_root":
+            return os.path.join(test_root, "boundary_plot")
+        if name == "multi_plot_root":
+            return os.path.join(test_root, "multi_plot")
+        if name == "imagewise_metric_file":
+            return os.path.join(test_root, f"{backbone}_{seed}_v{model_rev}_{test_set}_imgmetrics.xlsx")
+        if name == "threshold_sweep_file":
+            return os.path.join(test_root, f"{backbone}_{seed}_v{model_rev}_{test_set}_thresholds.xlsx")
+
+    def artifacts(self, name, **coords):
+        """
+        Enumerate an artifact over the grid.
+
+        Parameters
+        ----------
+        name: str
+            Name of the artifact, one of ARTIFACTS
+        coords:
+            Fix some of the coordinates, e.g. seed=42. The others run over the whole grid.
+
+        Returns
+        -------
+        list of (coords dict, path), skipping artifacts that have no path
+        """
+        levels = LEVELS[:LEVELS.index(ARTIFACTS[name]) + 1]
+        unknown = set(coords) - set(levels)
+        if unknown:
+            raise ValueError(f"{name} does not depend on {sorted(unknown)}.")
+        grid = [[coords[level]] if level in coords else self.values(level) for level in levels]
+
+        found = []
+        for values in itertools.product(*grid):
+            point = dict(zip(levels, values))
+            fn = self.path(name, **point)
+            if fn is not None:
+                found.append((point, fn))
+        return found
+
+    def existing(self, name, **coords):
+        """
+        The artifacts of the grid that already exist. Arguments are the same as for artifacts().
+        """
+        return [(point, fn) for point, fn in self.artifacts(name, **coords) if os.path.exists(fn)]
+
+    def missing(self, name, **coords):
+        """
+        The artifacts of the grid that don't exist yet. Arguments are the same as for artifacts().
+        """
+        return [(point, fn) for point, fn in self.artifacts(name, **coords) if not os.path.exists(fn)]
+
+    def glob(self, name, **coords):
+        """
+        Find the artifacts that exist on disk, including those outside the grid, e.g. of seeds that aren't listed.
+        Coordinates that aren't given are matched with a wildcard.
+
+        Parameters
+        ----------
+        name: str
+            Name of the artifact, one of ARTIFACTS
+        coords:
+            Fix some of the coordinates, e.g. backbone='resnet34'
+
+        Returns
+        -------
+        list[str] of the full paths, sorted
+        """
+        levels = LEVELS[:LEVELS.index(ARTIFACTS[name]) + 1]
+        pattern = self.path(name, **{level: coords.get(level, "*") for level in levels})
+        if pattern is None:
+            return []
+        return sorted(glob.glob(pattern))
+
+
+class _LayoutView:
+    """
+    One partially indexed point of an ExperimentLayout. Indexing with the next coordinate narrows the view, and
+    indexing with an artifact name of this level returns its path.
+    """
+
+    def __init__(self, layout, coords):
+        self.layout = layout
+        self.coords = coords
+
+    def __getitem__(self, key):
+        depth = len(self.coords)
+        if depth and ARTIFACTS.get(key) == LEVELS[depth - 1]:
+            return self.layout.path(key, **dict(zip(LEVELS, self.coords)))
+        if depth < len(LEVELS) and key in self.layout.values(LEVELS[depth]):
+            return _LayoutView(self.layout, self.coords + (key,))
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return f"<{self.layout!r}{''.join(f'[{c!r}]' for c in self.coords)}>"
@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import traceback
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS",
+                   "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS",
+                   "TF_NUM_INTEROP_THREADS"]
+
+
+def make_job(name, func, kwargs=None, deps=()):
+    """
+    Define a single job for run_jobs().
+
+    Parameters
+    ----------
+    name: str
+        Unique name of the job. Used as the key in the state file, so it
+        should be stable between runs.
+    func: callable
+        Function to run. Must be defined at module level so that it can be
+        sent to a worker process.
+    kwargs: dict (default None)
+        Keyword arguments for func. Must be picklable.
+    deps: iterable[str] (default ())
+        Names of jobs that must finish successfully before this one starts.
+
+    Returns
+    -------
+    dict describing the job
+    """
+    return {"name": name, "func": func, "kwargs": kwargs or {},
+            "deps": list(deps)}
+
+
+def read_job_state(state_file):
+    """
+    Read the job state file written by run_jobs().
+
+    Parameters
+    ----------
+    state_file: str
+        Full path of the state file
+
+    Returns
+    -------
+    dict of job name to {"status": str, "seconds": float, "error": str}.
+    Empty if the file doesn't exist.
+    """
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, "r") as f:
+        return json.load(f)
+
+
+def write_job_state(state_file, state):
+    """
+    Write the job state file. It is written to a temporary file and renamed
+    into place, so an interrupted write never leaves a corrupt state file.
+
+    Parameters
+    ----------
+    state_file: str
+        Full path of the state file
+    state: dict
+        job states, as returned by read_job_state()
+    """
+    state_dir = os.path.dirname(os.path.abspath(state_file))
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_file, state_file)
+
+
+def _run_job(func, kwargs):
+    """
+    Worker side of run_jobs(). Returns the run time, or raises a
+    RuntimeError carrying the formatted traceback of the failure.
+    """
+    start = time.time()
+    try:
+        func(**kwargs)
+    except Exception:
+        raise RuntimeError(traceback.format_exc())
+    return time.time() - start
+
+
+def run_jobs(jobs, state_file, n_workers=1, threads_per_job=None,
+             retry_failed=True, verbose=True):
+    """
+    Run a DAG of jobs on a pool of worker processes. Each job runs in a fresh
+    spawned process that exits when the job finishes, so memory held by
+    TensorFlow or other libraries is released between jobs. If that process
+    dies (e.g. killed when out of memory), the job is marked failed. A job
+    starts once all of its dependencies are done. The status of every job is
+    saved to state_file as it changes, and jobs already marked done are
+    skipped, so an interrupted run resumes where it stopped. A done job is
+    run again if its dependencies changed or if any job it depends on,
+    directly or indirectly, runs again.
+
+    Parameters
+    ----------
+    jobs: list[dict]
+        Jobs created by make_job()
+    state_file: str
+        Full path of the JSON file that holds the job states
+    n_workers: int (default 1)
+        Number of jobs to run at once. Jobs sharing a single GPU may need
+        this to stay at 1.
+    threads_per_job: int (default None)
+        Limit on the CPU threads used by each job, applied through the
+        OpenMP, BLAS and TensorFlow thread environment variables. If None,
+        the libraries choose.
+    retry_failed: bool (default True)
+        Rerun jobs that failed on a previous run? If False they are left
+        failed along with everything that depends on them.
+    verbose: bool (default True)
+        Print status?
+
+    Returns
+    -------
+    dict of job states, as returned by read_job_state()
+    """
+    by_name = {job["name"]: job for job in jobs}
+    if len(by_name) != len(jobs):
+        raise ValueError("Job names must be unique.")
+    dependents = {name: [] for name in by_name}
+    for job in jobs:
+        for dep in job["deps"]:
+            if dep not in by_name:
+                raise ValueError(f"Job {job['name']} depends on unknown job "
+                                 f"{dep}.")
+            dependents[dep].append(job["name"])
+
+    state = read_job_state(state_file)
+    queued = set()
+    for job in jobs:
+        entry = state.get(job["name"], {})
+        status = entry.get("status")
+        # States written before deps were recorded are taken as unchanged
+        same_deps = entry.get("deps", sorted(job["deps"])) == sorted(job["deps"])
+        if (status == "done" and same_deps) or \
+                (status == "failed" and not retry_failed):
+            continue
+        queued.add(job["name"])
+
+    # Everything downstream of a queued job has to run again too
+    stack = list(queued)
+    while stack:
+        for name in dependents[stack.pop()]:
+            if name not in queued:
+                queued.add(name)
+                stack.append(name)
+
+    pending = [job["name"] for job in jobs if job["name"] in queued]
+    for name in pending:
+        # Forget stale states (done, blocked, running when interrupted, etc.)
+        state.pop(name, None)
+
+    def is_done(name):
+        return state.get(name, {}).get("status") == "done"
+
+    def is_failed(name):
+        return state.get(name, {}).get("status") in ("failed", "blocked")
+
+    if verbose:
+        print(f"{len(jobs) - len(pending)} of {len(jobs)} jobs already "
+              f"complete.")
+
+    # Spawned workers inherit the environment, so set the thread limits
+    # before any worker starts and restore them afterwards.
+    old_env = {key: os.environ.get(key) for key in THREAD_ENV_VARS}
+    if threads_per_job is not None:
+        for key in THREAD_ENV_VARS:
+            os.environ[key] = str(threads_per_job)
+
+    ctx = mp.get_context("spawn")
+    running = {}  # future -> (job name, executor)
+    try:
+        while pending or running:
+            # Block everything downstream of a failure. A job can be listed
+            # before its dependency, so repeat until nothing changes.
+            blocking = True
+            while blocking:
+                blocking = False
+                for name in list(pending):
+                    if any(is_failed(dep) for dep in by_name[name]["deps"]):
+                        pending.remove(name)
+                        state[name] = {"status": "blocked",
+                                       "error": "A dependency failed."}
+                        write_job_state(state_file, state)
+                        blocking = True
+                        if verbose:
+                            print(f"Blocked: {name}")
+
+            # Start every job whose dependencies are done, up to n_workers
+            for name in list(pending):
+                deps = by_name[name]["deps"]
+                if all(is_done(dep) for dep in deps) and \
+                        len(running) < n_workers:
+                    pending.remove(name)
+                    state[name] = {"status": "running"}
+                    write_job_state(state_file, state)
+                    if verbose:
+                        print(f"Starting: {name}")
+                    job = by_name[name]
+                    # One single use worker per job, so the process exits
+                    # when the job is done
+                    executor = ProcessPoolExecutor(max_workers=1,
+                                                   mp_context=ctx)
+                    future = executor.submit(_run_job, job["func"],
+                                             job["kwargs"])
+                    running[future] = (name, executor)
+
+            if not running:
+                # Nothing can start, the remaining jobs form a cycle
+                for name in pending:
+                    state[name] = {"status": "blocked",
+                                   "error": "Circular dependency."}
+                write_job_state(state_file, state)
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, executor = running.pop(future)
+                executor.shutdown()
+                try:
+                    seconds = future.result()
+                except BrokenProcessPool:
+                    error = ("The worker process died unexpectedly, e.g. "
+                             "killed when out of memory.")
+                except Exception as e:
+                    error = str(e)
+                else:
+                    error = None
+
+                if error is None:
+                    state[name] = {"status": "done", "seconds": seconds,
+                                   "deps": sorted(by_name[name]["deps"])}
+                    if verbose:
+                        print(f"Finished: {name} ({seconds:.0f} s)")
+                else:
+                    state[name] = {"status": "failed", "error": error}
+                    if verbose:
+                        print(f"Failed: {name}\n{error}")
+                write_job_state(state_file, state)
+    finally:
+        for name, executor in running.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        for key, val in old_env.items():
+            if val is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = val
+
+    if verbose:
+        counts = {}
+        for job in jobs:
+            status = state.get(job["name"], {}).get("status", "pending")
+            counts[status] = counts.get(status, 0) + 1
+        print("Job summary: " + ", ".join(f"{n} {s}"
+                                          for s, n in counts.items()))
+
+    return state
@@ -1,15 +1,18 @@
 from model.dataset_manipulation import split_test_train
-from model.train_model import train_unet
-from model.eval_model import eval_model
 import os
 import gc
 
 import numpy as np
 import random
-from tensorflow import random as tfr
 
 
 def run_A():
+    # TensorFlow is imported here rather than at module level, since spawned
+    # worker processes import this script again
+    from model.train_model import train_unet
+    from model.eval_model import eval_model
+    from tensorflow import random as tfr
+
     ### Train #####
     my_test_ratio = 0.2
     myseed = 42
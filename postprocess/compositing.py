@@ -0,0 +1,203 @@
+import time
+
+import numpy as np
+from PIL import Image, ImageColor
+
+
+def mask_array(mask, thresh=0):
+    """
+    Convert a mask to a single channel boolean array. A pixel is on if any of
+    its color bands is above thresh, which matches binarizing every band of
+    the image.
+
+    Parameters
+    ----------
+    mask: PIL.Image or np.array
+        The mask. Palette and multi band images are converted to RGB first.
+        Arrays of shape (h, w) or (h, w, bands) are used as they are.
+    thresh: int (default 0)
+        Pixels above this value are on
+
+    Returns
+    -------
+    np.array of bool, shape (h, w)
+    """
+    if isinstance(mask, Image.Image):
+        if mask.mode not in ("L", "1"):
+            mask = mask.convert("RGB")
+        mask = np.asarray(mask)
+    if mask.ndim == 3:
+        mask = np.max(mask[:, :, :3], axis=-1)
+    if mask.dtype == np.bool_:
+        return mask
+    if mask.dtype == np.uint8:
+        # Threshold through a lookup table rather than a comparison per pixel
+        lut = np.zeros(256, dtype=np.bool_)
+        lut[int(thresh) + 1:] = True
+        return lut[mask]
+    return mask > thresh
+
+
+def _rank_filter(mask, size, func):
+    """
+    Separable size x size max or min filter with the edges replicated, like
+    PIL's MaxFilter and MinFilter. func is np.maximum or np.minimum.
+    """
+    r = size // 2
+    h, w = mask.shape
+    padded = np.pad(mask, r, mode="edge")
+
+    rows = padded[:, 0:w].copy()
+    for k in range(1, size):
+        func(rows, padded[:, k:k + w], out=rows)
+
+    out = rows[0:h].copy()
+    for k in range(1, size):
+        func(out, rows[k:k + h], out=out)
+    return out
+
+
+def mask_boundary(mask, size=3):
+    """
+    Find the boundary of a binary mask as the pixels where the size x size
+    dilation and erosion of the mask differ. Same result as the difference
+    of PIL's MaxFilter and MinFilter.
+
+    Parameters
+    ----------
+    mask: np.array of bool
+        The mask, shape (h, w), e.g. from mask_array()
+    size: int (default 3)
+        Odd width of the filter. Larger values give thicker boundaries.
+
+    Returns
+    -------
+    np.array of bool, shape (h, w)
+    """
+    dil = _rank_filter(mask, size, np.maximum)
+    ero = _rank_filter(mask, size, np.minimum)
+    return dil != ero
+
+
+def color_lut(colors, alpha=255):
+    """
+    Build the RGBA lookup table for composite_layers(). Entry 0 is the
+    transparent background, entry i is the color of layer i-1.
+
+    Parameters
+    ----------
+    colors: list
+        Color of each layer, as a color string (e.g. "#ff0000") or RGB tuple
+    alpha: int (default 255)
+        Opacity of the colored pixels
+
+    Returns
+    -------
+    np.array of uint8, shape (len(colors) + 1, 4)
+    """
+    if len(colors) > 255:
+        raise ValueError("At most 255 layers can be composited.")
+    lut = np.zeros((len(colors) + 1, 4), dtype=np.uint8)
+    for i, color in enumerate(colors):
+        if isinstance(color, str):
+            color = ImageColor.getrgb(color)
+        lut[i + 1, :3] = color[:3]
+        lut[i + 1, 3] = alpha
+    return lut
+
+
+def composite_layers(masks, colors, out=None, lut=None):
+    """
+    Paint several binary masks into one RGBA image, each in its own color on
+    a transparent background. Later masks are drawn on top of earlier ones.
+    The masks are first merged into a single layer index image, which is
+    mapped to colors with one lookup table pass.
+
+    Parameters
+    ----------
+    masks: list[np.array]
+        Boolean masks, all of shape (h, w)
+    colors: list
+        Color of each mask, see color_lut()
+    out: np.array (default None)
+        Preallocated uint8 buffer of shape (h, w, 4) to write into, so it can
+        be reused between tiles. If None, a new one is allocated.
+    lut: np.array (default None)
+        Precomputed color_lut(colors). If None, it is built from colors.
+
+    Returns
+    -------
+    np.array of uint8, shape (h, w, 4)
+    """
+    if lut is None:
+        lut = color_lut(colors)
+    shape = masks[0].shape
+    layers = np.zeros(shape, dtype=np.uint8)
+    for i, mask in enumerate(masks):
+        layers[mask] = i + 1
+    if out is None:
+        out = np.empty(shape + (4,), dtype=np.uint8)
+    np.take(lut, layers, axis=0, out=out)
+    return out
+
+
+def benchmark_compositing(mask_files, colors, size=3, thresh=50, repeats=3):
+    """
+    Time building the boundary overlay of a tile from several masks with
+    mask_array(), mask_boundary() and composite_layers() against the PIL
+    based helpers in images_to_plots, and check that the overlays match.
+
+    Parameters
+    ----------
+    mask_files: list[str]
+        Mask or prediction images of one tile, one per model. All must be the
+        same size.
+    colors: list
+        Color of each model's boundary
+    size: int (default 3)
+        Boundary filter width
+    thresh: int (default 50)
+        Binarization threshold
+    repeats: int (default 3)
+        Number of times to build the overlay. Best time is reported.
+
+    Returns
+    -------
+    t_new, t_old: (float, float)
+        Best time in seconds for the new kernels and for the PIL helpers
+    """
+    from postprocess.images_to_plots import (binarize, bkg_to_alpha,
+                                             mask_colorize, mask_to_boundary)
+
+    images = []
+    for fn in mask_files:
+        with Image.open(fn) as im:
+            images.append(im.copy())
+
+    lut = color_lut(colors)
+    buffer = np.empty(images[0].size[::-1] + (4,), dtype=np.uint8)
+
+    t_new = t_old = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        brds = [mask_boundary(mask_array(im, thresh), size) for im in images]
+        new = composite_layers(brds, colors, out=buffer, lut=lut)
+        t1 = time.perf_counter()
+        old = np.zeros_like(buffer)
+        for im, color in zip(images, colors):
+            brd = np.asarray(bkg_to_alpha(mask_colorize(
+                mask_to_boundary(binarize(im, thresh), size=size),
+                color=color)))
+            drawn = brd[:, :, 3] > 0
+            old[drawn] = brd[drawn]
+        t2 = time.perf_counter()
+        t_new = min(t_new, t1 - t0)
+        t_old = min(t_old, t2 - t1)
+
+        if not np.array_equal(new, old):
+            raise AssertionError("Boundary overlays do not match.")
+
+    print(f"compositing kernels: {t_new:.4f} s, "
+          f"PIL helpers: {t_old:.4f} s "
+          f"({t_old / max(t_new, 1e-9):.1f}x)")
+    return t_new, t_old
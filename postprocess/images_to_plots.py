@@ -1,149 +1,381 @@
-import glob
 import os
+import importlib.util
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
-import matplotlib.pyplot as plt
-from matplotlib.lines import Line2D
 import numpy as np
-from PIL import Image, ImageFilter, ImageColor
+from PIL import Image, ImageFilter, ImageColor, ImageDraw
 
+from postprocess.compositing import mask_array, mask_boundary, color_lut, composite_layers
 from utils.fileio import verify_dir
+from utils.prediction_store import list_predictions, open_prediction_image
+
+
+def model_boundary_plot(im_dir, truth_dir, pred_dirs, out_dir, dpi=300, verbose=True, model_names=["CA-F", "CA-S", "FR-I", "FR-G", "DE-G", "NY-Q", "COMB"], colors=["#0000ff", "#000088", "#00ff00", "#008800", "#ff00ff", "#ff8800", "#aaaa00"], overwrite=False,
+                        n_workers=None, fast=False):
+    """
+    Plot the image, the truth and the boundaries of the truth and every model's prediction for each tile.
+
+    Parameters
+    ----------
+    im_dir: str
+        Directory of the images
+    truth_dir: str
+        Directory of the ground truth masks
+    pred_dirs: list[str]
+        Prediction directory of each model. The tiles are taken from the first one.
+    out_dir: str
+        Output directory for the plots
+    dpi: int (default 300)
+        Resolution of the figures. Ignored if fast.
+    verbose: bool (default True)
+        Print progress?
+    model_names: list[str]
+        Name of each model, for the legend
+    colors: list[str]
+        Boundary color of each model
+    overwrite: bool (default False)
+        Should existing plots be overwritten?
+    n_workers: int or None (default None)
+        Number of worker processes to render the tiles with. If None or 1, all tiles are rendered in the current
+        process.
+    fast: bool (default False)
+        If True, compose the panels directly as an image mosaic at the tile resolution, without matplotlib or a
+        legend. Much faster than rendering figures.
+    """
+    if len(colors) < len(pred_dirs):
+        raise ValueError(f"{len(pred_dirs)} prediction directories but only {len(colors)} colors.")
+
+    jobs = []
+    for img in list_predictions(pred_dirs[0]):
+        out_file = os.path.join(out_dir, img)
+        if os.path.exists(out_file) and not overwrite:
+            print(f"File: {img} exists. Skip.")
+            continue
+        jobs.append(dict(img_file=os.path.join(im_dir, img),
+                         truth_file=os.path.join(truth_dir, img),
+                         pred_files=[os.path.join(pred_dir, img) for pred_dir in pred_dirs],
+                         out_file=out_file,
+                         model_names=list(model_names),
+                         colors=list(colors),
+                         dpi=dpi))
+
+    verify_dir(out_dir)
+    render_tiles(boundary_mosaic if fast else boundary_figure, jobs, n_workers, verbose)
+
+
+def boundary_figure(img_file, truth_file, pred_files, out_file, model_names, colors, dpi=300):
+    """
+    Render and save the boundary plot of a single tile. See model_boundary_plot(). Uses the object oriented
+    matplotlib API with the Agg canvas, so it can run in worker processes.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.lines import Line2D
 
-import importlib.util
-
-
-def model_boundary_plot(im_dir, truth_dir, pred_dirs, out_dir, dpi=300, verbose=True, model_names=["CA-F", "CA-S", "FR-I", "FR-G", "DE-G", "NY-Q", "COMB"], colors=["#0000ff", "#000088", "#00ff00", "#008800", "#ff00ff", "#ff8800", "#aaaa00"], overwrite=False):
-    # Get the filenames from one of the predictions
-    img_paths = glob.glob(os.path.join(pred_dirs[0], "*.png"))
-    imgs = [os.path.basename(img_path) for img_path in img_paths]
     titles = ['img', 'truth', 'predictions']
 
     figsize = 4
     cols = 3
 
-    if importlib.util.find_spec("tqdm"):
-        from tqdm import tqdm
-        looper = tqdm(imgs)
-    else:
-        looper = imgs
-
-    for i, img in enumerate(looper):
-        if verbose and not importlib.util.find_spec("tqdm"):
-            print(f"{i}/{len(imgs)}")
-
-        if os.path.exists(os.path.join(out_dir, img)) and not overwrite:
+    fig = Figure(figsize=(cols * figsize, figsize))
+    axes = fig.subplots(1, cols)
+
+    for axis, title in zip(axes, titles):
+        axis.set_axis_off()
+        axis.set_title(title, fontsize=15)
+
+    img_dat = Image.open(img_file)
+    axes[0].imshow(img_dat)
+    truth_dat = Image.open(truth_file)
+    axes[1].imshow(truth_dat)
+
+    handles, labels = axes[2].get_legend_handles_labels()
+
+    # Plot image, then the truth border and all prediction borders as one overlay
+    axes[2].imshow(img_dat, alpha=0.5)
+    axes[2].imshow(boundary_overlay(truth_dat, pred_files, colors, img_dat.size))
+
+    handles.append(Line2D([0], [0], label="Truth", color="#ff0000"))
+    for model, color in zip(model_names, colors):
+        handles.append(Line2D([0], [0], label=model, color=color))
+
+    truth_dat.close()
+    img_dat.close()
+
+    axes[2].legend(handles=handles, bbox_to_anchor=(1, 1), loc="upper left")
+    fig.savefig(out_file, dpi=dpi)
+
+
+def boundary_mosaic(img_file, truth_file, pred_files, out_file, model_names, colors, dpi=None):
+    """
+    Compose and save the boundary plot of a single tile as an image mosaic, without matplotlib. See
+    model_boundary_plot().
+    """
+    with Image.open(img_file) as img_dat:
+        img = np.asarray(img_dat.convert("RGB"))
+        size = img_dat.size
+    with Image.open(truth_file) as truth_dat:
+        truth = mask_array(truth_dat)
+        brd = boundary_overlay(truth_dat, pred_files, colors, size)
+
+    # Faded image with the truth border, then each model's border on top
+    overlay = fade(img)
+    drawn = brd[:, :, 3] > 0
+    overlay[drawn] = brd[drawn, :3]
+
+    panels = [img, mask_panel(truth), overlay]
+    save_mosaic(out_file, panels, ['img', 'truth', 'predictions'])
+
+
+def multimodel_plot(im_src, truth_dir, pred_dirs, out_dir, dpi=300, verbose=True, model_names=["CA-F", "CA-S", "FR-I", "FR-G", "DE-G", "NY-Q", "COMB"], overwrite=False,
+                    n_workers=None, fast=False):
+    """
+    Plot the image, the truth and every model's prediction side by side for each tile.
+
+    Parameters
+    ----------
+    im_src: str
+        Directory of the images
+    truth_dir: str
+        Directory of the ground truth masks
+    pred_dirs: list[str]
+        Prediction directory of each model. The tiles are taken from the first one.
+    out_dir: str
+        Output directory for the plots
+    dpi: int (default 300)
+        Resolution of the figures. Ignored if fast.
+    verbose: bool (default True)
+        Print progress?
+    model_names: list[str]
+        Name of each model, for the panel titles
+    overwrite: bool (default False)
+        Should existing plots be overwritten?
+    n_workers: int or None (default None)
+        Number of worker processes to render the tiles with. If None or 1, all tiles are rendered in the current
+        process.
+    fast: bool (default False)
+        If True, compose the panels directly as an image mosaic at the tile resolution, without matplotlib. Much
+        faster than rendering figures.
+    """
+    jobs = []
+    for img in list_predictions(pred_dirs[0]):
+        out_file = os.path.join(out_dir, img)
+        if os.path.exists(out_file) and not overwrite:
             print(f"File: {img} exists. Skip.")
             continue
+        jobs.append(dict(img_file=os.path.join(im_src, img),
+                         truth_file=os.path.join(truth_dir, img),
+                         pred_files=[os.path.join(pred_dir, img) for pred_dir in pred_dirs],
+                         out_file=out_file,
+                         model_names=list(model_names),
+                         dpi=dpi))
 
-        fig, axes = plt.subplots(1, cols, figsize=(cols * figsize, figsize))
-
-        for axis, title in zip(axes, titles):
-            axis.set_axis_off()
-            axis.set_title(title, fontsize=15)
-
-        img_dat = Image.open(os.path.join(im_dir, img))
-        axes[0].imshow(img_dat)
-        truth_dat = Image.open(os.path.join(truth_dir, img))
-        axes[1].imshow(truth_dat)
-
-        handles, labels = axes[2].get_legend_handles_labels()
-
-        # Plot image & truth border
-        axes[2].imshow(img_dat, alpha=0.5)
-        truth_brd = bkg_to_alpha(
-            mask_colorize(
-                mask_to_boundary(truth_dat, size=9),
-                "#ff0000"))
-        axes[2].imshow(truth_brd)
-
-        legend_entry = Line2D([0], [0], label="Truth", color="#ff0000")
-        handles.append(legend_entry)
-
-        truth_dat.close()
-        img_dat.close()
+    verify_dir(out_dir)
+    render_tiles(multimodel_mosaic if fast else multimodel_figure, jobs, n_workers, verbose)
 
-        # Plot prediction borders
-        for pred_dir, model, color in zip(pred_dirs, model_names, colors):
-            msk_im = Image.open(os.path.join(pred_dir, img))
-            msk = msk_im.resize(img_dat.size)
-            msk_im.close()
 
-            msk = binarize(msk, 50)
-            brd = bkg_to_alpha(
-                mask_colorize(
-                    mask_to_boundary(msk, size=3),
-                    color=color))
-            axes[2].imshow(brd)
-            legend_entry = Line2D([0], [0], label=model, color=color)
-            handles.append(legend_entry)
-        plt.legend(handles=handles, bbox_to_anchor=(1, 1), loc="upper left")
-        verify_dir(out_dir)
-        fig.savefig(os.path.join(out_dir, img), dpi=dpi)
-        # plt.show()
-        plt.close(fig)
-
-
-
-
-
-
-def multimodel_plot(im_src, truth_dir, pred_dirs, out_dir, dpi=300, verbose=True, model_names=["CA-F", "CA-S", "FR-I", "FR-G", "DE-G", "NY-Q", "COMB"], overwrite=False):
+def multimodel_figure(img_file, truth_file, pred_files, out_file, model_names, dpi=300):
+    """
+    Render and save the multi-model plot of a single tile. See multimodel_plot(). Uses the object oriented
+    matplotlib API with the Agg canvas, so it can run in worker processes.
+    """
+    from matplotlib.figure import Figure
 
     bkg_alpha = 0.5
     fg_alpha = 0.5
     overlay_color = "#ff0000"
 
-    # Get the filenames from one of the predictions
-    img_paths = glob.glob(os.path.join(pred_dirs[0], "*.png"))
-    imgs = [os.path.basename(img_path) for img_path in img_paths]
-
     titles = ['img', 'truth']
     [titles.append(mdl) for mdl in model_names]
 
     figsize = 7
     cols = len(titles)
 
-    if importlib.util.find_spec("tqdm"):
-        from tqdm import tqdm
-        looper = tqdm(imgs)
-    else:
-        looper = imgs
-
-    for img in looper:
-        if verbose and not importlib.util.find_spec("tqdm"):
-            print(f"{i}/{len(imgs)}")
-
-        if os.path.exists(os.path.join(out_dir, img)) and not overwrite:
-            print(f"File: {img} exists. Skip.")
-            continue
+    fig = Figure(figsize=(cols * figsize, figsize))
+    axes = fig.subplots(1, cols)
+    for axis, title in zip(axes, titles):
+        axis.set_axis_off()
+        axis.set_title(title, fontsize=15)
 
-        fig, axes = plt.subplots(1, cols, figsize=(cols * figsize, figsize))
-        for axis, title in zip(axes, titles):
-            axis.set_axis_off()
-            axis.set_title(title, fontsize=15)
+    img_dat = Image.open(img_file)
+    truth_dat = Image.open(truth_file)
 
-        img_dat = Image.open(os.path.join(im_src, img))
-        truth_dat = Image.open(os.path.join(truth_dir, img))
+    axes[0].imshow(img_dat)
+    axes[1].imshow(img_dat, alpha=bkg_alpha)
+    lut = color_lut([overlay_color])
+    axes[1].imshow(composite_layers([mask_array(truth_dat)], [overlay_color], lut=lut), alpha=fg_alpha)
 
-        axes[0].imshow(img_dat)
-        axes[1].imshow(img_dat, alpha=bkg_alpha)
-        axes[1].imshow(bkg_to_alpha(mask_colorize(truth_dat, overlay_color)), alpha=fg_alpha)
+    for i, pred_file in enumerate(pred_files):
+        # Binarize, colorize and remove bkg
+        msk = composite_layers([prediction_mask(pred_file, img_dat.size)], [overlay_color], lut=lut)
 
-        for i, pred_dir in enumerate(pred_dirs):
-            msk_im = Image.open(os.path.join(pred_dir, img))
-            msk = msk_im.resize(img_dat.size)
-            msk_im.close()
+        axes[i+2].imshow(img_dat, alpha=bkg_alpha)
+        axes[i+2].imshow(msk, alpha=fg_alpha)
 
-            # Binarize, colorize and remove bkg
-            msk = binarize(msk, 50)
-            msk = bkg_to_alpha(
-                mask_colorize(msk, color=overlay_color))
+    fig.savefig(out_file, dpi=dpi)
+    truth_dat.close()
+    img_dat.close()
 
-            axes[i+2].imshow(img_dat, alpha=bkg_alpha)
-            axes[i+2].imshow(msk, alpha=fg_alpha)
 
-        verify_dir(out_dir)
-        fig.savefig(os.path.join(out_dir, img), dpi=dpi)
-        plt.close(fig)
+def multimodel_mosaic(img_file, truth_file, pred_files, out_file, model_names, dpi=None):
+    """
+    Compose and save the multi-model plot of a single tile as an image mosaic, without matplotlib. See
+    multimodel_plot().
+    """
+    fg_alpha = 0.5
+    overlay_color = ImageColor.getrgb("#ff0000")
+
+    with Image.open(img_file) as img_dat:
+        img = np.asarray(img_dat.convert("RGB"))
+        size = img_dat.size
+    with Image.open(truth_file) as truth_dat:
+        truth = mask_array(truth_dat)
+
+    faded = fade(img)
+    panels = [img, blend(faded, truth, overlay_color, fg_alpha)]
+    for pred_file in pred_files:
+        panels.append(blend(faded, prediction_mask(pred_file, size), overlay_color, fg_alpha))
+
+    save_mosaic(out_file, panels, ['img', 'truth'] + list(model_names))
+
+
+def render_tiles(render, jobs, n_workers=None, verbose=True):
+    """
+    Run a tile rendering function over a list of jobs, optionally on a pool of worker processes. Progress is shown
+    with tqdm if it is installed, and is updated as each tile finishes, whichever worker rendered it. Inside a
+    daemonic process (e.g. a multiprocessing.Pool worker), which can't start child processes, a thread pool is used
+    instead. If a tile fails, the tiles that haven't started are cancelled and the error is raised.
+
+    Parameters
+    ----------
+    render: callable
+        Module level function called as render(**job)
+    jobs: list[dict]
+        Keyword arguments for each tile
+    n_workers: int or None (default None)
+        Number of worker processes. If None or 1, all tiles are rendered in the current process.
+    verbose: bool (default True)
+        Show progress?
+    """
+    if verbose and importlib.util.find_spec("tqdm"):
+        from tqdm import tqdm
+        bar = tqdm(total=len(jobs))
+    else:
+        bar = None
+
+    def done(i):
+        if bar is not None:
+            bar.update(1)
+        elif verbose:
+            print(f"{i + 1}/{len(jobs)}")
+
+    try:
+        if n_workers is None or n_workers <= 1:
+            for i, job in enumerate(jobs):
+                render(**job)
+                done(i)
+        else:
+            executor = ThreadPoolExecutor if mp.current_process().daemon else ProcessPoolExecutor
+            with executor(max_workers=n_workers) as pool:
+                futures = [pool.submit(render, **job) for job in jobs]
+                try:
+                    for i, future in enumerate(as_completed(futures)):
+                        future.result()
+                        done(i)
+                except BaseException:
+                    # Don't render the rest of the queue before raising
+                    pool.shutdown(cancel_futures=True)
+                    raise
+    finally:
+        if bar is not None:
+            bar.close()
+
+
+def fade(img, alpha=0.5):
+    """
+    Blend an RGB image array onto a white background, like imshow with alpha.
+    """
+    return (alpha * img + (1 - alpha) * 255).astype(np.uint8)
+
+
+def blend(base, mask, color, alpha=0.5):
+    """
+    Blend a solid color onto an RGB image array where mask is True.
+    """
+    out = base.copy()
+    out[mask] = (alpha * np.array(color) + (1 - alpha) * base[mask]).astype(np.uint8)
+    return out
+
+
+def prediction_mask(pred_file, size, thresh=50):
+    """
+    Binary mask of a prediction, resized to size and binarized at thresh.
+    """
+    with open_prediction_image(pred_file) as msk_im:
+        return mask_array(msk_im.resize(size), thresh)
+
+
+def boundary_overlay(truth, pred_files, colors, size, truth_color="#ff0000"):
+    """
+    RGBA overlay of the truth boundary with every prediction's boundary drawn on top, on a transparent background.
+
+    Parameters
+    ----------
+    truth: PIL.Image
+        The ground truth mask
+    pred_files: list[str]
+        Full path of each model's prediction
+    colors: list[str]
+        Boundary color of each model
+    size: tuple
+        Size of the image, the predictions are resized to it
+    truth_color: str (default "#ff0000")
+        Boundary color of the truth
+
+    Returns
+    -------
+    np.array of uint8, shape (height, width, 4)
+    """
+    brds = [mask_boundary(mask_array(truth), size=9)]
+    for pred_file in pred_files:
+        brds.append(mask_boundary(prediction_mask(pred_file, size), size=3))
+    return composite_layers(brds, [truth_color] + list(colors))
+
+
+def mask_panel(mask):
+    """
+    White on black RGB array of a boolean mask.
+    """
+    return np.repeat(mask[:, :, np.newaxis] * np.uint8(255), 3, axis=-1)
+
+
+def save_mosaic(out_file, panels, titles, pad=4, title_height=16):
+    """
+    Save RGB image arrays side by side in one image, with a title above each.
+
+    Parameters
+    ----------
+    out_file: str
+        Full context of the output image
+    panels: list[np.array]
+        RGB arrays, all the same height
+    titles: list[str]
+        Title of each panel
+    pad: int (default 4)
+        Pixels of white space between the panels
+    title_height: int (default 16)
+        Pixels of space for the titles
+    """
+    height = max(p.shape[0] for p in panels)
+    width = sum(p.shape[1] for p in panels) + pad * (len(panels) - 1)
+    canvas = Image.new("RGB", (width, height + title_height), "white")
+    draw = ImageDraw.Draw(canvas)
+    x = 0
+    for panel, title in zip(panels, titles):
+        canvas.paste(Image.fromarray(panel), (x, title_height))
+        draw.text((x + 2, 2), title, fill="black")
+        x += panel.shape[1] + pad
+    canvas.save(out_file)
 
 
 def mask_to_boundary(mask, size=3, color=[255, 255, 255]):
@@ -1,54 +1,202 @@
 from PIL import Image
 import numpy as np
-from utils.fileio import verify_dir
+from utils.fileio import verify_dir, file_signature, cell_file_for, read_cells, append_cells
+from utils.prediction_store import read_prediction, list_predictions, prediction_signature
 
 import glob
 import os
 import pandas as pd
 
 import importlib
+import importlib.util
+import base64
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 
 
-def aggregate_imagewise_metrics(truth_dir, pred_dirs, out_file, model_names, threshold=0.5, overwrite=False):
-    if os.path.exists(out_file) and not overwrite:
-        print(f"Output imagewise metric file exists: skipping...")
-        return
+METRIC_NAMES = ["iou_score", "precision", "recall", "f1_score"]
+CELL_KEYS = ["pred_dir", "image"]
+CELL_COLS = CELL_KEYS + ["signature"] + METRIC_NAMES
+SWEEP_CELL_COLS = CELL_KEYS + ["signature", "hist"]
+
+
+def aggregate_imagewise_metrics(truth_dir, pred_dirs, out_file, model_names, threshold=0.5, overwrite=False,
+                                n_workers=None):
+    """
+    Compute the metrics of every image for every model and save them to an Excel file with one sheet per metric.
+    Each truth mask is loaded once and scored against the predictions of all models together.
+
+    The metrics of each (prediction directory, image) cell are kept in a cell cache next to the output file, with a
+    fingerprint of the truth and prediction files and the threshold. Only cells that are missing or whose files have
+    changed are computed, e.g. only the new model's column after adding a train set to a sweep. The Excel file is
+    always rebuilt from the cached cells.
+
+    Parameters
+    ----------
+    truth_dir: str
+        Directory of the ground truth masks
+    pred_dirs: list[str]
+        Prediction directory of each model. The images are taken from the first one.
+    out_file: str
+        Full context of the output Excel file
+    model_names: list[str]
+        Name of each model, used as the column names
+    threshold: float (default 0.5)
+        A threshold value that will be applied to determine the level of prediction that constitutes "true".
+    overwrite: bool (default False)
+        Discard the cell cache and compute every cell again?
+    n_workers: int or None (default None)
+        Number of worker processes to spread the images over. If None or 1, all images are scored in the
+        current process.
+    """
     verify_dir(os.path.dirname(out_file))
+    cell_file = cell_file_for(out_file)
+    if overwrite and os.path.exists(cell_file):
+        os.remove(cell_file)
+    cells = read_cells(cell_file, CELL_KEYS)
 
     # Get the filenames from one of the predictions
-    img_paths = glob.glob(os.path.join(pred_dirs[0], "*.png"))
-    imgs = [os.path.basename(img_path) for img_path in img_paths]
-
-    col_names = list(model_names)
-    row_names = list(imgs)
-    iou_score = pd.DataFrame([], index=row_names, columns=col_names)
-    precision = iou_score.copy(deep=True)
-    recall = iou_score.copy(deep=True)
-    f1_score = iou_score.copy(deep=True)
-
-    if importlib.util.find_spec("tqdm"):
-        from tqdm import tqdm
-        looper = tqdm(imgs)
-    else:
-        looper = imgs
-
-    for j, img in enumerate(looper):  # rows
-        truth_fn = os.path.join(truth_dir, img)
-        for i, pred_dir in enumerate(pred_dirs):  # cols
-            pred_fn = os.path.join(pred_dir, img)
-
-            iou_im, p_im, r_im, f1_im = compute_imagewise_metrics(truth_fn, pred_fn, threshold)
-
-            iou_score.iloc[j,i] = iou_im
-            precision.iloc[j,i] = p_im
-            recall.iloc[j,i] = r_im
-            f1_score.iloc[j,i] = f1_im
+    imgs = list_predictions(pred_dirs[0])
+
+    # Find the cells that are missing or stale, grouped by image so each truth mask is still loaded once
+    jobs = []
+    signatures = {}
+    for img in imgs:
+        truth_file = os.path.join(truth_dir, img)
+        truth_sig = file_signature(truth_file)
+        stale = []
+        for pred_dir in pred_dirs:
+            sig = f"{truth_sig};{prediction_signature(os.path.join(pred_dir, img))};{threshold}"
+            signatures[(pred_dir, img)] = sig
+            cell = cells.get((pred_dir, img))
+            if cell is None or cell["signature"] != sig:
+                stale.append(pred_dir)
+        if stale:
+            jobs.append((img, stale, (truth_file, [os.path.join(pred_dir, img) for pred_dir in stale], threshold)))
+
+    n_cells = len(imgs) * len(pred_dirs)
+    print(f"Imagewise metrics: computing {sum(len(job[1]) for job in jobs)} of {n_cells} cells...")
+
+    if jobs:
+        if n_workers is None or n_workers <= 1:
+            results = map(_score_image, [job[2] for job in jobs])
+            pool = None
+        else:
+            pool = ProcessPoolExecutor(max_workers=n_workers)
+            results = pool.map(_score_image, [job[2] for job in jobs],
+                               chunksize=max(1, len(jobs) // (4 * n_workers)))
+
+        try:
+            if importlib.util.find_spec("tqdm"):
+                from tqdm import tqdm
+                results = tqdm(results, total=len(jobs))
+
+            for (img, stale, _), res in zip(jobs, results):
+                rows = []
+                for pred_dir, values in zip(stale, res):
+                    row = dict(pred_dir=pred_dir, image=img, signature=signatures[(pred_dir, img)])
+                    row.update({name: repr(float(v)) for name, v in zip(METRIC_NAMES, values)})
+                    cells[(pred_dir, img)] = row
+                    rows.append(row)
+                append_cells(cell_file, rows, CELL_COLS)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    # metrics[j, i, k] is metric k of model i on image j
+    metrics = np.array([[[float(cells[(pred_dir, img)][name]) for name in METRIC_NAMES] for pred_dir in pred_dirs]
+                        for img in imgs], dtype=np.float64).reshape(len(imgs), len(pred_dirs), len(METRIC_NAMES))
 
     with pd.ExcelWriter(out_file) as w:
-        iou_score.to_excel(w, sheet_name="iou_score")
-        precision.to_excel(w, sheet_name="precision")
-        recall.to_excel(w, sheet_name="recall")
-        f1_score.to_excel(w, sheet_name="f1_score")
+        for k, name in enumerate(METRIC_NAMES):
+            pd.DataFrame(metrics[:, :, k], index=list(imgs), columns=list(model_names)).to_excel(w, sheet_name=name)
+
+
+def _score_image(job):
+    """
+    Worker for aggregate_imagewise_metrics. Scores the predictions of all models for one image.
+    """
+    truth_file, prediction_files, threshold = job
+    preds = np.stack([load_prediction(fn) for fn in prediction_files])
+    gt = load_truth(truth_file, preds.shape[1:])
+    return imagewise_metrics_stack(gt, preds, threshold)
+
+
+def load_prediction(prediction_file):
+    """
+    Load a prediction mask as probabilities in 0-1. See utils.prediction_store.read_prediction().
+
+    Parameters
+    ----------
+    prediction_file: str
+        full context of prediction mask
+
+    Returns
+    -------
+    np.array of the prediction probabilities, shape (h, w)
+    """
+    return read_prediction(prediction_file)
+
+
+def load_truth(truth_file, shape):
+    """
+    Load a ground truth mask, resize it to match the predictions and normalize it to 0-1.
+
+    Parameters
+    ----------
+    truth_file: str
+        full context of ground truth mask
+    shape: tuple
+        shape of the predictions
+
+    Returns
+    -------
+    np.array of the normalized truth, shape (h, w)
+    """
+    with Image.open(truth_file) as i1:
+        gt = np.array(i1.resize(shape))  # Reshape to match prediction
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return gt / np.max(gt)
+
+
+def imagewise_metrics_stack(gt, preds, threshold=0.5):
+    """
+    Compute the metrics of several predictions of the same image at once.
+
+    Parameters
+    ----------
+    gt: np.array
+        Normalized ground truth, shape (h, w)
+    preds: np.array
+        Prediction probabilities of each model in 0-1, shape (n_models, h, w), e.g. from load_prediction()
+    threshold: float
+        A threshold value that will be applied to determine the level of prediction that constitutes "true".
+        Should be between 0-1.
+
+    Returns
+    -------
+    np.array of shape (n_models, 4) holding iou, precision, recall, f1 for each model
+    """
+    n_models = preds.shape[0]
+    preds = preds.reshape(n_models, -1)
+    gt = gt.reshape(-1).astype(np.float64)
+
+    pp = preds > threshold  # predicted positives
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Compute Truth Table
+        n_pp = np.count_nonzero(pp, axis=1)  # n of predicted positives
+        n_tp = pp.astype(np.float64) @ gt  # n of true positives
+        n_fp = n_pp - n_tp  # n of false positives
+        n_fn = np.sum(gt) - n_tp  # n of false negatives (actual positives - true positives)
+
+        # Metric Definitions
+        recall = n_tp / (n_tp + n_fn)
+        precision = n_tp / (n_tp + n_fp)
+        iou = n_tp / (n_tp + n_fp + n_fn)
+        f1 = 2 * n_tp / (2 * n_tp + n_fp + n_fn)
+
+    return np.stack([iou, precision, recall, f1], axis=1)
 
 
 def compute_imagewise_metrics(truth_file, prediction_file, threshold=0.5):
@@ -63,40 +211,17 @@ def compute_imagewise_metrics(truth_file, prediction_file, threshold=0.5):
         full context of prediction mask
     threshold: float
         A threshold value that will be applied to determine the level of prediction that constitutes "true".
-        Should be between 0-1 as masks will be normed.
+        Should be between 0-1. Applied to the absolute probabilities, except for older RGBA predictions, which are
+        normalized by their own max.
 
     Returns
     -------
     metrics: float
         return iou, precision, recall, f1
     """
-    # Load images
-    with Image.open(prediction_file) as i2:
-        pt = np.array(i2)[:, :, 0]  # Predictions are RGB for some reason
-        pt = pt/np.max(pt)  # normalize
-    with Image.open(truth_file) as i1:
-        gt = np.array(i1.resize(pt.shape))  # Reshape to match prediction
-        gt = gt/np.max(gt)
-
-    # Compute Truth Table
-    tot = np.size(pt)  # total pix
-    pp = pt > threshold  # predicted positives, array
-    tp = gt * pp  # true positives, array
-
-    n_pp = np.sum(pp)  # n of predicted positives
-    n_pn = tot - n_pp  # n of predicted negatives (all pix - positives)
-
-    n_tp = np.sum(tp)  # n of true positives
-    n_fp = n_pp - n_tp  # n of false positives
-    n_fn = np.sum(gt) - n_tp  # n of false negatives (actual positives - true positives)
-    n_tn = n_pn - n_fn  # n of true negatives
-
-    # Metric Definitions
-    recall = n_tp / (n_tp + n_fn)
-    precision = n_tp / (n_tp + n_fp)
-    iou = n_tp / (n_tp + n_fp + n_fn)
-    f1 = 2 * n_tp / (2 * n_tp + n_fp + n_fn)
-
+    pt = load_prediction(prediction_file)
+    gt = load_truth(truth_file, pt.shape)
+    iou, precision, recall, f1 = imagewise_metrics_stack(gt, pt[np.newaxis], threshold)[0]
     return iou, precision, recall, f1
 
     # # This can also be done with tensorflow, but it took roughly 10x the time of the manual method
@@ -121,6 +246,284 @@ def compute_imagewise_metrics(truth_file, prediction_file, threshold=0.5):
     # print(iou.result().numpy())
 
 
+def threshold_sweep(truth_dir, pred_dirs, out_file, model_names, n_bins=256, hist_file=None, overwrite=False,
+                    n_workers=None):
+    """
+    Compute the metrics of every model at every threshold from a single decode of each prediction. A histogram of
+    the prediction values, split by truth label, is built for each image and model. Summed over the images, the
+    histograms give the confusion counts of the whole test set at each threshold, from which the metric curves,
+    PR and ROC curves and the best threshold of each model are derived. Thresholds are k / (n_bins - 1) for
+    k = 0 ... n_bins - 1, applied to the prediction probabilities as in compute_imagewise_metrics. Blank truth masks
+    count as all negative.
+
+    The output Excel file has a sheet per metric (iou_score, precision, recall, f1_score and fpr) with a row per
+    threshold and a column per model, and a sheet "best" with the best threshold of each model by F1 and by IoU, the
+    metrics at those thresholds, and the areas under the PR and ROC curves.
+
+    The histograms of each (prediction directory, image) cell are kept in a cell cache next to the output file, with a
+    fingerprint of the truth and prediction files and n_bins, as for aggregate_imagewise_metrics(). Only cells that
+    are missing or stale are decoded, and the Excel file is always rebuilt from the cached cells.
+
+    Parameters
+    ----------
+    truth_dir: str
+        Directory of the ground truth masks
+    pred_dirs: list[str]
+        Prediction directory of each model. The images are taken from the first one.
+    out_file: str
+        Full context of the output Excel file
+    model_names: list[str]
+        Name of each model, used as the column names
+    n_bins: int (default 256)
+        Number of thresholds
+    hist_file: str (default None)
+        If given, the per-image histograms are saved to this .npz file, with the image names, so that per-image
+        curves can be derived later with sweep_metrics(). Ignored if None.
+    overwrite: bool (default False)
+        Discard the cell cache and decode every prediction again?
+    n_workers: int or None (default None)
+        Number of worker processes to spread the images over. If None or 1, all images are processed in the
+        current process.
+
+    Returns
+    -------
+    dict of the sweep results as returned by sweep_metrics() for the whole test set
+    """
+    verify_dir(os.path.dirname(out_file))
+    cell_file = cell_file_for(out_file)
+    if overwrite and os.path.exists(cell_file):
+        os.remove(cell_file)
+    cells = read_cells(cell_file, CELL_KEYS)
+
+    # Get the filenames from one of the predictions
+    imgs = list_predictions(pred_dirs[0])
+
+    # hists[j, i, 0 or 1, k] is the weight of truth negatives or positives of image j in bin k of model i
+    hists = np.empty((len(imgs), len(pred_dirs), 2, n_bins), dtype=np.float64)
+
+    # Use the cached cells that are still current, and group the rest by image so each truth mask is loaded once
+    jobs = []
+    signatures = {}
+    for j, img in enumerate(imgs):
+        truth_file = os.path.join(truth_dir, img)
+        truth_sig = file_signature(truth_file)
+        stale = []
+        for i, pred_dir in enumerate(pred_dirs):
+            sig = f"{truth_sig};{prediction_signature(os.path.join(pred_dir, img))};{n_bins}"
+            signatures[(pred_dir, img)] = sig
+            cell = cells.get((pred_dir, img))
+            if cell is None or cell["signature"] != sig:
+                stale.append(i)
+            else:
+                hists[j, i] = _decode_hist(cell["hist"], n_bins)
+        if stale:
+            jobs.append((j, stale, (truth_file, [os.path.join(pred_dirs[i], img) for i in stale], n_bins)))
+
+    n_cells = len(imgs) * len(pred_dirs)
+    print(f"Threshold sweep: decoding {sum(len(job[1]) for job in jobs)} of {n_cells} cells...")
+
+    if jobs:
+        if n_workers is None or n_workers <= 1:
+            results = map(_histogram_image, [job[2] for job in jobs])
+            pool = None
+        else:
+            pool = ProcessPoolExecutor(max_workers=n_workers)
+            results = pool.map(_histogram_image, [job[2] for job in jobs],
+                               chunksize=max(1, len(jobs) // (4 * n_workers)))
+
+        try:
+            if importlib.util.find_spec("tqdm"):
+                from tqdm import tqdm
+                results = tqdm(results, total=len(jobs))
+
+            for (j, stale, _), res in zip(jobs, results):
+                rows = []
+                for i, hist in zip(stale, res):
+                    hists[j, i] = hist
+                    rows.append(dict(pred_dir=pred_dirs[i], image=imgs[j],
+                                     signature=signatures[(pred_dirs[i], imgs[j])], hist=_encode_hist(hist)))
+                append_cells(cell_file, rows, SWEEP_CELL_COLS)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    if hist_file is not None:
+        verify_dir(os.path.dirname(hist_file))
+        np.savez_compressed(hist_file, name=np.array(imgs, dtype=str), model=np.array(model_names, dtype=str),
+                            hist=hists)
+
+    sweep = sweep_metrics(hists.sum(axis=0))
+    best = best_thresholds(sweep)
+
+    index = pd.Index(sweep["threshold"], name="threshold")
+    with pd.ExcelWriter(out_file) as w:
+        for name in SWEEP_NAMES:
+            pd.DataFrame(sweep[name].T, index=index, columns=list(model_names)).to_excel(w, sheet_name=name)
+        pd.DataFrame(best, index=list(model_names)).to_excel(w, sheet_name="best")
+
+    return sweep
+
+
+def _encode_hist(hist):
+    """
+    Pack a (2, n_bins) histogram losslessly into a short string for the cell cache.
+    """
+    raw = np.ascontiguousarray(hist, dtype="<f8").tobytes()
+    return base64.b64encode(zlib.compress(raw)).decode("ascii")
+
+
+def _decode_hist(text, n_bins):
+    """
+    Unpack a histogram packed by _encode_hist().
+    """
+    raw = zlib.decompress(base64.b64decode(text))
+    return np.frombuffer(raw, dtype="<f8").reshape(2, n_bins)
+
+
+def _histogram_image(job):
+    """
+    Worker for threshold_sweep. Builds the histograms of the predictions of all models for one image.
+    """
+    truth_file, prediction_files, n_bins = job
+    preds = np.stack([load_prediction(fn) for fn in prediction_files])
+    gt = load_truth(truth_file, preds.shape[1:])
+    return prediction_histograms(gt, preds, n_bins)
+
+
+def prediction_histograms(gt, preds, n_bins=256):
+    """
+    Histogram the predictions of several models for the same image, split by truth label. Bin k holds the values v
+    with (k - 1) / (n_bins - 1) < v <= k / (n_bins - 1), so v > k / (n_bins - 1) exactly when v falls in a bin above
+    k.
+
+    Parameters
+    ----------
+    gt: np.array
+        Normalized ground truth, shape (h, w). NaN (a blank mask normalized by its max) counts as negative.
+    preds: np.array
+        Prediction probabilities of each model in 0-1, shape (n_models, h, w), e.g. from load_prediction()
+    n_bins: int (default 256)
+        Number of bins
+
+    Returns
+    -------
+    np.array of shape (n_models, 2, n_bins) holding the weight of truth negatives [:, 0] and positives [:, 1] in
+    each bin
+    """
+    n_models = preds.shape[0]
+    levels = n_bins - 1
+    preds = preds.reshape(n_models, -1)
+    gt = np.nan_to_num(gt.reshape(-1).astype(np.float64))
+
+    # Bin index ceil(levels * p). Rounding first stops values stored as v / levels from landing one bin up.
+    bins = np.ceil(np.round(levels * preds.astype(np.float64), 6)).astype(np.int64)
+    bins = np.clip(bins, 0, levels)
+    bins += np.arange(n_models)[:, np.newaxis] * n_bins
+
+    size = n_models * n_bins
+    pos = np.bincount(bins.ravel(), weights=np.tile(gt, n_models), minlength=size)
+    neg = np.bincount(bins.ravel(), weights=np.tile(1 - gt, n_models), minlength=size)
+    return np.stack([neg.reshape(n_models, n_bins), pos.reshape(n_models, n_bins)], axis=1)
+
+
+SWEEP_NAMES = ["iou_score", "precision", "recall", "f1_score", "fpr"]
+
+
+def sweep_metrics(hists):
+    """
+    Compute the metrics at every threshold from histograms made by prediction_histograms().
+
+    Parameters
+    ----------
+    hists: np.array
+        Histograms of shape (..., 2, n_bins), e.g. of one image and model, or summed over a test set
+
+    Returns
+    -------
+    dict with "threshold" (n_bins,), and "tp", "fp", "fn", "tn" and each of SWEEP_NAMES with shape (..., n_bins).
+    fpr is the false positive rate, so recall against fpr is the ROC curve and precision against recall the PR
+    curve.
+    """
+    neg = hists[..., 0, :]
+    pos = hists[..., 1, :]
+    n_bins = hists.shape[-1]
+
+    # Weight strictly above each bin, i.e. predicted positive at that threshold
+    def above(h):
+        tail = np.cumsum(h[..., ::-1], axis=-1)[..., ::-1]
+        return np.concatenate([tail[..., 1:], np.zeros(h.shape[:-1] + (1,))], axis=-1)
+
+    tp = above(pos)
+    fp = above(neg)
+    fn = pos.sum(axis=-1, keepdims=True) - tp
+    tn = neg.sum(axis=-1, keepdims=True) - fp
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = {"threshold": np.arange(n_bins) / (n_bins - 1),
+               "tp": tp, "fp": fp, "fn": fn, "tn": tn,
+               "iou_score": tp / (tp + fp + fn),
+               "precision": tp / (tp + fp),
+               "recall": tp / (tp + fn),
+               "f1_score": 2 * tp / (2 * tp + fp + fn),
+               "fpr": fp / (fp + tn)}
+    return out
+
+
+def best_thresholds(sweep):
+    """
+    Find the best threshold of each model from the output of sweep_metrics(), and the areas under its PR and ROC
+    curves.
+
+    Parameters
+    ----------
+    sweep: dict
+        Output of sweep_metrics() for histograms of shape (n_models, 2, n_bins)
+
+    Returns
+    -------
+    dict of arrays of length n_models: best_f1_threshold, best_f1, precision_at_best_f1, recall_at_best_f1,
+    best_iou_threshold, best_iou, pr_auc and roc_auc. NaN where a metric is undefined at every threshold.
+    """
+    n_models = sweep["f1_score"].shape[0]
+    best = {key: np.full(n_models, np.nan) for key in
+            ["best_f1_threshold", "best_f1", "precision_at_best_f1", "recall_at_best_f1",
+             "best_iou_threshold", "best_iou", "pr_auc", "roc_auc"]}
+
+    for i in range(n_models):
+        f1 = sweep["f1_score"][i]
+        if not np.all(np.isnan(f1)):
+            k = np.nanargmax(f1)
+            best["best_f1_threshold"][i] = sweep["threshold"][k]
+            best["best_f1"][i] = f1[k]
+            best["precision_at_best_f1"][i] = sweep["precision"][i, k]
+            best["recall_at_best_f1"][i] = sweep["recall"][i, k]
+
+        iou = sweep["iou_score"][i]
+        if not np.all(np.isnan(iou)):
+            k = np.nanargmax(iou)
+            best["best_iou_threshold"][i] = sweep["threshold"][k]
+            best["best_iou"][i] = iou[k]
+
+        # Close the curves with the point where everything is predicted positive
+        recall = np.concatenate([[1.], sweep["recall"][i]])
+        fpr = np.concatenate([[1.], sweep["fpr"][i]])
+        best["roc_auc"][i] = _trapezoid(recall, fpr)
+        precision = sweep["precision"][i]
+        keep = ~np.isnan(precision)
+        best["pr_auc"][i] = _trapezoid(precision[keep], sweep["recall"][i][keep])
+
+    return best
+
+
+def _trapezoid(y, x):
+    """
+    Area under a curve with x running in either direction.
+    """
+    if len(x) < 2:
+        return np.nan
+    return abs(np.sum((x[1:] - x[:-1]) * (y[1:] + y[:-1]) / 2))
+
+
 def run():
     truth_file = r"D:\data\solardnn\NY-Q\tiles\mask\002200_62.png"
     prediction_file = r"D:\data\solardnn\NY-Q\predictions\NY-Q_resnet34_42_v1_predicting_NY-Q\pred_masks\002200_62.png"
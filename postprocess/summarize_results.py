@@ -1,8 +1,16 @@
 import os
+import numpy as np
 import pandas as pd
 import openpyxl
 
-from utils.fileio import verify_dir
+from utils.fileio import verify_dir, file_signature, cell_file_for, read_cells, append_cells
+from utils.results_store import summary_tables, column_name
+
+
+METRICS = ["loss", "iou_score", "precision", "recall", "f1-score"]
+SHEETS = ["loss", "iou_score", "precision", "recall", "f1_score"]
+CELL_KEYS = ["result_file"]
+CELL_COLS = CELL_KEYS + ["signature"] + METRICS
 
 
 def generate_run_summary(files_nested, out_file, overwrite=False):
@@ -28,42 +36,151 @@ def generate_run_summary(files_nested, out_file, overwrite=False):
         result files, as generated by `eval_model()`. Almost certainly want to use OrderedDicts.
     out_file: str
         Full context of the summary file to write. Must be XLSX type for writer to work.
-    overwrite
+    overwrite: bool (default False)
+        Discard the cell cache and read every result file again?
+
+    The values read from each result file are kept in a cell cache next to the summary, with a fingerprint of the file.
+    Only new or changed result files are read, and the summary is always rebuilt from the cached cells. Result files
+    that don't exist yet are left blank, so the summary can be refreshed as runs finish.
+    """
+    if "xls" not in os.path.splitext(out_file)[-1]:
+        print("Out file must be xlsx type, skipping...")
+        return
+    write_summary(result_file_tables(files_nested, out_file, overwrite), out_file)
+
+
+def result_file_tables(files_nested, out_file, overwrite=False):
+    """
+    Read the metrics of a 2-D nested dictionary of result files into one table per metric, through the cell cache next
+    to out_file. See generate_run_summary() for the layout of files_nested and the cell cache. Entries that are None are
+    left blank without looking for a file.
+
+    Parameters
+    ----------
+    files_nested: dict[dict[str]]
+        Result file of each cell, outer dict is the columns and inner dicts the rows
+    out_file: str
+        Full context of the summary file the cell cache belongs to
+    overwrite: bool (default False)
+        Discard the cell cache and read every result file again?
 
     Returns
     -------
-
+    dict of sheet name (see SHEETS) to pd.DataFrame, with rows and columns in the order of files_nested
     """
-    if os.path.exists(out_file) and not overwrite:
-        print("generate_run_summary: file exists, skipping...")
-        return
-    elif "xls" not in os.path.splitext(out_file)[-1]:
-        print("Out file must be xlsx type, skipping...")
     verify_dir(os.path.dirname(out_file))
 
+    cell_file = cell_file_for(out_file)
+    if overwrite and os.path.exists(cell_file):
+        os.remove(cell_file)
+    cells = read_cells(cell_file, CELL_KEYS)
+
     col_names = list(files_nested.keys())
     row_names = list(files_nested[col_names[0]].keys())
-    loss = pd.DataFrame([], index=row_names, columns=col_names)
-    iou_score = loss.copy(deep=True)
-    precision = loss.copy(deep=True)
-    recall = loss.copy(deep=True)
-    f1_score = loss.copy(deep=True)
 
-    for i, col_name in enumerate(col_names):
-        for j, row_name in enumerate(row_names):
+    # Read only the result files that are new or changed since they were cached
+    rows = []
+    new_cells = []
+    for col_name in col_names:
+        for row_name in row_names:
+            result_file = files_nested[col_name][row_name]
+            if result_file is None:
+                rows.append([col_name, row_name] + [np.nan] * len(METRICS))
+                continue
+            if not os.path.exists(result_file):
+                print(f"summarize_results: no results for {row_name} on {col_name}")
+                rows.append([col_name, row_name] + [np.nan] * len(METRICS))
+                continue
+            sig = file_signature(result_file)
+            cell = cells.get((result_file,))
+            if cell is None or cell["signature"] != sig:
+                dat = pd.read_csv(result_file, nrows=1)
+                cell = dict(result_file=result_file, signature=sig)
+                cell.update({metric: repr(float(dat[metric][0])) for metric in METRICS})
+                new_cells.append(cell)
+            rows.append([col_name, row_name] + [float(cell[metric]) for metric in METRICS])
+    if new_cells:
+        append_cells(cell_file, new_cells, CELL_COLS)
+
+    # One long table of all the cells, then pivot each metric
+    results = pd.DataFrame(rows, columns=["col", "row"] + METRICS)
+
+    return {sheet: results.pivot(index="row", columns="col", values=metric).reindex(index=row_names,
+                                                                                    columns=col_names)
+            for metric, sheet in zip(METRICS, SHEETS)}
+
 
-            set_result_file = files_nested[col_name][row_name]
-            dat = pd.read_csv(set_result_file)
+def generate_results_summary(db_file, out_file, row_names=None, col_names=None, result_files=None, overwrite=False,
+                             **filters):
+    """
+    Generate the same summary tables as generate_run_summary() from a results database written during evaluation
+    (see utils.results_store). Each table is a single pivot of the stored results, with train sets as rows and test sets
+    as columns. The pivot is cheap, so the summary is rebuilt on every call.
+
+    Runs evaluated before the database existed only have result files. If result_files is given, the cells that have
+    no row in the database are filled from those files instead, read through the same cell cache as
+    generate_run_summary().
+
+    Parameters
+    ----------
+    db_file: str
+        Full path of the SQLite results file. If it doesn't exist, only result_files are used.
+    out_file: str
+        Full context of the summary file to write. Must be XLSX type for writer to work.
+    row_names: list[str] (default None)
+        Train sets to include, in order. If None, all stored train sets are used.
+    col_names: list[str] (default None)
+        Test sets to include, in order. If None, all stored test sets are used.
+    result_files: dict[dict[str]] (default None)
+        Result file of each cell, laid out like files_nested of generate_run_summary(), i.e.
+        result_files[test_set][train_set]. Ignored if None.
+    overwrite: bool (default False)
+        Discard the cell cache of the result files and read them all again?
+    filters:
+        Passed to utils.results_store.read_results(), e.g. backbone, seed, model_rev. threshold=None selects the
+        metrics computed on the probabilities.
+    """
+    if not os.path.exists(db_file) and result_files is None:
+        print("generate_results_summary: no results found, skipping...")
+        return
+
+    if row_names is not None:
+        filters["train_set"] = list(row_names)
+    if col_names is not None:
+        filters["test_set"] = list(col_names)
+
+    if os.path.exists(db_file):
+        db_tables = summary_tables(db_file, values=METRICS, **filters)
+        tables = {sheet: db_tables[column_name(metric)] for metric, sheet in zip(METRICS, SHEETS)}
+    else:
+        tables = {sheet: pd.DataFrame() for sheet in SHEETS}
 
-            loss.iloc[j,i] = dat['loss'][0]
-            iou_score.iloc[j, i] = dat['iou_score'][0]
-            precision.iloc[j, i] = dat['precision'][0]
-            recall.iloc[j, i] = dat['recall'][0]
-            f1_score.iloc[j, i] = dat['f1-score'][0]
+    if result_files is not None:
+        # Only read the result files of cells the database has nothing for
+        stored = tables[SHEETS[0]]
+        missing = {col: {row: (None if row in stored.index and col in stored.columns and
+                               pd.notna(stored.at[row, col]) else result_file)
+                         for row, result_file in rows.items()}
+                   for col, rows in result_files.items()}
+        file_tables = result_file_tables(missing, out_file, overwrite)
+        tables = {sheet: tables[sheet].combine_first(file_tables[sheet]) for sheet in SHEETS}
 
+    write_summary({sheet: table.reindex(index=row_names, columns=col_names) for sheet, table in tables.items()},
+                  out_file)
+
+
+def write_summary(tables, out_file):
+    """
+    Write summary tables to an excel file, one sheet per table.
+
+    Parameters
+    ----------
+    tables: dict[pd.DataFrame]
+        Tables keyed by sheet name
+    out_file: str
+        Full context of the summary file to write. Must be XLSX type for writer to work.
+    """
+    verify_dir(os.path.dirname(out_file))
     with pd.ExcelWriter(out_file) as w:
-        loss.to_excel(w, sheet_name="loss")
-        iou_score.to_excel(w, sheet_name="iou_score")
-        precision.to_excel(w, sheet_name="precision")
-        recall.to_excel(w, sheet_name="recall")
-        f1_score.to_excel(w, sheet_name="f1_score")
+        for sheet, table in tables.items():
+            table.rename_axis(index=None, columns=None).to_excel(w, sheet_name=sheet)
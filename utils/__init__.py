@@ -3,9 +3,10 @@ from utils.convert_to_png import zip_to_png, tif_to_png
 from utils.generate_blank_json import generate_blank_json_dir
 from utils.generate_blank_json import generate_blank_json_file
 from utils.json_to_dataset import labelme_json_to_binary, cal_to_labelme
+from utils.json_to_dataset import labelme_json_to_array, labelme_json_dir_to_binary
 from utils.remove_json_imagedata import clear_imagedata
-from utils.slice_dataset_tiles import calc_rowcol
-from utils.delete_blanks import delete_blank_tiles
-
-
-
+from utils.slice_dataset_tiles import calc_rowcol, slice_tiles, slice_labelme_tiles
+from utils.delete_blanks import delete_blank_tiles, align_datasets
+from utils.dataset_pairing import pair_datasets
+from utils.prediction_store import read_prediction, list_predictions
+from utils.results_store import append_result, read_results, summary_tables
@@ -1,13 +1,21 @@
 from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, \
+    FIRST_COMPLETED
 import os
+import time
 from PIL import Image
 import numpy as np
 
-from utils.fileio import verify_dir, is_dir_empty, clear_dir, files_of_type
+from utils.fileio import verify_dir, files_of_type, read_manifest, \
+    append_manifest, is_manifest_current
+
+# File name used for the conversion manifest if none is given
+MANIFEST_NAME = "conversion_manifest.csv"
 
 
 def zip_to_png(source_zip, rgb_dir, ir_dir=None, img_ext="png",
-               overwrite=False, verbose=True):
+               overwrite=False, verbose=True, n_workers=None,
+               max_inflight=None, manifest_file=None):
     """
     Process ZIP files from New York City GIS data download
          (https://gis.ny.gov/gateway/mg/2018/new_york_city/)
@@ -27,73 +35,194 @@ def zip_to_png(source_zip, rgb_dir, ir_dir=None, img_ext="png",
     img_ext: str (default "png")
         Extension of the image file name to save as. Must be supported by PIL.
     overwrite: bool (default False)
-        If output path(s) exist, should the operation be run anyway?
+        Convert every file, even those the manifest shows as already done?
     verbose: bool (default True)
         Print a status update file by file?
+    n_workers: int or None (default None)
+        Number of worker processes used to decode the images. If None or 1,
+        all files are converted in the current process.
+    max_inflight: int or None (default None)
+        Maximum number of files submitted to the workers at any one time. This
+        bounds memory use regardless of the size of the archive. If None,
+        defaults to twice n_workers.
+    manifest_file: str or None (default None)
+        Full path of the conversion manifest. Each converted file is recorded
+        along with its size and CRC, so that re-running only converts files
+        that are new, changed or unfinished. If None, it is stored in rgb_dir.
     """
 
     # Make sure our output directories exist
     verify_dir(rgb_dir)
-    if not is_dir_empty(rgb_dir):
-        if not overwrite:
-            print("RGB Output path not empty. Skipping entire operation.")
-            return
-        else:
-            clear_dir(rgb_dir)
-
     if ir_dir is not None:
         verify_dir(ir_dir)
-        if not is_dir_empty(ir_dir):
-            if not overwrite:
-                print("IR Output path not empty. Skipping entire operation.")
-                return
-            else:
-                clear_dir(ir_dir)
-
-    # Open the zip file for internal access
+
+    if manifest_file is None:
+        manifest_file = os.path.join(rgb_dir, MANIFEST_NAME)
+    manifest = read_manifest(manifest_file)
+
+    # Find the images within the zip that still need to be converted
+    jobs = []
+    n_total = 0
     with ZipFile(source_zip, "r") as zipdat:
+        for info in zipdat.infolist():
+            fn_short, ext = os.path.splitext(info.filename)
+            if ext != ".jp2":
+                continue
+            n_total += 1
 
-        # Get a list of all files within the zip
-        fns = zipdat.namelist()
+            outputs = [os.path.join(rgb_dir, fn_short + "." + img_ext)]
+            if ir_dir is not None:
+                outputs.append(os.path.join(ir_dir, fn_short + "." + img_ext))
+            signature = f"{info.CRC:08x}"
 
-        # loop over each file within the zip
-        for fn in fns:
+            if not overwrite and is_manifest_current(
+                    manifest.get(info.filename), info.file_size, signature,
+                    outputs):
+                continue
+            jobs.append((info.filename, info.file_size, signature, outputs))
 
-            # Separate the file name and its extension for this file
-            fn_short, ext = os.path.splitext(fn)
+    if verbose:
+        print(f"{len(jobs)} of {n_total} files need converting.")
 
-            # Check to see if it's an image
-            if ext == ".jp2":
+    if n_workers is None or n_workers <= 1:
+        # Convert each file in this process
+        for job in jobs:
+            try:
+                result = _convert_jp2_member(source_zip, job[0], rgb_dir,
+                                             ir_dir, img_ext)
+            except Exception as e:
+                result = e
+            _record_conversion(manifest_file, job, result, verbose)
+        return
 
-                if verbose:
-                    # Just output a status indicator
-                    print(fn)
+    if max_inflight is None:
+        max_inflight = 2 * n_workers
 
-                # Get access to this individual picture file within the zip
-                with zipdat.open(fn) as file:
+    # Spread the files over a pool of workers, but never hold more than
+    # max_inflight of them at once so that memory stays flat.
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        pending = {}
+        for job in jobs:
+            if len(pending) >= max_inflight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _record_future(manifest_file, pending.pop(future), future,
+                                   verbose)
+            future = pool.submit(_convert_jp2_member, source_zip, job[0],
+                                 rgb_dir, ir_dir, img_ext)
+            pending[future] = job
 
-                    # Read it in as a PIL object
-                    pic = Image.open(file)
+        for future in as_completed(pending):
+            _record_future(manifest_file, pending[future], future, verbose)
 
-                    # Images have 4 layers (RGB + Infrared).
-                    # Convert to NumPy Array for manipulation
-                    x, y = pic.size
-                    a = np.array(pic.getdata()).reshape(x, y, 4)
 
-                    # Separate RGB and Infrared channels and save each into
-                    # a PNG file
-                    # Layers 0-2 are RGB
-                    im = Image.fromarray(a[:, :, :-1].astype('uint8'))
-                    im.save(os.path.join(rgb_dir, fn_short + "." + img_ext))
+def _convert_jp2_member(source_zip, fn, rgb_dir, ir_dir=None, img_ext="png"):
+    """
+    Convert a single JPEG2000 image inside of a zip into RGB and IR images.
+    Opens the zip on its own so that it can be run in a worker process.
 
-                    # Layer 3 is Infrared
-                    if ir_dir is not None:
-                        alpha = Image.fromarray(a[:, :, -1].astype('uint8'))
-                        alpha.save(os.path.join(ir_dir, fn_short +
-                                                "." + img_ext))
+    Parameters
+    ----------
+    source_zip: str
+        full path to the zip file
+    fn: str
+        name of the image within the zip
+    rgb_dir: str
+        full path output directory for the rgb image
+    ir_dir: str or None (default None)
+        full path output directory for the alpha image. If None, not saved.
+    img_ext: str (default "png")
+        Extension of the image file name to save as.
+
+    Returns
+    -------
+    fn, n_pix, seconds: (str, int, float)
+        The name of the file, the number of pixels converted and the time
+        taken.
+    """
+    t_start = time.perf_counter()
+    fn_short = os.path.splitext(fn)[0]
+
+    # Get access to this individual picture file within the zip
+    with ZipFile(source_zip, "r") as zipdat, zipdat.open(fn) as file:
+
+        # Read it in as a PIL object
+        with Image.open(file) as pic:
+            # Images have 4 layers (RGB + Infrared). Decode directly into a
+            # uint8 (height, width, 4) array.
+            a = np.asarray(pic)
 
+    # Separate RGB and Infrared channels and save each into a PNG file
+    # Layers 0-2 are RGB
+    im = Image.fromarray(a[:, :, :-1])
+    _save_atomic(im, os.path.join(rgb_dir, fn_short + "." + img_ext))
 
-def tif_to_png(tif_dir, overwrite=False, verbose=True, delete=False):
+    # Layer 3 is Infrared
+    if ir_dir is not None:
+        alpha = Image.fromarray(a[:, :, -1])
+        _save_atomic(alpha, os.path.join(ir_dir, fn_short + "." + img_ext))
+
+    return fn, a.shape[0] * a.shape[1], time.perf_counter() - t_start
+
+
+def _save_atomic(im, out_fn):
+    """
+    Save a PIL image under a hidden temporary name and then move it into
+    place, so that an interrupted save never leaves a partial output file.
+    """
+    tmp_fn = os.path.join(os.path.dirname(out_fn),
+                          "." + os.path.basename(out_fn))
+    im.save(tmp_fn)
+    os.replace(tmp_fn, out_fn)
+
+
+def _record_future(manifest_file, job, future, verbose=True):
+    """
+    Record the outcome of a conversion future in the manifest.
+    """
+    error = future.exception()
+    result = future.result() if error is None else error
+    _record_conversion(manifest_file, job, result, verbose)
+
+
+def _record_conversion(manifest_file, job, result, verbose=True):
+    """
+    Record the outcome of a single conversion in the manifest and report it.
+
+    Parameters
+    ----------
+    manifest_file: str
+        Full path of the manifest file
+    job: tuple
+        (source, size, signature, outputs) for the converted file
+    result: tuple or Exception
+        The (fn, n_pix, seconds) returned by the conversion, or the exception
+        raised if it failed.
+    verbose: bool (default True)
+        Print the status of the conversion?
+    """
+    source, size, signature, outputs = job
+    if isinstance(result, Exception):
+        print(f"Failed to convert {source}: {result}")
+        append_manifest(manifest_file, source, size, signature, outputs,
+                        status="failed")
+    else:
+        append_manifest(manifest_file, source, size, signature, outputs)
+        _report_throughput(*result, verbose=verbose)
+
+
+def _report_throughput(fn, n_pix, seconds, verbose=True):
+    """
+    Print a status line with the conversion rate of a single file.
+    """
+    if verbose:
+        rate = n_pix / max(seconds, 1e-9) / 1e6
+        print(f"{fn}: {n_pix / 1e6:.1f} Mpix in {seconds:.1f} s "
+              f"({rate:.1f} Mpix/s)")
+
+
+def tif_to_png(tif_dir, overwrite=False, verbose=True, delete=False,
+               manifest_file=None):
     """
     Convert a directory of tif images to pngs
 
@@ -102,23 +231,45 @@ def tif_to_png(tif_dir, overwrite=False, verbose=True, delete=False):
     tif_dir: str
         directory where tif images are stored
     overwrite: bool (default: False)
-        Overwrite, or skip if exists
+        Convert every file, even those the manifest shows as already done?
     verbose: bool (default: True)
         Print filenames while running
     delete: bool (default: False)
         Delete tif file when done?
+    manifest_file: str or None (default None)
+        Full path of the conversion manifest. Each converted file is recorded
+        along with its size and modification time, so that re-running only
+        converts files that are new, changed or unfinished. If None, it is
+        stored in tif_dir.
     """
+    if manifest_file is None:
+        manifest_file = os.path.join(tif_dir, MANIFEST_NAME)
+    manifest = read_manifest(manifest_file)
+
     fns = files_of_type(tif_dir, "*.tif")
     for fn in fns:
-        if verbose:
-            print(fn)
-        with Image.open(fn) as f:
-            pfn = fn.replace(".tif", ".png")
-            if os.path.exists(pfn) and not overwrite:
-                print(f"File exists, skipping: {pfn}")
+        source = os.path.basename(fn)
+        pfn = fn.replace(".tif", ".png")
+        stat = os.stat(fn)
+        signature = str(stat.st_mtime_ns)
+
+        if not overwrite and is_manifest_current(manifest.get(source),
+                                                 stat.st_size, signature, pfn):
+            if verbose:
+                print(f"Already converted, skipping: {pfn}")
+        else:
+            if verbose:
+                print(fn)
+            try:
+                with Image.open(fn) as f:
+                    _save_atomic(f, pfn)
+            except Exception as e:
+                print(f"Failed to convert {fn}: {e}")
+                append_manifest(manifest_file, source, stat.st_size, signature,
+                                pfn, status="failed")
                 continue
-            else:
-                f.save(pfn)
+            append_manifest(manifest_file, source, stat.st_size, signature,
+                            pfn)
 
         if delete:
             os.remove(fn)
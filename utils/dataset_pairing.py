@@ -0,0 +1,106 @@
+import os
+
+from utils.fileio import dir_index
+
+
+def scan_dir(search_dir, ext=None):
+    """
+    List the files in a directory, from the cached utils.fileio.dir_index().
+
+    Parameters
+    ----------
+    search_dir: str
+        full path of directory to scan
+    ext: str or None (default None)
+        File extension to keep, without the dot (e.g. "png"). If None, all
+        files are kept.
+
+    Returns
+    -------
+    dict mapping each file stem (name without extension) to its basename, in
+    directory order.
+    """
+    index = dir_index(search_dir)
+    if ext is None:
+        names = index["names"]
+    else:
+        ext = "." + ext
+        names = index["by_ext"].get(os.path.normcase(ext), [])
+
+    files = {}
+    for name in names:
+        if name.startswith(".") or name not in index["files"]:
+            continue
+        stem, this_ext = os.path.splitext(name)
+        if ext is not None and this_ext != ext:
+            continue
+        files.setdefault(stem, name)
+    return files
+
+
+def pair_datasets(img_dir, mask_dir, img_ext="png", mask_ext=None):
+    """
+    Match up the image and mask files of a dataset by their file stems, and
+    find any orphans in either direction.
+
+    Parameters
+    ----------
+    img_dir: str
+        Full path to directory containing the images
+    mask_dir: str
+        Full path to directory containing the masks
+    img_ext: str (default "png")
+        The file extension of the images
+    mask_ext: str or None (default None)
+        The file extension of the masks. If None, masks with any extension are
+        matched.
+
+    Returns
+    -------
+    pairs: list[tuple]
+        (image basename, mask basename) for each matched pair, in the
+        directory order of img_dir
+    img_only: list[str]
+        basenames of images with no mask
+    mask_only: list[str]
+        basenames of masks with no image
+    """
+    imgs = scan_dir(img_dir, img_ext)
+    masks = scan_dir(mask_dir, mask_ext)
+
+    pairs = [(name, masks[stem]) for stem, name in imgs.items()
+             if stem in masks]
+    img_only = [name for stem, name in imgs.items() if stem not in masks]
+    mask_only = [name for stem, name in masks.items() if stem not in imgs]
+
+    return pairs, img_only, mask_only
+
+
+def remove_files(target_dir, names, dry_run=False, verbose=False):
+    """
+    Delete a batch of files from a directory. Caution! Files will be deleted!
+
+    Parameters
+    ----------
+    target_dir: str
+        Full path of the directory
+    names: iterable[str]
+        basenames of the files to delete
+    dry_run: bool (default False)
+        If True, only report what would be deleted.
+    verbose: bool (default False)
+        Print each file that is deleted?
+
+    Returns
+    -------
+    list[str] of the full paths of the deleted files
+    """
+    removed = []
+    for name in names:
+        fn = os.path.join(target_dir, name)
+        if verbose or dry_run:
+            print(("Would delete: " if dry_run else "Deleting: ") + fn)
+        if not dry_run:
+            os.remove(fn)
+        removed.append(fn)
+    return removed
@@ -4,9 +4,13 @@ from PIL import Image
 import numpy as np
 
 from utils.fileio import files_of_type
+from utils.dataset_pairing import pair_datasets, remove_files
+from utils.tile_stats import read_tile_stats, write_tile_stats, \
+    filter_tile_stats, blank_tiles
 
 
-def delete_blank_tiles(img_dir, mask_dir, maxfrac=0, seed=None, img_ext="png"):
+def delete_blank_tiles(img_dir, mask_dir, maxfrac=0, seed=None, img_ext="png",
+                       stats_file=None, dry_run=False):
     """
     Look at a combined dataset of label masks and corresponding images. Find
     the masks that are blank and remove them from both parts of the dataset.
@@ -28,20 +32,44 @@ def delete_blank_tiles(img_dir, mask_dir, maxfrac=0, seed=None, img_ext="png"):
     seed: int (default None)
         A random seed that can be set to produce repeatable data. Caution! This
         will affect the global numpy.random.seed()!
+    stats_file: str (default None)
+        Full path of a tile statistics index for the masks (see
+        utils.tile_stats). If it exists, blank tiles are found from the index
+        and only masks missing from the index are opened. The dropped tiles
+        are removed from it. If None or missing, every mask is opened to check
+        for blanks.
+    dry_run: bool (default False)
+        If True, only report the files that would be deleted.
     """
 
-    # Get a list of all files in each location
+    # Get a list of all the masks
     maskfns = files_of_type(mask_dir, "*." + img_ext)
-    imgfns = files_of_type(mask_dir, "*." + img_ext)
 
     # Require that all the masks have a corresponding image file
-    imgs = [os.path.basename(f) for f in imgfns]
-    if not all(os.path.basename(fn) in imgs for fn in maskfns):
-        raise ValueError("All mask files must have a matching image file.")
+    _, _, mask_only = pair_datasets(img_dir, mask_dir, img_ext, img_ext)
+    if len(mask_only) > 0:
+        raise ValueError("All mask files must have a matching image file. "
+                         f"{len(mask_only)} masks have no image, e.g. "
+                         f"{mask_only[0]}")
 
     # Idenfity blank masks
     blanks = []
-    for fn in maskfns:
+    if stats_file is not None and os.path.exists(stats_file):
+        stats = read_tile_stats(stats_file)
+        indexed = set(str(n) for n in stats["name"])
+        blank_names = set(blank_tiles(stats))
+        blanks = [fn for fn in maskfns
+                  if os.path.basename(fn) in blank_names]
+        # Masks added since the index was written have to be opened
+        unindexed = [fn for fn in maskfns
+                     if os.path.basename(fn) not in indexed]
+        if len(unindexed) > 0:
+            print(f"{len(unindexed)} masks are missing from the tile "
+                  "statistics index, checking them directly.")
+    else:
+        stats = None
+        unindexed = maskfns
+    for fn in unindexed:
         with Image.open(fn) as img:
             if not img.getbbox():
                 blanks.append(fn)
@@ -55,19 +83,24 @@ def delete_blank_tiles(img_dir, mask_dir, maxfrac=0, seed=None, img_ext="png"):
         # choose files to drop
         if seed is not None:
             np.random.seed(seed)
-        keeps = np.random.choice(blanks, nkeep, replace=False)
-        drops = list(filter(lambda x: x not in keeps, blanks))  # NOT keeps
+        keeps = set(np.random.choice(blanks, nkeep, replace=False))
+        drops = [x for x in blanks if x not in keeps]  # NOT keeps
 
         # Drop the file from both locations
-        for f in drops:
-            basefn = os.path.basename(f)
+        dropped = set(os.path.basename(f) for f in drops)
+        remove_files(mask_dir, dropped, dry_run)
+        remove_files(img_dir, dropped, dry_run)
 
-            os.remove(os.path.join(mask_dir, basefn))
+        align_datasets(mask_dir, img_dir, img_ext, dry_run)
 
-        align_datasets(mask_dir, img_dir)
+        # Keep the index in step with the files
+        if stats is not None and not dry_run:
+            keep_names = [n for n in stats["name"] if n not in dropped]
+            write_tile_stats(stats_file,
+                             *filter_tile_stats(stats, keep_names))
 
 
-def align_datasets(folder_a, folder_b, img_ext="png"):
+def align_datasets(folder_a, folder_b, img_ext="png", dry_run=False):
     """
     Take two folders, search through and delete any files that appear in only
     one. Caution! Files will be deleted!
@@ -80,23 +113,21 @@ def align_datasets(folder_a, folder_b, img_ext="png"):
         Full path to second folder
     img_ext: str (default "png")
         The extension of the filetype to look for
-    """
+    dry_run: bool (default False)
+        If True, only report the files that would be deleted.
 
-    # Get a list of all files in each location
-    fns_a = files_of_type(folder_a, "*." + img_ext)
-    fns_b = files_of_type(folder_b, "*." + img_ext)
-
-    bns_a = [os.path.basename(f) for f in fns_a]
-    bns_b = [os.path.basename(f) for f in fns_b]
+    Returns
+    -------
+    only_a, only_b: (list[str], list[str])
+        Full paths of the files that were only in folder_a and only in folder_b
+    """
+    _, only_a, only_b = pair_datasets(folder_a, folder_b, img_ext, img_ext)
 
     # remove in each direction
-    for fn in fns_a:
-        if os.path.basename(fn) not in bns_b:
-            os.remove(fn)
+    only_a = remove_files(folder_a, only_a, dry_run)
+    only_b = remove_files(folder_b, only_b, dry_run)
 
-    for fn in fns_b:
-        if os.path.basename(fn) not in bns_a:
-            os.remove(fn)
+    return only_a, only_b
 
 
 # Sample run
@@ -1,6 +1,10 @@
 import os
+import re
+import csv
 import glob
+import time
 import shutil
+import fnmatch
 
 
 def verify_dir(target_dir):
@@ -60,9 +64,72 @@ def is_dir_empty(test_dir):
         return True
 
 
+# Search strings of the form "*.ext" are looked up by extension
+_EXT_PATTERN = re.compile(r"\*(\.[^.*?\[\]]+)")
+
+# A directory modified this close to the time it was scanned is scanned again on the next call, since file systems
+# with coarse timestamps can hide a change made in the same tick as the scan.
+DIR_INDEX_RACY_NS = 2 * 10**9
+
+_dir_index_cache = {}
+
+
+def dir_index(search_dir):
+    """
+    List a directory with a single os.scandir pass, grouped by extension and stem. The index is cached and reused
+    until the modification time of the directory changes, i.e. until entries are added, removed or renamed, so
+    repeated lookups in large directories (e.g. on network shares) only cost one stat.
+
+    Parameters
+    ----------
+    search_dir: str
+        full path of directory to scan
+
+    Returns
+    -------
+    dict with keys
+        names: list[str] of all entry names, in directory order
+        files: set[str] of the names that are files
+        by_ext: dict of extension (e.g. ".png", normalized with os.path.normcase) to names, in directory order
+        by_stem: dict of stem (name without extension) to names, in directory order
+    The index is shared between callers and must not be modified.
+    """
+    key = os.path.abspath(search_dir)
+    mtime = os.stat(key).st_mtime_ns
+    cached = _dir_index_cache.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    scan_start = time.time_ns()
+    index = {"names": [], "files": set(), "by_ext": {}, "by_stem": {}}
+    with os.scandir(key) as it:
+        for entry in it:
+            index["names"].append(entry.name)
+            if entry.is_file():
+                index["files"].add(entry.name)
+            stem, ext = os.path.splitext(entry.name)
+            index["by_ext"].setdefault(os.path.normcase(ext), []).append(entry.name)
+            index["by_stem"].setdefault(stem, []).append(entry.name)
+
+    if scan_start - mtime > DIR_INDEX_RACY_NS:
+        _dir_index_cache[key] = (mtime, index)
+    else:
+        _dir_index_cache.pop(key, None)
+    return index
+
+
+def clear_dir_index():
+    """
+    Forget all cached directory indexes, e.g. after changing files in a way that doesn't update the directory's
+    modification time.
+    """
+    _dir_index_cache.clear()
+
+
 def files_of_type(search_dir, search_str, fullpath=True):
     """
-    Get all files in a directory that match a search string
+    Get all files in a directory that match a search string. Same results and order as glob.glob, but read from the
+    cached dir_index(), so repeated calls on the same directory don't list it again.
 
     Parameters
     ----------
@@ -77,10 +144,29 @@ def files_of_type(search_dir, search_str, fullpath=True):
     -------
         List of all files in the dir matching the search string
     """
+    if glob.has_magic(search_dir) or os.sep in search_str or "/" in search_str:
+        # Patterns spanning directories are left to glob
+        found = glob.glob(os.path.join(search_dir, search_str))
+        return found if fullpath else [os.path.basename(f) for f in found]
+
+    try:
+        index = dir_index(search_dir)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+    ext_match = _EXT_PATTERN.fullmatch(search_str)
+    if ext_match:
+        names = index["by_ext"].get(os.path.normcase(ext_match.group(1)), [])
+    else:
+        names = fnmatch.filter(index["names"], search_str)
+    if not search_str.startswith("."):
+        # glob skips hidden files unless the pattern asks for them
+        names = [n for n in names if not n.startswith(".")]
+
     if fullpath:
-        return [f for f in glob.glob(os.path.join(search_dir, search_str))]
+        return [os.path.join(search_dir, n) for n in names]
     else:
-        return [os.path.basename(f) for f in glob.glob(os.path.join(search_dir, search_str))]
+        return list(names)
 
 
 def read_file_list(source_file, base_dir=None):
@@ -91,4 +177,169 @@ def read_file_list(source_file, base_dir=None):
             if base_dir is not None:
                 fix = os.path.join(base_dir, fix)
             mylist.append(fix)
-    return mylist
\ No newline at end of file
+    return mylist
+
+
+MANIFEST_COLS = ["source", "size", "signature", "output", "status"]
+
+
+def read_manifest(manifest_file):
+    """
+    Read a conversion manifest written by append_manifest. The manifest is an
+    append-only CSV log, so if a source appears more than once, the last entry
+    wins.
+
+    Parameters
+    ----------
+    manifest_file: str
+        Full path of the manifest file
+
+    Returns
+    -------
+    dict keyed by source, each value a dict with keys from MANIFEST_COLS.
+    Empty if the manifest file doesn't exist.
+    """
+    entries = {}
+    if not os.path.exists(manifest_file):
+        return entries
+    with open(manifest_file, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            entries[row["source"]] = row
+    return entries
+
+
+def append_manifest(manifest_file, source, size, signature, output,
+                    status="done"):
+    """
+    Append a single entry to a conversion manifest. Entries are written one at
+    a time so that the manifest is always up to date if a job dies part way.
+
+    Parameters
+    ----------
+    manifest_file: str
+        Full path of the manifest file. Created if it doesn't exist.
+    source: str
+        Name of the source file
+    size: int
+        Size of the source file in bytes
+    signature: str
+        Any string identifying the source contents (e.g. CRC or mtime)
+    output: str or list[str]
+        Output file(s) generated from the source
+    status: str (default "done")
+        Status of the conversion, e.g. "done" or "failed"
+    """
+    if not isinstance(output, str):
+        output = ";".join(output)
+    new_file = not os.path.exists(manifest_file)
+    with open(manifest_file, "a", newline="") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(MANIFEST_COLS)
+        writer.writerow([source, size, signature, output, status])
+
+
+def is_manifest_current(entry, size, signature, output):
+    """
+    Check if a manifest entry shows a source as already converted, unchanged
+    since it was converted and with all of its outputs still in place.
+
+    Parameters
+    ----------
+    entry: dict or None
+        A single entry returned by read_manifest. None if no entry exists.
+    size: int
+        Current size of the source file in bytes
+    signature: str
+        Current signature of the source file
+    output: str or list[str]
+        Output file(s) that should exist
+
+    Returns
+    -------
+    bool: True if the source can be skipped
+    """
+    if entry is None or entry["status"] != "done":
+        return False
+    if isinstance(output, str):
+        output = [output]
+    return (entry["size"] == str(size) and
+            entry["signature"] == signature and
+            entry["output"] == ";".join(output) and
+            all(os.path.exists(f) for f in output))
+
+
+def file_signature(fn):
+    """
+    Fingerprint of a file from its size and modification time, so that any
+    rewrite of the file changes it without reading the contents.
+
+    Parameters
+    ----------
+    fn: str
+        Full path of the file
+
+    Returns
+    -------
+    str: "size:mtime_ns"
+    """
+    st = os.stat(fn)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def cell_file_for(out_file):
+    """
+    Name of the cell cache kept next to a postprocess output file, e.g.
+    summary.xlsx keeps its cells in summary_cells.csv.
+    """
+    return os.path.splitext(out_file)[0] + "_cells.csv"
+
+
+def read_cells(cell_file, key_cols):
+    """
+    Read a cell cache written by append_cells. Like the conversion manifest
+    it is an append-only CSV log, so if a key appears more than once, the
+    last entry wins.
+
+    Parameters
+    ----------
+    cell_file: str
+        Full path of the cell cache
+    key_cols: list[str]
+        Columns that together identify a cell
+
+    Returns
+    -------
+    dict keyed by tuples of the key column values, each value a dict of the
+    row with all values as strings. Empty if the file doesn't exist.
+    """
+    cells = {}
+    if not os.path.exists(cell_file):
+        return cells
+    with open(cell_file, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            cells[tuple(row[c] for c in key_cols)] = row
+    return cells
+
+
+def append_cells(cell_file, rows, cols):
+    """
+    Append computed cells to a cell cache. Cells are appended as soon as
+    they are computed so that the cache is up to date if a job dies part
+    way.
+
+    Parameters
+    ----------
+    cell_file: str
+        Full path of the cell cache. Created if it doesn't exist.
+    rows: list[dict]
+        Cells to append, each with a value for every column in cols
+    cols: list[str]
+        Columns of the cache, in order
+    """
+    new_file = not os.path.exists(cell_file)
+    with open(cell_file, "a", newline="") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(cols)
+        writer.writerows([[row[c] for c in cols] for row in rows])
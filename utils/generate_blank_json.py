@@ -5,7 +5,7 @@ from PIL import Image
 from utils.fileio import files_of_type
 
 
-def generate_blank_json_file(json_file, shape):
+def generate_blank_json_file(json_file, shape, img_ext=".png"):
     """
     Create a blank JSON file consistent with the structure of labelme outputs.
 
@@ -15,13 +15,15 @@ def generate_blank_json_file(json_file, shape):
         Full path to the json file that should be created
     shape: tuple
         The (height, width) of the image
+    img_ext: str (default ".png")
+        File extension of the image the JSON describes
     """
     with open(json_file, "w") as file:
         data = {
             "version": "5.0.1",
             "flags": {},
             "shapes": [],
-            "imagePath": os.path.basename(json_file).replace(".json", ".png"),
+            "imagePath": os.path.basename(json_file).replace(".json", img_ext),
             "imageData": None,
             "imageHeight": shape[1],
             "imageWidth": shape[0]
@@ -60,7 +62,7 @@ def generate_blank_json_dir(target_dir, json_dir=None, img_ext=".png"):
             # Get the size of the existing image
             with Image.open(f) as im:
                 shape = im.size
-            generate_blank_json_file(jsonfn, shape)
+            generate_blank_json_file(jsonfn, shape, img_ext)
 
 
 # Example directory for testing
@@ -3,6 +3,9 @@ import os
 import math
 import uuid
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed
 
 import numpy as np
 
@@ -41,30 +44,55 @@ def shape_to_mask(img_shape, points, shape_type=None,
     mask = np.zeros(img_shape[:2], dtype=np.uint8)
     mask = PIL.Image.fromarray(mask)
     draw = PIL.ImageDraw.Draw(mask)
+    draw_shape(draw, points, shape_type, 1, line_width, point_size)
+    mask = np.array(mask, dtype=bool)
+    return mask
+
+
+def draw_shape(draw, points, shape_type=None, fill=1,
+               line_width=10, point_size=5):
+    """
+    Draw a fundamental shape from a labelme file onto an existing canvas. Only
+    the pixels covered by the shape are touched, so many shapes can share the
+    same canvas.
+
+    Parameters
+    ----------
+    draw: PIL.ImageDraw.ImageDraw
+        Drawing context of the canvas
+    points: list
+        List of points making up the shape
+    shape_type: str
+        Type of the shape
+    fill: int (default 1)
+        Value to write into the pixels covered by the shape
+    line_width: int
+        Width of the line (used only for certain types)
+    point_size: int
+        Size of point, used only for certain types
+    """
     xy = [tuple(point) for point in points]
     if shape_type == "circle":
         assert len(xy) == 2, "Shape of shape_type=circle must have 2 points"
         (cx, cy), (px, py) = xy
         d = math.sqrt((cx - px) ** 2 + (cy - py) ** 2)
-        draw.ellipse([cx - d, cy - d, cx + d, cy + d], outline=1, fill=1)
+        draw.ellipse([cx - d, cy - d, cx + d, cy + d], outline=fill, fill=fill)
     elif shape_type == "rectangle":
         assert len(xy) == 2, "Shape of shape_type=rectangle must have 2 points"
-        draw.rectangle(xy, outline=1, fill=1)
+        draw.rectangle(xy, outline=fill, fill=fill)
     elif shape_type == "line":
         assert len(xy) == 2, "Shape of shape_type=line must have 2 points"
-        draw.line(xy=xy, fill=1, width=line_width)
+        draw.line(xy=xy, fill=fill, width=line_width)
     elif shape_type == "linestrip":
-        draw.line(xy=xy, fill=1, width=line_width)
+        draw.line(xy=xy, fill=fill, width=line_width)
     elif shape_type == "point":
         assert len(xy) == 1, "Shape of shape_type=point must have 1 points"
         cx, cy = xy[0]
         r = point_size
-        draw.ellipse([cx - r, cy - r, cx + r, cy + r], outline=1, fill=1)
+        draw.ellipse([cx - r, cy - r, cx + r, cy + r], outline=fill, fill=fill)
     else:
         assert len(xy) > 2, "Polygon must have points more than 2"
-        draw.polygon(xy=xy, outline=1, fill=1)
-    mask = np.array(mask, dtype=bool)
-    return mask
+        draw.polygon(xy=xy, outline=fill, fill=fill)
 
 
 def shapes_to_label(img_shape, shapes, label_name_to_value, layer_order=None):
@@ -93,6 +121,33 @@ def shapes_to_label(img_shape, shapes, label_name_to_value, layer_order=None):
 
     """
 
+    layer_order = _resolve_layer_order(label_name_to_value, layer_order)
+
+    # All shapes are drawn in layer order onto a single shared canvas for each
+    # output. Each shape only touches its own pixels, and later layers
+    # overwrite earlier ones exactly like cls[mask] = cls_id would.
+    cls_canvas = PIL.Image.new("I", (img_shape[1], img_shape[0]), 0)
+    ins_canvas = PIL.Image.new("I", (img_shape[1], img_shape[0]), 0)
+    cls_draw = PIL.ImageDraw.Draw(cls_canvas)
+    ins_draw = PIL.ImageDraw.Draw(ins_canvas)
+    instances = []
+    for shape in sorted(shapes, key=lambda x: layer_order.index(x["label"])):
+        cls_id, ins_id = _shape_ids(shape, label_name_to_value, instances)
+        shape_type = shape.get("shape_type", None)
+
+        draw_shape(cls_draw, shape["points"], shape_type, fill=cls_id)
+        draw_shape(ins_draw, shape["points"], shape_type, fill=ins_id)
+
+    cls = np.array(cls_canvas, dtype=np.int32)
+    ins = np.array(ins_canvas, dtype=np.int32)
+
+    return cls, ins
+
+
+def _resolve_layer_order(label_name_to_value, layer_order=None):
+    """
+    Fill in the layer order used by shapes_to_label.
+    """
     if layer_order is None:
         # Default to increasing numeric value
         layer_order = sorted(label_name_to_value.keys(), key=lambda x: label_name_to_value[x])
@@ -101,33 +156,98 @@ def shapes_to_label(img_shape, shapes, label_name_to_value, layer_order=None):
         for key in label_name_to_value.keys():
             if key not in layer_order:
                 layer_order.insert(0, key)
+    return layer_order
+
 
+def _shape_ids(shape, label_name_to_value, instances):
+    """
+    Get the class id and instance id of a labelme shape. instances is a list
+    of the (label, group_id) pairs seen so far and is updated in place.
+    """
+    label = shape["label"]
+    group_id = shape.get("group_id")
+    if group_id is None:
+        group_id = uuid.uuid1()
+
+    instance = (label, group_id)
+    if instance not in instances:
+        instances.append(instance)
+    ins_id = instances.index(instance) + 1
+    cls_id = label_name_to_value[label]
+    return cls_id, ins_id
+
+
+def _shapes_to_label_masks(img_shape, shapes, label_name_to_value,
+                           layer_order=None):
+    """
+    Reference implementation of shapes_to_label that builds a full size mask
+    for every shape. Kept for benchmark_shapes_to_label.
+    """
+    layer_order = _resolve_layer_order(label_name_to_value, layer_order)
     cls = np.zeros(img_shape[:2], dtype=np.int32)
     ins = np.zeros_like(cls)
     instances = []
     for shape in sorted(shapes, key=lambda x: layer_order.index(x["label"])):
-        points = shape["points"]
-        label = shape["label"]
-        group_id = shape.get("group_id")
-        if group_id is None:
-            group_id = uuid.uuid1()
-        shape_type = shape.get("shape_type", None)
-
-        cls_name = label
-        instance = (cls_name, group_id)
-
-        if instance not in instances:
-            instances.append(instance)
-        ins_id = instances.index(instance) + 1
-        cls_id = label_name_to_value[cls_name]
-
-        mask = shape_to_mask(img_shape[:2], points, shape_type)
+        cls_id, ins_id = _shape_ids(shape, label_name_to_value, instances)
+        mask = shape_to_mask(img_shape[:2], shape["points"],
+                             shape.get("shape_type", None))
         cls[mask] = cls_id
         ins[mask] = ins_id
 
     return cls, ins
 
 
+def benchmark_shapes_to_label(json_files, label_name_to_value,
+                              layer_order=None, repeats=3):
+    """
+    Time shapes_to_label against the per-shape mask reference implementation
+    and check that both produce identical masks.
+
+    Parameters
+    ----------
+    json_files: list[str]
+        labelme generated JSON shape files to rasterize
+    label_name_to_value: dict
+        a dict connecting polygon label names to the numeric id that should be
+        displayed in the output array
+    layer_order: list (default None)
+        A list of the layer order using the keys in label_name_to_value.
+    repeats: int (default 3)
+        Number of times to rasterize each file. Best time is reported.
+
+    Returns
+    -------
+    t_canvas, t_masks: (float, float)
+        Best total time in seconds for shapes_to_label and for the reference
+    """
+    datas = []
+    for json_file in json_files:
+        imshape, shapes, value_pairs = _read_labelme_shapes(json_file,
+                                                            label_name_to_value)
+        order = None if layer_order is None else list(layer_order)
+        datas.append((imshape, shapes, value_pairs, order))
+
+    t_canvas = t_masks = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        new = [shapes_to_label(*d) for d in datas]
+        t1 = time.perf_counter()
+        ref = [_shapes_to_label_masks(*d) for d in datas]
+        t2 = time.perf_counter()
+        t_canvas = min(t_canvas, t1 - t0)
+        t_masks = min(t_masks, t2 - t1)
+
+        for fn, a, b in zip(json_files, new, ref):
+            if not (np.array_equal(a[0], b[0]) and
+                    np.array_equal(a[1], b[1])):
+                raise AssertionError(f"Masks do not match for {fn}")
+
+    print(f"shapes_to_label: {t_canvas:.3f} s, "
+          f"per-shape masks: {t_masks:.3f} s "
+          f"({t_masks / max(t_canvas, 1e-9):.1f}x)")
+    return t_canvas, t_masks
+
+
 def labelme_json_to_binary(json_file, mask_dir, label_name_to_value, layer_order=None,
                            img_ext="png", overwrite=False):
     """
@@ -171,7 +291,143 @@ def labelme_json_to_binary(json_file, mask_dir, label_name_to_value, layer_order
         else:
             os.remove(out_fn)
 
-    data = json.load(open(json_file))
+    lbl = labelme_json_to_array(json_file, label_name_to_value, layer_order)
+    lbl_pil = PIL.Image.fromarray(lbl, mode="P")
+
+    # Generate the output filename
+    lbl_pil.save(out_fn)
+
+
+def labelme_json_dir_to_binary(json_dir, mask_dir, label_name_to_value,
+                               layer_order=None, img_ext="png",
+                               overwrite=False, n_workers=None, verbose=True):
+    """
+    Convert a whole directory of labelme JSON files into binary image masks.
+    See labelme_json_to_binary for details of the conversion.
+
+    Masks that are newer than their JSON file are skipped, so editing a few
+    labels and re-running only regenerates the masks that changed.
+
+    Parameters
+    ----------
+    json_dir: str
+        Full path to the directory of labelme generated JSON shape files.
+    mask_dir: str
+        Full path to the file output directory. Output will be PNG file
+    label_name_to_value: dict
+        a dict connecting polygon label names to the numeric id that should be
+        displayed in the output array
+    layer_order: list
+        A list of the layer order using the keys in label_name_to_value.
+        Must match keys in label_name_to_value. If None, uses numeric value to sort
+    img_ext: str (default "png")
+        str of the file extension for the output image.
+    overwrite: bool (default False)
+        Regenerate all masks, even those newer than their JSON file?
+    n_workers: int or None (default None)
+        Number of worker processes. If None or 1, files are converted in the
+        current process.
+    verbose: bool (default True)
+        Print a summary when done?
+
+    Returns
+    -------
+    summary: dict
+        Lists of the JSON files that were "converted", "skipped" and "failed"
+    """
+    verify_dir(mask_dir)
+
+    summary = {"converted": [], "skipped": [], "failed": []}
+    jobs = []
+    for json_file in files_of_type(json_dir, "*.json"):
+        out_fn = os.path.basename(json_file).replace(".json", "." + img_ext)
+        out_fn = os.path.join(mask_dir, out_fn)
+        if not overwrite and os.path.exists(out_fn) and \
+                os.path.getmtime(out_fn) >= os.path.getmtime(json_file):
+            summary["skipped"].append(json_file)
+        else:
+            jobs.append((json_file, out_fn))
+
+    if n_workers is None or n_workers <= 1:
+        for json_file, out_fn in jobs:
+            try:
+                _json_to_mask_file(json_file, out_fn, label_name_to_value,
+                                   layer_order)
+                summary["converted"].append(json_file)
+            except Exception as e:
+                print(f"Failed to convert {json_file}: {e}")
+                summary["failed"].append(json_file)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(_json_to_mask_file, json_file, out_fn,
+                                   label_name_to_value, layer_order): json_file
+                       for json_file, out_fn in jobs}
+            for future in as_completed(futures):
+                json_file = futures[future]
+                if future.exception() is None:
+                    summary["converted"].append(json_file)
+                else:
+                    print(f"Failed to convert {json_file}: "
+                          f"{future.exception()}")
+                    summary["failed"].append(json_file)
+
+    if verbose:
+        print(f"Masks converted: {len(summary['converted'])}, "
+              f"skipped: {len(summary['skipped'])}, "
+              f"failed: {len(summary['failed'])}")
+
+    return summary
+
+
+def _json_to_mask_file(json_file, out_fn, label_name_to_value,
+                       layer_order=None):
+    """
+    Convert a single labelme JSON file to a mask file. Used as the unit of
+    work for labelme_json_dir_to_binary.
+    """
+    if layer_order is not None:
+        layer_order = list(layer_order)  # shapes_to_label may add to it
+    lbl = labelme_json_to_array(json_file, label_name_to_value, layer_order)
+    PIL.Image.fromarray(lbl, mode="P").save(out_fn)
+
+
+def labelme_json_to_array(json_file, label_name_to_value, layer_order=None):
+    """
+    Takes a JSON file generated by labelme and converts it to a mask array
+    without writing it to disk.
+
+    Parameters
+    ----------
+    json_file: str
+        Path to the labelme generated JSON shape file.
+    label_name_to_value: dict
+        a dict connecting polygon label names to the numeric id that should be
+        displayed in the output array
+    layer_order: list
+        A list of the layer order using the keys in label_name_to_value.
+        Must match keys in label_name_to_value. If None, uses numeric value to sort
+
+    Returns
+    -------
+    lbl: np.array
+        uint8 mask array of shape (height, width)
+    """
+    imshape, shapes, value_pairs = _read_labelme_shapes(json_file,
+                                                        label_name_to_value)
+
+    # Convert shapes to mask
+    lbl, _ = shapes_to_label(imshape, shapes, value_pairs, layer_order)
+    return lbl.astype(np.uint8)
+
+
+def _read_labelme_shapes(json_file, label_name_to_value):
+    """
+    Read the image shape and list of shapes from a labelme JSON file. Returns
+    a copy of label_name_to_value with numeric values added for any labels
+    that are missing from it.
+    """
+    with open(json_file) as f:
+        data = json.load(f)
     imshape = (data['imageHeight'], data['imageWidth'])
 
     # Create numeric label values for any labels not in label_name_to_value
@@ -182,15 +438,11 @@ def labelme_json_to_binary(json_file, mask_dir, label_name_to_value, layer_order
             label_value = len(value_pairs)
             value_pairs[label_name] = label_value
 
-    # Convert shapes to mask
-    lbl, _ = shapes_to_label(imshape, data["shapes"], value_pairs, layer_order)
-    lbl_pil = PIL.Image.fromarray(lbl.astype(np.uint8), mode="P")
+    return imshape, data["shapes"], value_pairs
 
-    # Generate the output filename
-    lbl_pil.save(out_fn)
 
-
-def cal_to_labelme(img_list, dataset_json, dataset_csv):
+def cal_to_labelme(img_list, dataset_json, dataset_csv, index_file=None,
+                   n_workers=None):
     """
     Convert shape notation files from the California dataset to labelme shape
     files.
@@ -207,15 +459,18 @@ def cal_to_labelme(img_list, dataset_json, dataset_csv):
         searchable map between filename and polygon info.
     img_list: list
         A list of filenames of the images to process
+    index_file: str or None (default None)
+        Location of a sidecar cache for the index built from dataset_csv. If
+        given, the index is read from here when it is newer than dataset_csv
+        and saved here otherwise. If None, the index is rebuilt every call.
+    n_workers: int or None (default None)
+        Number of threads used to write the JSON files. If None or 1, files
+        are written one at a time.
 
     Returns
     -------
 
     """
-    imname_col = 9
-    rawnumcol = 0
-    idcol = 1
-
     width = height = None
 
     with open(dataset_json) as f:
@@ -226,60 +481,123 @@ def cal_to_labelme(img_list, dataset_json, dataset_csv):
     # data[rownum]['polygon_id'] is the id
     # data[rownum]['polygon_vertices_pixels'] is the shape
 
-    for imname in img_list:
-        imname_base = os.path.basename(imname)
-
-        # Search the CSV file for polygons that go with this image. Extract the
-        # polygon row number and ID number.
-        poly_nums = []
-        poly_ids = []
-        with open(dataset_csv) as f:
-            rd = csv.reader(f)
-            for row in rd:
-                if row[imname_col] == os.path.splitext(imname_base)[0]:
-                    poly_nums.append(int(row[rawnumcol]))
-                    poly_ids.append(int(row[idcol]))
-
-        # Use the extracted polygon info from the CSV to get the vertices from
-        # the JSON file. Build into a list of polygons
-        shapes = []
-        for poly_num, poly_id in zip(poly_nums, poly_ids):
-            assert data[poly_num]["polygon_id"] == poly_id
-            this_shape = data[poly_num]['polygon_vertices_pixels']
-            if np.size(this_shape) > 4:  # Must have more than 2 pts
-                shapes.append(this_shape)
-
-        # Build a labelme compatible dict for each shape.
-        shapelist = []
-        for shape in shapes:
-            shapedata = {
-                "label": "pv",
-                "points": shape,
-                "group_id": None,
-                "shape_type": "polygon",
-                "flags": {}
-            }
-            shapelist.append(shapedata)
-
-        # Get the image dimensions if they haven't been set yet
-        if width is None or height is None:
-            with PIL.Image.open(imname) as im:
-                width, height = im.size
-
-        # Create a labelme json and insert all the data. Save it.
-        json_file = imname.replace(".png", ".json")
-        with open(json_file, "w") as file:
-            labelme_json = {
-                "version": "5.0.1",
-                "flags": {},
-                "shapes": shapelist,
-                "imagePath": imname_base,
-                "imageData": None,
-                "imageHeight": height,
-                "imageWidth": width
-            }
-            json_str = json.dumps(labelme_json, indent=2)
-            file.write(json_str)
+    # Map from image name to the polygon row numbers and IDs, built once
+    index = build_cal_index(dataset_csv, index_file)
+
+    # Get the image dimensions (all images in the dataset share a size)
+    if len(img_list) > 0:
+        with PIL.Image.open(img_list[0]) as im:
+            width, height = im.size
+
+    if n_workers is None or n_workers <= 1:
+        for imname in img_list:
+            _write_cal_labelme(imname, index, data, width, height)
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(_write_cal_labelme, imname, index, data,
+                                   width, height) for imname in img_list]
+            for future in futures:
+                future.result()
+
+
+def build_cal_index(dataset_csv, index_file=None):
+    """
+    Build an index of the California dataset polygons by image in a single
+    pass through "polygonDataExceptVertices.csv".
+
+    Parameters
+    ----------
+    dataset_csv: str
+        Location of "polygonDataExceptVertices.csv".
+    index_file: str or None (default None)
+        Location of a JSON sidecar cache for the index. Read if it is newer
+        than dataset_csv, written otherwise. If None, no cache is used.
+
+    Returns
+    -------
+    index: dict
+        Keyed by image name (no extension), values are lists of
+        [polygon row number, polygon ID] for that image.
+    """
+    if index_file is not None and os.path.exists(index_file) and \
+            os.path.getmtime(index_file) >= os.path.getmtime(dataset_csv):
+        with open(index_file) as f:
+            return json.load(f)
+
+    imname_col = 9
+    rawnumcol = 0
+    idcol = 1
+
+    index = {}
+    with open(dataset_csv) as f:
+        rd = csv.reader(f)
+        for row in rd:
+            if not row[rawnumcol].strip().isdigit():  # Header row
+                continue
+            index.setdefault(row[imname_col], []).append(
+                [int(row[rawnumcol]), int(row[idcol])])
+
+    if index_file is not None:
+        with open(index_file, "w") as f:
+            json.dump(index, f)
+
+    return index
+
+
+def _write_cal_labelme(imname, index, data, width, height):
+    """
+    Write the labelme JSON file for a single image of the California dataset.
+
+    Parameters
+    ----------
+    imname: str
+        Full path of the image
+    index: dict
+        Output of build_cal_index()
+    data: list
+        The 'polygons' from "SolarArrayPolygons.json"
+    width: int
+        Image width
+    height: int
+        Image height
+    """
+    imname_base = os.path.basename(imname)
+
+    # Use the polygon info from the index to get the vertices from the JSON
+    # file. Build into a list of polygons
+    shapes = []
+    for poly_num, poly_id in index.get(os.path.splitext(imname_base)[0], []):
+        assert data[poly_num]["polygon_id"] == poly_id
+        this_shape = data[poly_num]['polygon_vertices_pixels']
+        if np.size(this_shape) > 4:  # Must have more than 2 pts
+            shapes.append(this_shape)
+
+    # Build a labelme compatible dict for each shape.
+    shapelist = []
+    for shape in shapes:
+        shapedata = {
+            "label": "pv",
+            "points": shape,
+            "group_id": None,
+            "shape_type": "polygon",
+            "flags": {}
+        }
+        shapelist.append(shapedata)
+
+    # Create a labelme json and insert all the data. Save it.
+    json_file = os.path.splitext(imname)[0] + ".json"
+    with open(json_file, "w") as file:
+        labelme_json = {
+            "version": "5.0.1",
+            "flags": {},
+            "shapes": shapelist,
+            "imagePath": imname_base,
+            "imageData": None,
+            "imageHeight": height,
+            "imageWidth": width
+        }
+        json_str = json.dumps(labelme_json, indent=2)
+        file.write(json_str)
 
 
 # Example directories to test
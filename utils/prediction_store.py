@@ -0,0 +1,231 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+from utils.fileio import file_signature, files_of_type
+
+
+PRED_FORMATS = ["png", "npz", "rgba"]
+CHUNK_PREFIX = "predictions_"
+
+
+def prediction_to_uint8(pred):
+    """
+    Quantize prediction probabilities in 0-1 to uint8 in 0-255.
+
+    Parameters
+    ----------
+    pred: np.array
+        The prediction probabilities
+
+    Returns
+    -------
+    np.array of uint8
+    """
+    return np.round(np.clip(pred, 0, 1) * 255).astype(np.uint8)
+
+
+def save_prediction_png(pred_file, pred, compress_level=6):
+    """
+    Save a single prediction as a single channel, 8 bit grayscale PNG of the
+    absolute probability, so that a pixel value v is a probability of v/255.
+
+    Parameters
+    ----------
+    pred_file: str
+        Full path of the output image
+    pred: np.array
+        The prediction probabilities, shape (size, size)
+    compress_level: int (default 6)
+        PNG compression level, 0-9. Lower is faster but makes larger files.
+    """
+    Image.fromarray(prediction_to_uint8(np.squeeze(pred))).save(
+        pred_file, compress_level=compress_level)
+
+
+def write_prediction_chunk(pred_dir, chunk_id, names, preds, dtype="uint8"):
+    """
+    Save a chunk of predictions to a compressed .npz file in pred_dir. The
+    chunk holds the names of the predictions and a single array of their
+    probabilities. It is written to a temporary file and renamed into place.
+
+    Parameters
+    ----------
+    pred_dir: str
+        Full path of the prediction directory
+    chunk_id: int
+        Number of the chunk, used in the filename
+    names: list[str]
+        Basenames of the images, e.g. 000001_1.png
+    preds: np.array
+        The prediction probabilities, shape (n, size, size)
+    dtype: str (default "uint8")
+        "uint8" stores round(255 * p), "float16" stores the probabilities.
+
+    Returns
+    -------
+    str: full path of the chunk file
+    """
+    if dtype == "uint8":
+        data = prediction_to_uint8(preds)
+    elif dtype == "float16":
+        data = np.asarray(preds, dtype=np.float16)
+    else:
+        raise ValueError(f"Unsupported prediction dtype {dtype}.")
+
+    chunk_file = os.path.join(pred_dir, f"{CHUNK_PREFIX}{chunk_id:05d}.npz")
+    tmp_file = os.path.join(pred_dir, f".{CHUNK_PREFIX}{chunk_id:05d}.npz")
+    with open(tmp_file, "wb") as f:
+        np.savez_compressed(f, name=np.array(names, dtype=str), pred=data)
+    os.replace(tmp_file, chunk_file)
+    return chunk_file
+
+
+def chunk_files(pred_dir):
+    """
+    Get the prediction chunk files in a directory, in order.
+
+    Parameters
+    ----------
+    pred_dir: str
+        Full path of the prediction directory
+
+    Returns
+    -------
+    list[str] of full paths
+    """
+    return sorted(files_of_type(pred_dir, CHUNK_PREFIX + "*.npz"))
+
+
+@lru_cache(maxsize=4)
+def _load_chunk(chunk_file, mtime_ns):
+    """
+    Load the predictions of a chunk. Cached so that reading the images of a
+    chunk one at a time only decompresses it once. mtime_ns is part of the
+    cache key so a rewritten chunk is reloaded.
+    """
+    with np.load(chunk_file) as data:
+        return data["pred"]
+
+
+@lru_cache(maxsize=64)
+def _chunk_index(pred_dir, signature):
+    """
+    Map each prediction name to its chunk file and position in the chunk.
+    signature is part of the cache key so that changed chunks are reindexed.
+    """
+    index = {}
+    for chunk_file, _ in signature:
+        with np.load(chunk_file) as data:
+            for i, name in enumerate(data["name"]):
+                index[str(name)] = (chunk_file, i)
+    return index
+
+
+def _store_index(pred_dir):
+    signature = tuple((fn, os.stat(fn).st_mtime_ns)
+                      for fn in chunk_files(pred_dir))
+    return _chunk_index(pred_dir, signature)
+
+
+def list_predictions(pred_dir):
+    """
+    Get the names of all the predictions in a directory, whether saved as
+    images or in chunk files.
+
+    Parameters
+    ----------
+    pred_dir: str
+        Full path of the prediction directory
+
+    Returns
+    -------
+    list[str] of basenames, e.g. 000001_1.png
+    """
+    imgs = files_of_type(pred_dir, "*.png", fullpath=False)
+    return imgs + list(_store_index(pred_dir).keys())
+
+
+def read_prediction(prediction_file):
+    """
+    Read a single prediction as probabilities in 0-1. Grayscale PNGs and
+    chunk files hold absolute probabilities. Older RGBA predictions written
+    by plt.imsave were scaled to their own min and max, so for those the
+    first channel is normalized by its max as before.
+
+    Parameters
+    ----------
+    prediction_file: str
+        Full path of the prediction image. If the file doesn't exist, the
+        prediction is looked up by its basename in the chunk files of the
+        same directory.
+
+    Returns
+    -------
+    np.array of float64, shape (size, size)
+    """
+    if os.path.exists(prediction_file):
+        with Image.open(prediction_file) as im:
+            arr = np.array(im)
+        if arr.ndim == 3:  # Legacy RGBA prediction
+            arr = arr[:, :, 0].astype(np.float64)
+            pmax = np.max(arr)
+            return arr / pmax if pmax > 0 else arr
+        return arr.astype(np.float64) / 255
+
+    pred_dir, name = os.path.split(prediction_file)
+    try:
+        chunk_file, i = _store_index(pred_dir)[name]
+    except KeyError:
+        raise FileNotFoundError(f"No prediction found for {prediction_file}")
+    data = _load_chunk(chunk_file, os.stat(chunk_file).st_mtime_ns)[i]
+    if data.dtype == np.uint8:
+        return data.astype(np.float64) / 255
+    return data.astype(np.float64)
+
+
+def prediction_signature(prediction_file):
+    """
+    Fingerprint of a single prediction that changes whenever it is rewritten,
+    whether it is saved as an image or in a chunk file.
+
+    Parameters
+    ----------
+    prediction_file: str
+        Full path of the prediction image
+
+    Returns
+    -------
+    str, see utils.fileio.file_signature(). For predictions in chunk files
+    it is the signature of the chunk and the position in it.
+    """
+    if os.path.exists(prediction_file):
+        return file_signature(prediction_file)
+
+    pred_dir, name = os.path.split(prediction_file)
+    try:
+        chunk_file, i = _store_index(pred_dir)[name]
+    except KeyError:
+        raise FileNotFoundError(f"No prediction found for {prediction_file}")
+    return f"{file_signature(chunk_file)}:{i}"
+
+
+def open_prediction_image(prediction_file):
+    """
+    Open a prediction as a PIL image, whether it is saved as an image or in a
+    chunk file.
+
+    Parameters
+    ----------
+    prediction_file: str
+        Full path of the prediction image
+
+    Returns
+    -------
+    PIL.Image. The caller should close it.
+    """
+    if os.path.exists(prediction_file):
+        return Image.open(prediction_file)
+    return Image.fromarray(prediction_to_uint8(read_prediction(prediction_file)))
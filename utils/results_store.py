@@ -0,0 +1,171 @@
+import os
+import time
+import sqlite3
+
+import pandas as pd
+
+from utils.fileio import verify_dir
+
+
+RUN_COLUMNS = ["train_set", "test_set", "backbone", "seed", "model_rev", "weight_file", "threshold"]
+VALUE_COLUMNS = ["loss", "iou_score", "precision", "recall", "f1_score", "tp", "fp", "fn", "tn"]
+
+_COLUMN_TYPES = {"seed": "INTEGER", "threshold": "REAL"}
+
+
+def column_name(name):
+    """
+    Store column name of a metric, e.g. f1-score is stored as f1_score.
+    """
+    return name.replace("-", "_").replace(" ", "_")
+
+
+def _connect(db_file):
+    """
+    Open the results database, creating the table if needed. The timeout lets
+    several processes append to the same file, each waiting for the others'
+    writes to finish.
+    """
+    verify_dir(os.path.dirname(os.path.abspath(db_file)))
+    conn = sqlite3.connect(db_file, timeout=60)
+    cols = [f'"{c}" {_COLUMN_TYPES.get(c, "TEXT")}' for c in RUN_COLUMNS]
+    cols += [f'"{c}" REAL' for c in VALUE_COLUMNS]
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS results ("
+                     "id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL, " + ", ".join(cols) + ")")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_run ON results (" +
+                     ", ".join(f'"{c}"' for c in RUN_COLUMNS) + ")")
+    return conn
+
+
+def append_result(db_file, run, values):
+    """
+    Append one result row to the results database. Rows are never updated in
+    place; rerunning an evaluation adds a new row, and read_results() returns
+    the latest row of each run by default. Each append is a single
+    transaction, so a row is either fully written or not at all.
+
+    Parameters
+    ----------
+    db_file: str
+        Full path of the SQLite results file. Created if it doesn't exist.
+    run: dict
+        Metadata of the run, keyed by RUN_COLUMNS. Missing keys are stored as
+        NULL, e.g. threshold for metrics computed on the probabilities.
+    values: dict
+        Metric values and confusion counts, keyed by VALUE_COLUMNS. Names
+        like f1-score are converted with column_name().
+
+    Returns
+    -------
+    int: id of the new row
+    """
+    unknown = set(run) - set(RUN_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown run columns {sorted(unknown)}.")
+    values = {column_name(k): v for k, v in values.items()}
+    unknown = set(values) - set(VALUE_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown value columns {sorted(unknown)}.")
+
+    cols = ["created"] + RUN_COLUMNS + VALUE_COLUMNS
+    row = [time.time()] + [run.get(c) for c in RUN_COLUMNS] + \
+          [None if values.get(c) is None else float(values[c]) for c in VALUE_COLUMNS]
+
+    conn = _connect(db_file)
+    try:
+        with conn:
+            cur = conn.execute("INSERT INTO results (" + ", ".join(f'"{c}"' for c in cols) + ") VALUES (" +
+                               ", ".join("?" * len(cols)) + ")", row)
+        return cur.lastrowid
+    finally:
+        conn.close()
+
+
+def read_results(db_file, latest=True, run_columns=None, **filters):
+    """
+    Read results from the results database.
+
+    Parameters
+    ----------
+    db_file: str
+        Full path of the SQLite results file
+    latest: bool (default True)
+        Only return the most recent row of each run, i.e. of each unique
+        combination of run_columns.
+    run_columns: list[str] (default None)
+        The columns that identify a run when taking the latest rows. If None,
+        all of RUN_COLUMNS.
+    filters:
+        Restrict the rows by run column, e.g. backbone="resnet34". A list
+        matches any of its values and None matches NULL.
+
+    Returns
+    -------
+    pd.DataFrame with one row per result, in the order they were added
+    """
+    run_columns = RUN_COLUMNS if run_columns is None else list(run_columns)
+    unknown = set(run_columns) - set(RUN_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown run columns {sorted(unknown)}.")
+
+    where = []
+    params = []
+    for key, val in filters.items():
+        if key not in RUN_COLUMNS:
+            raise ValueError(f"Unknown run column {key}.")
+        if val is None:
+            where.append(f'"{key}" IS NULL')
+        elif isinstance(val, (list, tuple, set)):
+            where.append(f'"{key}" IN (' + ", ".join("?" * len(val)) + ")")
+            params.extend(val)
+        else:
+            where.append(f'"{key}" = ?')
+            params.append(val)
+    if latest:
+        where.append("id IN (SELECT MAX(id) FROM results GROUP BY " +
+                     ", ".join(f'"{c}"' for c in run_columns) + ")")
+
+    sql = "SELECT * FROM results"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id"
+
+    conn = _connect(db_file)
+    try:
+        return pd.read_sql_query(sql, conn, params=params)
+    finally:
+        conn.close()
+
+
+def summary_tables(db_file, index="train_set", columns="test_set", values=None, aggfunc="mean", **filters):
+    """
+    Pivot the latest results into one table per metric. A run evaluated
+    again with other weights (e.g. final instead of best) replaces the
+    earlier result rather than being averaged with it, the same as the
+    result file written by the evaluation.
+
+    Parameters
+    ----------
+    db_file: str
+        Full path of the SQLite results file
+    index: str (default "train_set")
+        Run column used for the rows
+    columns: str (default "test_set")
+        Run column used for the columns
+    values: list[str] (default None)
+        Value columns to make tables of. If None, all of VALUE_COLUMNS.
+    aggfunc: str (default "mean")
+        How rows that share a cell are combined, e.g. results of several
+        seeds when seed isn't filtered.
+    filters:
+        Passed to read_results()
+
+    Returns
+    -------
+    dict of value column name to pd.DataFrame
+    """
+    values = VALUE_COLUMNS if values is None else [column_name(v) for v in values]
+    results = read_results(db_file, run_columns=[c for c in RUN_COLUMNS if c != "weight_file"], **filters)
+    return {value: results.pivot_table(index=index, columns=columns, values=value, aggfunc=aggfunc)
+            for value in values}
@@ -3,8 +3,11 @@ import numpy as np
 import glob
 import shutil
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 from utils.fileio import verify_dir, files_of_type
+from utils.json_to_dataset import labelme_json_to_array
+from utils.tile_stats import mask_tile_stats
 
 # https://github.com/whiplashoo/split-image
 from split_image import split_image
@@ -36,6 +39,263 @@ def calc_rowcol(img_file, slice_width, slice_height):
     return v_slices, h_slices
 
 
+def tile_boxes(imwidth, imheight, n_rows, n_cols):
+    """
+    Calculate the crop boxes for each tile of an image, following the same
+    conventions as split_image (tiles are numbered row by row and any
+    remainder pixels at the right and bottom edges are dropped).
+
+    Parameters
+    ----------
+    imwidth: int
+        image width in pixels
+    imheight: int
+        image height in pixels
+    n_rows: int
+        Number of tile rows
+    n_cols: int
+        Number of tile columns
+
+    Returns
+    -------
+    boxes: list[tuple]
+        (left, upper, right, lower) pixel box for each tile
+    """
+    tile_width = int(imwidth / n_cols)
+    tile_height = int(imheight / n_rows)
+    boxes = []
+    for i in range(n_rows):
+        for j in range(n_cols):
+            boxes.append((j * tile_width, i * tile_height,
+                          (j + 1) * tile_width, (i + 1) * tile_height))
+    return boxes
+
+
+def open_raster(img_file, reduce=1):
+    """
+    Open a source raster (e.g. JP2, TIF or PNG) for tiling. Where the codec
+    supports it (JPEG2000), the image is decoded directly at reduced
+    resolution, otherwise it is reduced after decoding.
+
+    Parameters
+    ----------
+    img_file: str
+        Full file path of the image
+    reduce: int (default 1)
+        Integer factor to reduce the resolution by. For JPEG2000, must be a
+        power of 2 to use the reduced resolution decoding.
+
+    Returns
+    -------
+    img: PIL.Image
+        The decoded image
+    """
+    img = Image.open(img_file)
+    if reduce > 1 and img.format == "JPEG2000" and (reduce & (reduce - 1)) == 0:
+        # Discard resolution levels inside the codec
+        img.reduce = int(np.log2(reduce))
+        img.load()
+    elif reduce > 1:
+        img.load()
+        img = img.reduce(reduce)
+    else:
+        img.load()
+    return img
+
+
+def slice_tiles(img_file, slice_width, slice_height, img_out_dir, mask=None,
+                mask_out_dir=None, img_ext="png", reduce=1, overwrite=False,
+                stats=None):
+    """
+    Slice an image and its mask into tiles in a single pass, reading straight
+    from the source raster. The source is decoded once and the tiles are
+    written without any intermediate full size image. Tiles are named and
+    sized the same as split_image: IMGNAME_N.ext
+
+    Parameters
+    ----------
+    img_file: str
+        Full file path of the source image. Any format supported by PIL.
+    slice_width: int
+        slice width in pixels (after any reduction)
+    slice_height: int
+        slice height in pixels (after any reduction)
+    img_out_dir: str
+        Full path of the output directory for image tiles
+    mask: str, np.array or None (default None)
+        Either the full file path of the mask image, or the mask as an array
+        with the same height and width as the image. If None, no mask tiles
+        are created.
+    mask_out_dir: str or None (default None)
+        Full path of the output directory for the mask tiles. Required if
+        mask is provided.
+    img_ext: str (default "png")
+        Extension of the output tiles
+    reduce: int (default 1)
+        Integer factor to reduce the resolution of the source by. See
+        open_raster().
+    overwrite: bool (default False)
+        Should existing tiles be overwritten?
+    stats: list or None (default None)
+        If a list is given, a (tile name, mask_tile_stats()) pair is appended
+        to it for every mask tile. Collect these over a dataset and save them
+        with utils.tile_stats.write_tile_records().
+
+    Returns
+    -------
+    tiles: list[str]
+        The basenames of all the tiles for this image
+    """
+    if mask is not None and mask_out_dir is None:
+        raise ValueError("mask_out_dir must be provided with mask.")
+
+    n_rows, n_cols = calc_rowcol(img_file, slice_width * reduce,
+                                 slice_height * reduce)
+    name = os.path.splitext(os.path.basename(img_file))[0]
+
+    verify_dir(img_out_dir)
+    if mask is not None:
+        verify_dir(mask_out_dir)
+
+    img = open_raster(img_file, reduce)
+
+    if mask is None:
+        msk = None
+    elif isinstance(mask, str):
+        msk = Image.open(mask)
+        msk.load()
+    else:
+        msk = Image.fromarray(np.asarray(mask, dtype=np.uint8), mode="P")
+
+    if msk is not None and msk.size != img.size:
+        if reduce > 1:  # Mask is at the source resolution
+            msk = msk.resize(img.size, resample=Image.NEAREST)
+        else:
+            raise ValueError(f"Mask size {msk.size} does not match image size "
+                             f"{img.size}.")
+
+    tiles = []
+    boxes = tile_boxes(img.size[0], img.size[1], n_rows, n_cols)
+    for n, box in enumerate(boxes):
+        tile_name = f"{name}_{n}.{img_ext}"
+        tiles.append(tile_name)
+
+        img_tile_fn = os.path.join(img_out_dir, tile_name)
+        if overwrite or not os.path.exists(img_tile_fn):
+            img.crop(box).save(img_tile_fn)
+
+        if msk is not None:
+            mask_tile = msk.crop(box)
+            mask_tile_fn = os.path.join(mask_out_dir, tile_name)
+            if overwrite or not os.path.exists(mask_tile_fn):
+                mask_tile.save(mask_tile_fn)
+            if stats is not None:
+                stats.append((tile_name, mask_tile_stats(mask_tile)))
+
+    img.close()
+    if msk is not None:
+        msk.close()
+
+    return tiles
+
+
+def slice_labelme_tiles(img_files, slice_width, slice_height, img_out_dir,
+                        mask_out_dir, label_name_to_value, layer_order=None,
+                        img_ext="png", reduce=1, overwrite=False,
+                        n_workers=None, verbose=True):
+    """
+    Rasterize the labelme JSON file of each image into a mask and slice both
+    into tiles with slice_tiles(). The JSON file is expected next to its
+    image, with the same name. Masks are only held in memory, and each image
+    is handled by a single worker from decode to tiles.
+
+    Parameters
+    ----------
+    img_files: list[str]
+        Full file paths of the source images
+    slice_width: int
+        slice width in pixels (after any reduction)
+    slice_height: int
+        slice height in pixels (after any reduction)
+    img_out_dir: str
+        Full path of the output directory for image tiles
+    mask_out_dir: str
+        Full path of the output directory for the mask tiles
+    label_name_to_value: dict
+        a dict connecting polygon label names to the numeric id that should be
+        displayed in the mask
+    layer_order: list (default None)
+        A list of the layer order using the keys in label_name_to_value. If
+        None, uses numeric value to sort
+    img_ext: str (default "png")
+        Extension of the output tiles
+    reduce: int (default 1)
+        Integer factor to reduce the resolution of the source by. See
+        open_raster().
+    overwrite: bool (default False)
+        Should existing tiles be overwritten?
+    n_workers: int or None (default None)
+        Number of worker processes. If None or 1, images are sliced in the
+        current process.
+    verbose: bool (default True)
+        Print a summary when done?
+
+    Returns
+    -------
+    stats: list[tuple]
+        (tile name, mask_tile_stats()) pair for every mask tile, in the order
+        of img_files. Save them with utils.tile_stats.write_tile_records().
+        Images that fail are reported and left out.
+    """
+    args = (slice_width, slice_height, img_out_dir, mask_out_dir,
+            label_name_to_value, layer_order, img_ext, reduce, overwrite)
+
+    results = []
+    failed = []
+    if n_workers is None or n_workers <= 1:
+        for img_file in img_files:
+            try:
+                results.append(_slice_labelme_image(img_file, *args))
+            except Exception as e:
+                print(f"Failed to slice {img_file}: {e}")
+                failed.append(img_file)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [(img_file, pool.submit(_slice_labelme_image, img_file,
+                                              *args))
+                       for img_file in img_files]
+            for img_file, future in futures:
+                if future.exception() is None:
+                    results.append(future.result())
+                else:
+                    print(f"Failed to slice {img_file}: "
+                          f"{future.exception()}")
+                    failed.append(img_file)
+
+    if verbose:
+        print(f"Images sliced: {len(results)}, failed: {len(failed)}")
+
+    return [record for records in results for record in records]
+
+
+def _slice_labelme_image(img_file, slice_width, slice_height, img_out_dir,
+                         mask_out_dir, label_name_to_value, layer_order=None,
+                         img_ext="png", reduce=1, overwrite=False):
+    """
+    Rasterize and slice a single image. Used as the unit of work for
+    slice_labelme_tiles, returns the stats of its mask tiles.
+    """
+    if layer_order is not None:
+        layer_order = list(layer_order)  # shapes_to_label may add to it
+    json_file = os.path.splitext(img_file)[0] + ".json"
+    mask = labelme_json_to_array(json_file, label_name_to_value, layer_order)
+    stats = []
+    slice_tiles(img_file, slice_width, slice_height, img_out_dir, mask=mask,
+                mask_out_dir=mask_out_dir, img_ext=img_ext, reduce=reduce,
+                overwrite=overwrite, stats=stats)
+    return stats
+
+
 # Deprecated due to updates in split_image
 # def slice_image(img_file, n_rows, n_cols, out_dir=None):
 #     """
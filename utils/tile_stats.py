@@ -0,0 +1,194 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from utils.fileio import files_of_type, verify_dir
+
+
+def mask_tile_stats(mask):
+    """
+    Compute the summary statistics of a single mask tile.
+
+    Parameters
+    ----------
+    mask: np.array or PIL.Image
+        The mask tile
+
+    Returns
+    -------
+    stats: dict
+        positive: int
+            Number of non-zero pixels
+        bbox: tuple
+            (left, upper, right, lower) box around the non-zero pixels, same
+            convention as PIL getbbox(). (-1, -1, -1, -1) if the mask is blank.
+        values: np.array
+            The distinct pixel values present in the mask
+        counts: np.array
+            The number of pixels with each of the values
+    """
+    arr = np.asarray(mask)
+    if arr.ndim == 3:
+        nonzero = np.any(arr != 0, axis=-1)
+        arr = arr[:, :, 0]
+    else:
+        nonzero = arr != 0
+
+    rows = np.flatnonzero(np.any(nonzero, axis=1))
+    if rows.size == 0:
+        bbox = (-1, -1, -1, -1)
+    else:
+        cols = np.flatnonzero(np.any(nonzero, axis=0))
+        bbox = (int(cols[0]), int(rows[0]), int(cols[-1]) + 1,
+                int(rows[-1]) + 1)
+
+    values, counts = np.unique(arr, return_counts=True)
+
+    return {"positive": int(np.count_nonzero(nonzero)),
+            "bbox": bbox,
+            "values": values.astype(np.int64),
+            "counts": counts.astype(np.int64)}
+
+
+def write_tile_stats(stats_file, names, stats):
+    """
+    Write a tile statistics index to a compressed columnar .npz file. The
+    class histograms are stored sparsely, with the values and counts of all
+    tiles concatenated and an offset array marking where each tile starts.
+
+    Parameters
+    ----------
+    stats_file: str
+        Full path of the output .npz file
+    names: list[str]
+        Basenames of the mask tiles
+    stats: list[dict]
+        Output of mask_tile_stats() for each of the tiles
+    """
+    verify_dir(os.path.dirname(os.path.abspath(stats_file)))
+
+    n = len(names)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s["values"]) for s in stats])
+
+    np.savez_compressed(
+        stats_file,
+        name=np.array(names, dtype=str),
+        positive=np.array([s["positive"] for s in stats], dtype=np.int64),
+        bbox=np.array([s["bbox"] for s in stats],
+                      dtype=np.int32).reshape(n, 4),
+        hist_values=np.concatenate([s["values"] for s in stats] +
+                                   [np.zeros(0, dtype=np.int64)]),
+        hist_counts=np.concatenate([s["counts"] for s in stats] +
+                                   [np.zeros(0, dtype=np.int64)]),
+        hist_offsets=offsets)
+
+
+def write_tile_records(stats_file, records):
+    """
+    Write a tile statistics index from a list of (tile name, stats) pairs, as
+    collected by utils.slice_dataset_tiles.slice_tiles(stats=...). An empty
+    list writes an empty index.
+
+    Parameters
+    ----------
+    stats_file: str
+        Full path of the output .npz file
+    records: list[tuple]
+        (basename, mask_tile_stats()) pair for each of the mask tiles
+    """
+    names = [name for name, _ in records]
+    stats = [stat for _, stat in records]
+    write_tile_stats(stats_file, names, stats)
+
+
+def read_tile_stats(stats_file):
+    """
+    Read a tile statistics index written by write_tile_stats().
+
+    Parameters
+    ----------
+    stats_file: str
+        Full path of the .npz file
+
+    Returns
+    -------
+    stats: dict
+        Columns of the index: name, positive, bbox, hist_values, hist_counts,
+        hist_offsets. The histogram of tile i is given by
+        hist_values[hist_offsets[i]:hist_offsets[i+1]] and the matching slice
+        of hist_counts.
+    """
+    with np.load(stats_file) as data:
+        return {key: data[key] for key in data.files}
+
+
+def filter_tile_stats(stats, keep_names):
+    """
+    Subset a tile statistics index to the tiles in keep_names.
+
+    Parameters
+    ----------
+    stats: dict
+        Output of read_tile_stats()
+    keep_names: iterable[str]
+        Basenames of the tiles to keep
+
+    Returns
+    -------
+    names, stats: (list[str], list[dict])
+        Suitable for passing to write_tile_stats()
+    """
+    keep_names = set(keep_names)
+    names = []
+    out = []
+    for i, name in enumerate(stats["name"]):
+        if name not in keep_names:
+            continue
+        lo, hi = stats["hist_offsets"][i], stats["hist_offsets"][i + 1]
+        names.append(str(name))
+        out.append({"positive": int(stats["positive"][i]),
+                    "bbox": tuple(stats["bbox"][i]),
+                    "values": stats["hist_values"][lo:hi],
+                    "counts": stats["hist_counts"][lo:hi]})
+    return names, out
+
+
+def build_tile_stats(mask_dir, stats_file, img_ext="png"):
+    """
+    Build the tile statistics index for an existing directory of mask tiles.
+    Only needed for datasets that were sliced before the index existed.
+
+    Parameters
+    ----------
+    mask_dir: str
+        Full path where the mask files exist
+    stats_file: str
+        Full path of the output .npz file
+    img_ext: str (default 'png')
+        String of the image filetype
+    """
+    names = []
+    stats = []
+    for fn in files_of_type(mask_dir, "*." + img_ext):
+        with Image.open(fn) as img:
+            stats.append(mask_tile_stats(img))
+        names.append(os.path.basename(fn))
+    write_tile_stats(stats_file, names, stats)
+
+
+def blank_tiles(stats):
+    """
+    Get the names of all the blank tiles in a tile statistics index.
+
+    Parameters
+    ----------
+    stats: dict
+        Output of read_tile_stats()
+
+    Returns
+    -------
+    list[str] of the basenames of the blank tiles
+    """
+    return [str(n) for n in stats["name"][stats["positive"] == 0]]